@@ -0,0 +1,428 @@
+import asyncio
+import os
+import time
+
+try:
+    import aiohttp  # only needed for the asyncio engine
+except ImportError:
+    aiohttp = None
+
+from host_stats import host_of
+from m3u8_ts_to_tg import SEGMENT_HEADERS, M3U8TSToTG
+from sent_ledger import SentLedger
+from telegram_uploader import retry_after_of
+
+
+class AsyncM3U8TSToTG(M3U8TSToTG):
+    """
+    M3U8TSToTG on a single asyncio event loop.
+
+    Playlist polling, segment fetches (aiohttp), ffmpeg merges (asyncio
+    subprocesses) and Telegram uploads all run as coroutines, so a stream
+    costs a few tasks instead of several threads and nothing blocks on
+    time.sleep. Playlist parsing, the segment ledger, grouping, sent
+    bookkeeping and decryption are shared with the threaded class; disk
+    writes, decryption and TS scans run in the loop's default executor so
+    they never stall other fetches. Only merge_mode="concat" is supported.
+
+    run(timeout_hours=...) still works as before; run_async() can be awaited
+    directly to put many streams on one loop.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        if self.merge_mode != "concat":
+            raise ValueError("AsyncM3U8TSToTG only supports merge_mode='concat'")
+        self.http = None
+        self.fetch_slots = None
+        self.segment_aqueue = None
+        self.upload_aqueue = None
+        self.uploading = False  # upload_loop is sending a file
+
+    def run(self, timeout_hours=2.5):
+        """Blocking wrapper around run_async()."""
+        asyncio.run(self.run_async(timeout_hours))
+
+    async def run_async(self, timeout_hours=2.5):
+        if aiohttp is None:
+            raise RuntimeError("AsyncM3U8TSToTG needs aiohttp: pip install aiohttp")
+
+        timeout_seconds = timeout_hours * 3600
+        start_time = time.time()
+        self.last_activity = start_time
+
+        self.segment_aqueue = asyncio.Queue()
+        self.upload_aqueue = asyncio.Queue()
+        self.fetch_slots = asyncio.Semaphore(self.download_concurrency)
+        self.sent = SentLedger(self.sent_json_file)
+        self.recover_leftovers()
+        if self.metrics_port:
+            self.metrics_server = self.metrics.serve(self.metrics_port)
+
+        connector = aiohttp.TCPConnector(
+            limit=self.download_concurrency,
+            limit_per_host=self.max_connections_per_host,
+        )
+        async with aiohttp.ClientSession(connector=connector) as http:
+            self.http = http
+            print("🚀 Starting playlist poller and uploader tasks...")
+            tasks = [
+                asyncio.ensure_future(self.poll_playlist()),
+                asyncio.ensure_future(self.upload_loop()),
+            ]
+            try:
+                while True:
+                    await self.collect_segments_async(timeout=1)
+                    self.merge_ts_to_mp4()
+                    self.shed_load()
+                    self.save_checkpoint()
+
+                    elapsed = time.time() - start_time
+                    idle_time = time.time() - self.last_activity
+
+                    if elapsed > timeout_seconds:
+                        print(f"⏱️ {timeout_hours} hours elapsed — stopping.")
+                        break
+                    if idle_time > timeout_seconds:
+                        print(f"🕒 Idle {timeout_hours} hours — stopping.")
+                        break
+                    if self.drained():
+                        print("🏁 Everything merged and sent — stopping.")
+                        break
+            finally:
+                self.stop_event.set()
+                for task in tasks:
+                    task.cancel()
+                await asyncio.gather(*tasks, return_exceptions=True)
+                # let running merges finish so their MP4s are queued in order
+                merges = [entry[1] for entry in self.merging if entry[1] is not None]
+                await asyncio.gather(*merges, return_exceptions=True)
+                self.hand_off_merges()
+                if self.metrics_server is not None:
+                    self.metrics_server.shutdown()
+                # keep what the downloader finished for the next run
+                received = []
+                while not self.segment_aqueue.empty():
+                    received.append(self.segment_aqueue.get_nowait())
+                if received:
+                    self.add_pending(received)
+                self.save_checkpoint(force=True)
+                self.sent.close()
+                self.cleanup()
+                print("🧹 Cleaned .ts files. ✅ Done.")
+
+    # --- download stage ---
+
+    async def poll_playlist(self):
+        """Reload the playlist on the HLS cadence and fetch new segments."""
+        loop = asyncio.get_event_loop()
+        while not self.stop_event.is_set() and not self.downloads_finished:
+            started = loop.time()
+            try:
+                await self.download_new_segments_async()
+            except Exception as e:
+                print("Download task error:", e)
+                await asyncio.sleep(2)
+                continue
+            await asyncio.sleep(max(0, self.poll_interval() - (loop.time() - started)))
+
+    async def fetch_playlist_async(self):
+        async with self.http.get(
+            self.m3u8_url,
+            headers=self.playlist_headers(),
+            timeout=aiohttp.ClientTimeout(total=10),
+        ) as r:
+            if r.status == 304:
+                return None
+            r.raise_for_status()
+            return self.playlist_changed_text(r.headers, await r.text())
+
+    async def download_new_segments_async(self) -> bool:
+        if self.downloads_paused():
+            return False
+        fetch_started = time.time()
+        try:
+            text = await self.fetch_playlist_async()
+        except Exception as e:
+            self.playlist_failed(e)
+            return False
+        self.stats.observe("playlist_fetch_seconds", time.time() - fetch_started)
+
+        self.playlist_changed = text is not None
+        if text is None:
+            return False
+
+        playlist = self.parse_playlist(text)
+        if playlist is None:
+            return False
+
+        started = time.time()
+        jobs = [
+            (segment, ts_file, asyncio.ensure_future(self.fetch_segment_async(segment, ts_file)))
+            for segment, ts_file in self.new_segments(playlist)
+        ]
+        self.stats.set("download_queue_depth", len(jobs))
+
+        new_files = 0
+        # publish in playlist order, like the threaded downloader
+        for segment, ts_file, task in jobs:
+            try:
+                tmp_name, segment.size = await task
+                await self.publish_segment_async(segment, ts_file, tmp_name)
+                self.segment_fetched(segment)
+                new_files += 1
+            except Exception as e:
+                self.download_failed(segment, ts_file, e)
+        self.observe_batch(jobs, started)
+        self.record_gaps()
+        self.check_ended(jobs)
+        return new_files > 0
+
+    async def ensure_key(self, segment):
+        """Fetch an AES-128/SAMPLE-AES key into the shared key cache without blocking the loop."""
+        key = segment.key
+        if key is None or key.method not in ("AES-128", "SAMPLE-AES"):
+            return
+        if key.uri in self.key_cache.keys:
+            return
+        if key.uri.startswith("data:"):
+            self.key_cache.get(key.uri)
+            return
+        async with self.http.get(key.uri, timeout=aiohttp.ClientTimeout(total=10)) as r:
+            r.raise_for_status()
+            data = await r.read()
+        if len(data) != 16:
+            raise ValueError(f"AES-128 key must be 16 bytes, got {len(data)}")
+        with self.key_cache.lock:
+            self.key_cache.keys[key.uri] = data
+
+    async def fetch_from_async(self, segment, url: str, tmp_name: str):
+        """One GET of a segment into tmp_name; return (path, size)."""
+        await self.ensure_key(segment)
+        decryptor = self.make_decryptor(segment)
+        host = host_of(url)
+        started = time.time()
+        try:
+            received = written = 0
+            headers = dict(SEGMENT_HEADERS)
+            if segment.byterange is not None:
+                length, offset = segment.byterange
+                headers["Range"] = f"bytes={offset}-{offset + length - 1}"
+            async with self.http.get(
+                url,
+                headers=headers,
+                timeout=aiohttp.ClientTimeout(total=None, sock_read=20),
+            ) as res:
+                res.raise_for_status()
+                if "Range" in headers and res.status != 206:
+                    raise IOError("server ignored the Range header")
+                # disk writes and decryption go to the executor, off the loop
+                loop = asyncio.get_event_loop()
+                f = await loop.run_in_executor(None, open, tmp_name, "wb")
+                try:
+                    async for chunk in res.content.iter_chunked(self.chunk_size):
+                        received += len(chunk)
+                        written += await loop.run_in_executor(
+                            None, self.write_body_chunk, f, decryptor, chunk
+                        )
+                    if decryptor is not None:
+                        written += await loop.run_in_executor(
+                            None, self.write_body_chunk, f, decryptor, None
+                        )
+                finally:
+                    f.close()
+                self.check_body_length(received, res.headers)
+        except asyncio.CancelledError:
+            self.fetch_aborted(tmp_name, host, started, cancelled=True)
+            raise
+        except Exception:
+            self.fetch_aborted(tmp_name, host, started, cancelled=False)
+            raise
+        self.fetch_succeeded(segment, host, started)
+        return tmp_name, written
+
+    async def hedged_fetch_async(self, segment, ts_file: str, url: str, backup_url: str):
+        """hedged_fetch() with tasks: the slower request is cancelled outright."""
+        first = asyncio.ensure_future(self.fetch_from_async(segment, url, ts_file + ".part"))
+        delay = self.hedge_delay(url, segment)
+        done, _ = await asyncio.wait([first], timeout=delay)
+        if done:
+            return first.result()
+
+        name = os.path.basename(ts_file)
+        print(f"🐇 {name} slower than {delay:.1f}s, hedging on {host_of(backup_url)}")
+        self.stats.inc("hedged_requests_total")
+        second = asyncio.ensure_future(
+            self.fetch_from_async(segment, backup_url, ts_file + ".hedge.part")
+        )
+        running = {first, second}
+        winner = error = None
+        try:
+            while running and winner is None:
+                done, running = await asyncio.wait(running, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is not None:
+                        error = task.exception()
+                    elif winner is None:
+                        winner = task
+                    else:
+                        self.remove_quietly(task.result()[0])
+        finally:
+            for task in running:
+                task.cancel()
+        if winner is None:
+            raise error
+        if winner is second:
+            self.stats.inc("hedge_wins_total")
+        return winner.result()
+
+    async def fetch_segment_async(self, segment, ts_file: str):
+        """Stream one segment to a .part file; return (path, size)."""
+        urls = self.segment_urls(segment.url)
+        retries = max(self.segment_retries, len(urls) - 1)
+        attempt = 0
+        async with self.fetch_slots:
+            while True:
+                url = urls[attempt % len(urls)]
+                backup_url = urls[(attempt + 1) % len(urls)]
+                try:
+                    return await self.hedged_fetch_async(segment, ts_file, url, backup_url)
+                except Exception as e:
+                    attempt += 1
+                    if attempt > retries or self.stop_event.is_set():
+                        raise
+                    self.fetch_failed(url, e, attempt, backup_url, os.path.basename(ts_file))
+
+    async def publish_segment_async(self, segment, ts_file: str, tmp_name: str):
+        """publish_segment() with the rename and the TS scan off the loop."""
+        loop = asyncio.get_event_loop()
+        await loop.run_in_executor(None, self.store_segment, segment, ts_file, tmp_name)
+        self.segment_aqueue.put_nowait(segment)
+        print(f"⬇️ Downloaded: {os.path.basename(ts_file)}")
+
+    # --- merge stage ---
+
+    async def collect_segments_async(self, timeout: float):
+        try:
+            received = [await asyncio.wait_for(self.segment_aqueue.get(), timeout)]
+        except asyncio.TimeoutError:
+            return
+        while not self.segment_aqueue.empty():
+            received.append(self.segment_aqueue.get_nowait())
+        self.add_pending(received)
+
+    def start_merge(self, group):
+        """Merges run as tasks on the loop instead of the merge pool."""
+        return asyncio.ensure_future(self.timed_merge_async(group))
+
+    async def timed_merge_async(self, group):
+        started = time.time()
+        ok, mp4_name = await self.merge_group_async(group)
+        return ok, mp4_name, time.time() - started
+
+    async def merge_group_async(self, group):
+        """merge_group() with ffmpeg as an asyncio subprocess."""
+        loop = asyncio.get_event_loop()
+        prepared = await loop.run_in_executor(None, self.prepare_merge, group)
+        if prepared is None:
+            return True, None
+        paths, mp4_name, list_file = prepared
+        try:
+            proc = await asyncio.create_subprocess_exec(
+                *self.concat_command(list_file, mp4_name),
+                stdout=asyncio.subprocess.PIPE,
+                stderr=asyncio.subprocess.PIPE,
+            )
+            _, stderr = await proc.communicate()
+            ok = await loop.run_in_executor(
+                None, self.finish_merge, paths, mp4_name, proc.returncode, stderr
+            )
+            return ok, mp4_name if ok else None
+        finally:
+            self.remove_quietly(list_file)
+
+    def drained(self) -> bool:
+        if not self.downloads_finished or self.pending_ts or not self.segment_aqueue.empty():
+            return False
+        return self.upload_aqueue.empty() and not self.uploading
+
+    # --- upload stage ---
+
+    def mp4_ready(self, mp4_name: str):
+        self.last_activity = time.time()
+        f = os.path.basename(mp4_name)
+        if f not in self.sent:
+            self.sent.record(f, first_seen=time.time(), sent=False)
+        self.unsent.append(mp4_name)
+        self.stage(self.file_size(mp4_name))
+        self.upload_aqueue.put_nowait(mp4_name)
+        self.stats.set("upload_queue_depth", self.upload_aqueue.qsize())
+
+    async def send_async(self, file_path: str):
+        """One sendDocument attempt; returns the status and parsed JSON body."""
+        data = {"chat_id": str(self.telegram_chat_id), "caption": self.caption_for(file_path)}
+        if self.uploader.local_mode:
+            data["document"] = self.uploader.local_uri(file_path)
+            return await self.post_document(data)
+        with open(file_path, "rb") as f:
+            form = aiohttp.FormData(data)
+            form.add_field("document", f, filename=os.path.basename(file_path))
+            return await self.post_document(form)
+
+    async def post_document(self, data):
+        async with self.http.post(
+            self.uploader.url,
+            data=data,
+            timeout=aiohttp.ClientTimeout(total=None, sock_read=self.uploader.timeout),
+        ) as response:
+            try:
+                body = await response.json(content_type=None)
+            except ValueError:
+                body = {}
+            return response.status, body, response.headers
+
+    async def upload_loop(self):
+        """
+        Upload MP4s one after another (keeping chat order), honouring 429
+        retry_after and backing off exponentially on 5xx and network errors.
+        """
+        backoff = 1
+        while True:
+            file_path = await self.upload_aqueue.get()
+            self.stats.set("upload_queue_depth", self.upload_aqueue.qsize())
+            self.uploading = True
+            attempts = 0
+            while True:
+                attempts += 1
+                started = time.time()
+                try:
+                    status, body, headers = await self.send_async(file_path)
+                except FileNotFoundError as e:
+                    print(f"❌ {file_path} is gone, dropping upload: {e}")
+                    self.drop_upload(file_path)
+                    break
+                except Exception as e:
+                    print(f"⚠️ Telegram send error for {file_path}: {e}")
+                    status, body, headers = None, {}, {}
+
+                if status == 200:
+                    backoff = 1
+                    self.stats.observe("upload_seconds", time.time() - started)
+                    if attempts > 1:
+                        self.stats.inc("upload_retries_total", attempts - 1)
+                    self.record_sent(file_path)
+                    await asyncio.sleep(self.uploader.per_chat_interval)
+                    break
+                if status == 429:
+                    retry_after = retry_after_of(body, headers)
+                    print(f"🐢 Flood limit: retry after {retry_after}s")
+                    await asyncio.sleep(retry_after)
+                elif status is None or status >= 500:
+                    backoff = min(backoff * 2, self.uploader.max_backoff)
+                    print(f"Retrying {file_path} in {backoff}s...")
+                    await asyncio.sleep(backoff)
+                else:
+                    print(f"❌ Telegram rejected {file_path} ({status}): {body}")
+                    self.drop_upload(file_path)
+                    break
+            self.uploading = False
@@ -0,0 +1,398 @@
+"""
+Offline end-to-end benchmark: runs M3U8TSToTG against a synthetic live HLS
+origin and a stand-in for the Telegram Bot API, both on localhost, and
+prints the results as JSON. The two servers run in a separate process, so
+the CPU and memory figures are the pipeline's own; theirs are reported
+under "servers".
+
+    python benchmark.py --seconds 120 --segment-bytes 2000000 --error-rate 0.02 \
+        --rate-429 0.1 --output bench.json
+
+Every segment the origin serves is the same real H.264/AAC segment, generated
+once with ffmpeg's lavfi test source, so ffmpeg must be installed (the
+pipeline needs it for merging anyway).
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import random
+import resource
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from urllib.parse import parse_qs
+
+from m3u8_ts_to_tg import M3U8TSToTG
+from telegram_uploader import TelegramUploader
+
+
+class Server(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def start_server(handler, port=0):
+    server = Server(("127.0.0.1", port), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def ffmpeg_segment(duration: float, size: int) -> bytes:
+    """One real TS segment of about `size` bytes."""
+    bitrate = int(size * 8 / duration)
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "seg.ts")
+        cmd = [
+            "ffmpeg", "-y", "-loglevel", "error",
+            "-f", "lavfi", "-i", f"testsrc2=size=1280x720:rate=30:duration={duration}",
+            "-f", "lavfi", "-i", f"sine=duration={duration}",
+            "-c:v", "libx264", "-preset", "ultrafast", "-g", "60",
+            "-b:v", str(bitrate), "-maxrate", str(bitrate), "-bufsize", str(bitrate),
+            "-c:a", "aac", "-f", "mpegts", path,
+        ]
+        subprocess.run(cmd, check=True)
+        with open(path, "rb") as f:
+            return f.read()
+
+
+class LiveOrigin:
+    """
+    A live HLS origin: a new segment every `duration` seconds, a sliding
+    window of `window` segments with PROGRAM-DATE-TIME, and injectable
+    faults on segment responses (jitter, 5xx, slow responses).
+    """
+
+    def __init__(self, segment, duration=2.0, window=6, jitter=0.0,
+                 error_rate=0.0, slow_rate=0.0, slow_delay=5.0):
+        self.segment = segment
+        self.duration = duration
+        self.window = window
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.slow_rate = slow_rate
+        self.slow_delay = slow_delay
+        self.started = time.time()
+        self.stats = {"playlists": 0, "segments": 0, "errors_injected": 0, "slow_injected": 0}
+        self.server = None
+
+    def published(self) -> int:
+        """Number of segments published so far (the first window is there at start)."""
+        return int((time.time() - self.started) / self.duration) + self.window
+
+    def playlist(self) -> str:
+        last = self.published()
+        first = max(0, last - self.window)
+        lines = [
+            "#EXTM3U",
+            "#EXT-X-VERSION:3",
+            f"#EXT-X-TARGETDURATION:{int(self.duration + 0.999)}",
+            f"#EXT-X-MEDIA-SEQUENCE:{first}",
+        ]
+        for i in range(first, last):
+            # segment i went live `duration` seconds after it started airing
+            aired = self.started + (i - self.window) * self.duration
+            stamp = time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(aired))
+            lines.append(f"#EXT-X-PROGRAM-DATE-TIME:{stamp}.{int(aired % 1 * 1000):03d}Z")
+            lines.append(f"#EXTINF:{self.duration:.3f},")
+            lines.append(f"seg{i}.ts")
+        return "\n".join(lines) + "\n"
+
+    def start(self):
+        origin = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path == "/live.m3u8":
+                    origin.stats["playlists"] += 1
+                    self.reply(200, origin.playlist().encode(), "application/vnd.apple.mpegurl")
+                elif self.path.startswith("/seg"):
+                    origin.stats["segments"] += 1
+                    if origin.jitter:
+                        time.sleep(random.uniform(0, origin.jitter))
+                    if random.random() < origin.error_rate:
+                        origin.stats["errors_injected"] += 1
+                        self.reply(503, b"injected", "text/plain")
+                        return
+                    if random.random() < origin.slow_rate:
+                        origin.stats["slow_injected"] += 1
+                        time.sleep(origin.slow_delay)
+                    self.reply(200, origin.segment, "video/mp2t")
+                else:
+                    self.reply(404, b"", "text/plain")
+
+            def reply(self, status, body, content_type):
+                try:
+                    self.send_response(status)
+                    self.send_header("Content-Type", content_type)
+                    self.send_header("Content-Length", str(len(body)))
+                    self.end_headers()
+                    self.wfile.write(body)
+                except (BrokenPipeError, ConnectionResetError):
+                    pass  # the client cancelled it, e.g. a hedged request that lost
+
+            def log_message(self, *args):
+                pass
+
+        self.server = start_server(Handler)
+        return f"http://127.0.0.1:{self.server.server_address[1]}/live.m3u8"
+
+
+class FakeBotAPI:
+    """
+    Accepts sendDocument uploads; answers 429 with retry_after at `rate_429`.
+    Like a --local Bot API server it also takes file:// documents, which it
+    reads from disk.
+    """
+
+    def __init__(self, rate_429=0.0, retry_after=1):
+        self.rate_429 = rate_429
+        self.retry_after = retry_after
+        self.stats = {"documents": 0, "bytes": 0, "rejected_429": 0}
+        self.server = None
+
+    def start(self):
+        api = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                length = int(self.headers.get("Content-Length", 0))
+                if self.headers.get("Content-Type", "").startswith("application/x-www-form"):
+                    form = parse_qs(self.rfile.read(length).decode())
+                    document = form.get("document", [""])[0]
+                    if not document.startswith("file://"):
+                        self.reply(400, {"ok": False, "error_code": 400,
+                                         "description": "Bad Request: wrong file identifier"})
+                        return
+                    length = api.read_local(document[len("file://"):])
+                else:
+                    # drain the upload so the client sees real transfer times
+                    remaining = length
+                    while remaining > 0:
+                        chunk = self.rfile.read(min(remaining, 1024 * 1024))
+                        if not chunk:
+                            break
+                        remaining -= len(chunk)
+                if random.random() < api.rate_429:
+                    api.stats["rejected_429"] += 1
+                    body = {
+                        "ok": False,
+                        "error_code": 429,
+                        "description": "Too Many Requests: retry after %d" % api.retry_after,
+                        "parameters": {"retry_after": api.retry_after},
+                    }
+                    self.reply(429, body)
+                    return
+                api.stats["documents"] += 1
+                api.stats["bytes"] += length
+                self.reply(200, {"ok": True, "result": {"message_id": api.stats["documents"]}})
+
+            def reply(self, status, body):
+                data = json.dumps(body).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = start_server(Handler)
+        return f"http://127.0.0.1:{self.server.server_address[1]}"
+
+    def read_local(self, path) -> int:
+        """Read a file the way a local server would; returns its size."""
+        size = 0
+        with open(path, "rb") as f:
+            while True:
+                chunk = f.read(1024 * 1024)
+                if not chunk:
+                    return size
+                size += len(chunk)
+
+
+def histogram_summary(samples):
+    """Mean and bucket-estimated p50/p95 of a metrics snapshot histogram."""
+    if not samples:
+        return None
+    value = samples[0]["value"]
+    if not value["count"]:
+        return None
+    summary = {"count": value["count"], "mean": value["sum"] / value["count"]}
+    for name, q in (("p50", 0.5), ("p95", 0.95)):
+        for bound, n in value["buckets"].items():
+            if n >= q * value["count"]:
+                summary[name] = float(bound)
+                break
+    return summary
+
+
+def counter(snapshot, name):
+    return sum(sample["value"] for sample in snapshot.get(name, []))
+
+
+def cpu_seconds(usage) -> float:
+    return usage.ru_utime + usage.ru_stime
+
+
+def serve(args, conn):
+    """
+    Server process: generate the segment, run the origin and the fake Bot
+    API until told to stop, then send back their stats and resource usage.
+    """
+    segment = ffmpeg_segment(args.segment_duration, args.segment_bytes)
+    origin = LiveOrigin(
+        segment,
+        duration=args.segment_duration,
+        window=args.window,
+        jitter=args.jitter,
+        error_rate=args.error_rate,
+        slow_rate=args.slow_rate,
+        slow_delay=args.slow_delay,
+    )
+    bot = FakeBotAPI(rate_429=args.rate_429, retry_after=args.retry_after)
+    conn.send((origin.start(), origin.server.server_address[1], bot.start(), len(segment)))
+    conn.recv()
+    origin.server.shutdown()
+    bot.server.shutdown()
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    conn.send({
+        "origin": origin.stats,
+        "bot_api": bot.stats,
+        "cpu_seconds": cpu_seconds(usage),
+        "ffmpeg_cpu_seconds": cpu_seconds(children),
+        "peak_rss_mb": usage.ru_maxrss / 1024,
+    })
+
+
+def run_benchmark(args) -> dict:
+    if shutil.which("ffmpeg") is None:
+        raise SystemExit("benchmark.py needs ffmpeg on PATH")
+
+    conn, server_conn = multiprocessing.Pipe()
+    servers = multiprocessing.Process(target=serve, args=(args, server_conn), daemon=True)
+    servers.start()
+    m3u8_url, origin_port, api_base, segment_bytes = conn.recv()
+
+    mirrors = None
+    if args.mirror:
+        # the same origin under a second host name
+        mirrors = [f"http://localhost:{origin_port}"]
+
+    work_dir = tempfile.mkdtemp(prefix="m3u8bench_")
+    uploader = TelegramUploader(
+        "bench",
+        workers=args.upload_concurrency,
+        api_base=api_base,
+        per_chat_interval=0,
+        local_mode=args.local_mode,
+    )
+    processor = M3U8TSToTG(
+        m3u8_url=m3u8_url,
+        telegram_bot_token="bench",
+        telegram_chat_id="1",
+        work_dir=work_dir,
+        merge_group_size=args.merge_group_size,
+        download_concurrency=args.download_concurrency,
+        merge_mode=args.merge_mode,
+        uploader=uploader,
+        mirrors=mirrors,
+        hedge_quantile=args.hedge_quantile or None,
+    )
+
+    usage_before = resource.getrusage(resource.RUSAGE_SELF)
+    children_before = resource.getrusage(resource.RUSAGE_CHILDREN)
+    started = time.time()
+    try:
+        processor.run(timeout_hours=args.seconds / 3600)
+    finally:
+        uploader.stop()
+        elapsed = time.time() - started
+        conn.send("stop")
+        server_stats = conn.recv()
+        servers.join()
+        shutil.rmtree(work_dir, ignore_errors=True)
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    # the server process is a child too: take it (and its ffmpeg) back out
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    ffmpeg_cpu = (
+        cpu_seconds(children) - cpu_seconds(children_before)
+        - server_stats["cpu_seconds"] - server_stats["ffmpeg_cpu_seconds"]
+    )
+
+    snapshot = processor.metrics.snapshot()
+    segments = counter(snapshot, "segments_downloaded_total")
+    nbytes = counter(snapshot, "segment_bytes_total")
+    return {
+        "started": started,
+        "python": platform.python_version(),
+        "config": vars(args),
+        "served_segment_bytes": segment_bytes,
+        "results": {
+            "elapsed_seconds": elapsed,
+            "segments": segments,
+            "segments_per_second": segments / elapsed,
+            "mb_per_second": nbytes / elapsed / 1e6,
+            "segment_failures": counter(snapshot, "segment_download_failures_total"),
+            "hedged_requests": counter(snapshot, "hedged_requests_total"),
+            "hedge_wins": counter(snapshot, "hedge_wins_total"),
+            "mirror_failovers": counter(snapshot, "mirror_failovers_total"),
+            "merges": counter(snapshot, "merges_total"),
+            "merge_failures": counter(snapshot, "merge_failures_total"),
+            "uploads": counter(snapshot, "uploads_total"),
+            "upload_retries": counter(snapshot, "upload_retries_total"),
+            "cpu_seconds": cpu_seconds(usage) - cpu_seconds(usage_before),
+            "ffmpeg_cpu_seconds": ffmpeg_cpu,
+            "peak_rss_mb": usage.ru_maxrss / 1024,  # ru_maxrss is KiB on Linux
+            "playlist_fetch_seconds": histogram_summary(snapshot.get("playlist_fetch_seconds")),
+            "merge_seconds": histogram_summary(snapshot.get("merge_seconds")),
+            "upload_seconds": histogram_summary(snapshot.get("upload_seconds")),
+            "live_edge_latency_seconds": histogram_summary(
+                snapshot.get("live_edge_latency_seconds")
+            ),
+        },
+        "origin": server_stats.pop("origin"),
+        "bot_api": server_stats.pop("bot_api"),
+        "servers": server_stats,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--seconds", type=float, default=60, help="how long to record")
+    parser.add_argument("--segment-bytes", type=int, default=1_000_000)
+    parser.add_argument("--segment-duration", type=float, default=2.0)
+    parser.add_argument("--window", type=int, default=6, help="segments in the live playlist")
+    parser.add_argument("--jitter", type=float, default=0.0, help="max random delay per segment, s")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="share of segment 503s")
+    parser.add_argument("--slow-rate", type=float, default=0.0, help="share of slow segment responses")
+    parser.add_argument("--slow-delay", type=float, default=5.0)
+    parser.add_argument("--rate-429", type=float, default=0.0, help="share of uploads answered 429")
+    parser.add_argument("--retry-after", type=int, default=1)
+    parser.add_argument("--mirror", action="store_true", help="serve the origin as a mirror too")
+    parser.add_argument("--hedge-quantile", type=float, default=0.9, help="0 disables hedging")
+    parser.add_argument("--merge-group-size", type=int, default=5)
+    parser.add_argument("--merge-mode", default="concat", choices=("concat", "stream"))
+    parser.add_argument("--download-concurrency", type=int, default=4)
+    parser.add_argument("--upload-concurrency", type=int, default=2)
+    parser.add_argument("--local-mode", action="store_true",
+                        help="upload file:// paths as to a --local Bot API server")
+    parser.add_argument("--output", help="also write the JSON results here")
+    args = parser.parse_args()
+
+    result = run_benchmark(args)
+    text = json.dumps(result, indent=2)
+    print(text)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(text + "\n")
+
+
+if __name__ == "__main__":
+    main()
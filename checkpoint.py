@@ -0,0 +1,127 @@
+import json
+import os
+import threading
+import time
+
+from hls_playlist import Segment
+
+# Segment fields worth keeping for a segment that waits on disk to be merged
+SEGMENT_FIELDS = (
+    "sequence",
+    "path",
+    "size",
+    "duration",
+    "discontinuity",
+    "keyframe",
+    "program_date_time",
+)
+
+
+class Checkpoint:
+    """
+    Pipeline state of one stream, saved so a restarted process resumes at
+    the exact segment.
+
+    The file (`checkpoint.json` in the work dir) holds the stream URL, the
+    media sequence after the last segment handed to the merger, the
+    downloaded segments still waiting to be merged, in order, and the merged
+    MP4s still waiting for upload, in upload order. It is small and rewritten
+    whole: to a temp file, fsynced, then swapped in with os.replace, so a
+    crash leaves either the old or the new checkpoint.
+
+    Segments published between two saves go to a journal next to it
+    (`checkpoint.json.journal`, a JSON line each), so they come back with
+    their media sequence too. Every save() drops the lines it covers.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.journal_path = path + ".journal"
+        self.lock = threading.Lock()
+        self.journal = None
+        self.journaled = []  # entries not yet covered by a saved checkpoint
+
+    def load(self):
+        """The saved state, or None when there is none (or it is unreadable)."""
+        if not os.path.exists(self.path):
+            return None
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                state = json.load(f)
+            pending = state["pending"]
+            newer = [
+                entry
+                for entry in self.read_journal()
+                if state["next_sequence"] is None or entry["sequence"] >= state["next_sequence"]
+            ]
+            if newer:
+                state["next_sequence"] = max(entry["sequence"] for entry in newer) + 1
+            state["pending"] = [Segment(url="", **entry) for entry in pending + newer]
+            return state
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            print(f"⚠️ Ignoring unreadable {self.path}: {e}")
+            return None
+
+    def read_journal(self):
+        """Journal entries in sequence order; a torn last line is skipped."""
+        entries = []
+        if not os.path.exists(self.journal_path):
+            return entries
+        with open(self.journal_path, "r", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    entries.append(json.loads(line))
+                except ValueError:
+                    continue
+        return sorted(entries, key=lambda entry: entry["sequence"])
+
+    def published(self, segment):
+        """Journal a segment handed to the merger, until the next save() covers it."""
+        if segment.sequence is None:
+            return
+        entry = {name: getattr(segment, name) for name in SEGMENT_FIELDS}
+        with self.lock:
+            if self.journal is None:
+                self.journal = open(self.journal_path, "a", encoding="utf-8")
+            self.journal.write(json.dumps(entry) + "\n")
+            self.journal.flush()
+            self.journaled.append(entry)
+
+    def save(self, m3u8_url, next_sequence, pending, uploads):
+        state = {
+            "saved_at": time.time(),
+            "m3u8_url": m3u8_url,
+            "next_sequence": next_sequence,
+            "pending": [
+                {name: getattr(segment, name) for name in SEGMENT_FIELDS}
+                for segment in pending
+            ],
+            "uploads": list(uploads),
+        }
+        tmp = self.path + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(state, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.path)
+        self.compact_journal(next_sequence)
+
+    def compact_journal(self, next_sequence):
+        """Keep only the journal lines the checkpoint does not cover yet."""
+        with self.lock:
+            if next_sequence is not None:
+                self.journaled = [e for e in self.journaled if e["sequence"] >= next_sequence]
+            if self.journal is not None:
+                self.journal.close()
+            tmp = self.journal_path + ".tmp"
+            with open(tmp, "w", encoding="utf-8") as f:
+                for entry in self.journaled:
+                    f.write(json.dumps(entry) + "\n")
+            os.replace(tmp, self.journal_path)
+            self.journal = open(self.journal_path, "a", encoding="utf-8")
+
+    def close(self):
+        with self.lock:
+            if self.journal is not None:
+                self.journal.close()
+                self.journal = None
@@ -46,5 +46,6 @@ if __name__ == "__main__":
         caption_prefix="kick",
         work_dir=".",
         merge_group_size=5,
+        merge_mode="stream",
     )
     m3u8_processor.run()
@@ -0,0 +1,357 @@
+import base64
+import threading
+from urllib.parse import unquote_to_bytes
+
+from ts_scanner import PACKET_SIZE, SYNC_BYTE, section
+
+try:
+    from Crypto.Cipher import AES  # pycryptodome, only needed for encrypted streams
+except ImportError:
+    AES = None
+
+
+def sequence_iv(sequence: int) -> bytes:
+    """Default IV when #EXT-X-KEY has none: the media sequence as 128-bit big endian."""
+    return sequence.to_bytes(16, "big")
+
+
+class KeyCache:
+    """
+    Fetches each #EXT-X-KEY URI once and keeps the key bytes.
+
+    `data:` URIs (base64 or percent-encoded) are decoded locally. Concurrent
+    download workers asking for the same key wait on one fetch.
+    """
+
+    def __init__(self, session):
+        self.session = session
+        self.keys = {}
+        self.lock = threading.Lock()
+        self.fetching = {}  # uri -> Event while a fetch is in flight
+
+    def get(self, uri: str) -> bytes:
+        with self.lock:
+            if uri in self.keys:
+                return self.keys[uri]
+            event = self.fetching.get(uri)
+            if event is None:
+                event = self.fetching[uri] = threading.Event()
+                owner = True
+            else:
+                owner = False
+
+        if not owner:
+            event.wait(30)
+            with self.lock:
+                if uri in self.keys:
+                    return self.keys[uri]
+            raise IOError(f"key fetch failed: {uri}")
+
+        try:
+            key = self.fetch(uri)
+            with self.lock:
+                self.keys[uri] = key
+            return key
+        finally:
+            with self.lock:
+                self.fetching.pop(uri, None)
+            event.set()
+
+    def fetch(self, uri: str) -> bytes:
+        if uri.startswith("data:"):
+            header, _, payload = uri[len("data:") :].partition(",")
+            if header.endswith(";base64"):
+                key = base64.b64decode(payload)
+            else:
+                key = unquote_to_bytes(payload)
+        else:
+            r = self.session.get(uri, timeout=10)
+            r.raise_for_status()
+            key = r.content
+        if len(key) != 16:
+            raise ValueError(f"AES-128 key must be 16 bytes, got {len(key)}")
+        return key
+
+
+class SegmentDecryptor:
+    """
+    Incremental AES-128-CBC decryption of one segment.
+
+    Ciphertext can be fed in chunks of any size. The last block is always
+    held back until finalize(), which strips the PKCS#7 padding.
+    """
+
+    def __init__(self, key: bytes, iv: bytes):
+        if AES is None:
+            raise RuntimeError(
+                "encrypted stream needs pycryptodome: pip install pycryptodome"
+            )
+        self.cipher = AES.new(key, AES.MODE_CBC, iv)
+        self.pending = b""
+
+    def update(self, data) -> bytes:
+        data = self.pending + bytes(data)
+        # decrypt whole blocks but keep at least one back for the padding
+        usable = (len(data) - 1) // 16 * 16 if data else 0
+        self.pending = data[usable:]
+        return self.cipher.decrypt(data[:usable]) if usable else b""
+
+    def finalize(self) -> bytes:
+        if len(self.pending) != 16:
+            raise ValueError("ciphertext is not a whole number of AES blocks")
+        plain = self.cipher.decrypt(self.pending)
+        pad = plain[-1]
+        if not 1 <= pad <= 16 or plain[-pad:] != bytes([pad]) * pad:
+            raise ValueError("bad PKCS#7 padding (wrong key or IV?)")
+        return plain[:-pad]
+
+
+class UnsupportedEncryption(ValueError):
+    """Segments encrypted in a way this module cannot undo (DRM key formats, AC-3, ...)."""
+
+
+# SAMPLE-AES stream types in the PMT and the clear types they stand for
+SAMPLE_AES_STREAM_TYPES = {0xDB: 0x1B, 0xCF: 0x0F}  # H.264, AAC in ADTS
+UNSUPPORTED_SAMPLE_AES_TYPES = {0xC1: "AC-3", 0xC2: "E-AC-3"}
+H264_TYPE, AAC_TYPE = 0xDB, 0xCF
+
+
+def crc32_mpeg2(data) -> int:
+    """The CRC32 that closes every PSI section (MPEG-2, not zlib's)."""
+    crc = 0xFFFFFFFF
+    for byte in data:
+        crc ^= byte << 24
+        for _ in range(8):
+            crc = ((crc << 1) ^ 0x04C11DB7) if crc & 0x80000000 else crc << 1
+        crc &= 0xFFFFFFFF
+    return crc
+
+
+def remove_emulation_prevention(nal) -> bytearray:
+    """Drop the 0x03 of every 00 00 03 that has a byte after it (H.264 7.4.1)."""
+    out = bytearray()
+    i = 0
+    while True:
+        j = nal.find(b"\x00\x00\x03", i)
+        if j == -1 or len(nal) - j <= 3:
+            out += nal[i:]
+            return out
+        out += nal[i : j + 2]
+        i = j + 3
+
+
+def pad_adaptation_field(af: bytes, extra: int) -> bytes:
+    """Grow an adaptation field (its length byte included) by `extra` stuffing bytes."""
+    if not af:
+        if extra == 1:
+            return b"\x00"
+        return bytes([extra - 1, 0x00]) + b"\xff" * (extra - 2)
+    if af[0] == 0:
+        return bytes([extra]) + b"\x00" + b"\xff" * (extra - 1)
+    return bytes([af[0] + extra]) + af[1:] + b"\xff" * extra
+
+
+class SampleAESDecryptor:
+    """
+    SAMPLE-AES decryption of one MPEG-TS segment.
+
+    SAMPLE-AES leaves TS packets and PES headers in the clear and encrypts
+    only parts of the samples, each in AES-128-CBC starting over from the
+    IV: in H.264 slice NAL units longer than 48 bytes, one 16-byte block in
+    every ten after a 32-byte clear leader (with start code emulation
+    prevention applied on top), and in AAC ADTS frames every whole block
+    after the header and a 16-byte leader. Undoing it needs whole PES
+    packets, so update() only collects the segment; finalize() decrypts it,
+    repacketizes the video PES packets that got shorter, and marks the
+    streams as plain H.264/AAC in the PMT so ffmpeg reads them as such.
+    """
+
+    def __init__(self, key: bytes, iv: bytes):
+        if AES is None:
+            raise RuntimeError(
+                "encrypted stream needs pycryptodome: pip install pycryptodome"
+            )
+        self.key = key
+        self.iv = iv
+        self.chunks = []
+
+    def update(self, data) -> bytes:
+        self.chunks.append(bytes(data))
+        return b""
+
+    def finalize(self) -> bytes:
+        return self.decrypt_ts(b"".join(self.chunks))
+
+    def decrypt_blocks(self, data: bytearray, spans):
+        """Decrypt the (start, end) block runs of data in place as one CBC chain."""
+        if not spans:
+            return
+        cipher = AES.new(self.key, AES.MODE_CBC, self.iv)
+        plain = cipher.decrypt(b"".join(bytes(data[s:e]) for s, e in spans))
+        i = 0
+        for s, e in spans:
+            data[s:e] = plain[i : i + e - s]
+            i += e - s
+
+    def decrypt_nal(self, nal) -> bytes:
+        if len(nal) <= 48 or nal[0] & 0x1F not in (1, 5):
+            return nal
+        data = remove_emulation_prevention(nal)
+        spans = []
+        pos, remaining = 32, len(data) - 32
+        while remaining > 0:
+            if remaining > 16:
+                spans.append((pos, pos + 16))
+                pos += 16
+                remaining -= 16
+            skip = min(144, remaining)
+            pos += skip
+            remaining -= skip
+        self.decrypt_blocks(data, spans)
+        return bytes(data)
+
+    def decrypt_h264(self, body: bytes) -> bytes:
+        """Decrypt the slice NAL units of an Annex B PES payload."""
+        out = bytearray()
+        copied = 0
+        start = body.find(b"\x00\x00\x01")
+        while start != -1:
+            nal_start = start + 3
+            following = body.find(b"\x00\x00\x01", nal_start)
+            nal_end = len(body) if following == -1 else following
+            # zero bytes before the next start code are not part of this NAL
+            while nal_end > nal_start and body[nal_end - 1] == 0:
+                nal_end -= 1
+            out += body[copied:nal_start]
+            out += self.decrypt_nal(body[nal_start:nal_end])
+            copied = nal_end
+            start = following
+        out += body[copied:]
+        return bytes(out)
+
+    def decrypt_adts(self, body: bytes) -> bytes:
+        """Decrypt the AAC frames of an ADTS PES payload; sizes do not change."""
+        data = bytearray(body)
+        i = 0
+        while i + 7 <= len(data) and data[i] == 0xFF and data[i + 1] & 0xF0 == 0xF0:
+            header = 7 if data[i + 1] & 0x01 else 9
+            length = ((data[i + 3] & 0x03) << 11) | (data[i + 4] << 3) | (data[i + 5] >> 5)
+            if length < header or i + length > len(data):
+                break
+            leader = i + header + 16
+            blocks = (i + length - leader) // 16
+            if blocks > 0:
+                self.decrypt_blocks(data, [(leader, leader + 16 * blocks)])
+            i += length
+        return bytes(data)
+
+    def decrypt_pes(self, pes: bytes, stream_type: int) -> bytes:
+        if len(pes) < 9 or pes[:3] != b"\x00\x00\x01":
+            return pes
+        header_length = 9 + pes[8]
+        header = bytearray(pes[:header_length])
+        body = pes[header_length:]
+        if stream_type == H264_TYPE:
+            body = self.decrypt_h264(body)
+        else:
+            body = self.decrypt_adts(body)
+        if header[4] or header[5]:
+            length = len(header) - 6 + len(body)
+            if length > 0xFFFF:
+                length = 0  # allowed for video: "unbounded"
+            header[4], header[5] = length >> 8, length & 0xFF
+        return bytes(header) + body
+
+    def rewrite_pmt(self, packet: bytearray, start: int, stream_types: dict):
+        """Record the PMT's streams and rename the SAMPLE-AES types to the clear ones."""
+        sec = section(packet, start, PACKET_SIZE)
+        if not sec or packet[sec[0]] != 0x02:
+            return
+        s, end = sec
+        j = s + 12 + (((packet[s + 10] & 0x0F) << 8) | packet[s + 11])
+        while j + 5 <= end:
+            es_pid = ((packet[j + 1] & 0x1F) << 8) | packet[j + 2]
+            stream_type = packet[j]
+            if stream_type in UNSUPPORTED_SAMPLE_AES_TYPES:
+                raise UnsupportedEncryption(
+                    f"SAMPLE-AES {UNSUPPORTED_SAMPLE_AES_TYPES[stream_type]} audio is not supported"
+                )
+            if stream_type in SAMPLE_AES_STREAM_TYPES:
+                stream_types[es_pid] = stream_type
+                packet[j] = SAMPLE_AES_STREAM_TYPES[stream_type]
+            j += 5 + (((packet[j + 3] & 0x0F) << 8) | packet[j + 4])
+        if end + 4 <= PACKET_SIZE:
+            packet[end : end + 4] = crc32_mpeg2(packet[s:end]).to_bytes(4, "big")
+
+    def decrypt_ts(self, data: bytes) -> bytes:
+        if len(data) % PACKET_SIZE or (data and data[0] != SYNC_BYTE):
+            raise ValueError("SAMPLE-AES segment is not packet-aligned MPEG-TS")
+        pmt_pids = set()
+        stream_types = {}  # encrypted pid -> SAMPLE-AES stream type
+        items = []  # packets, and [pid, cc, adaptation field, PES bytes] for rebuilt PES
+        current = {}  # pid -> the PES item being collected
+        for i in range(0, len(data), PACKET_SIZE):
+            packet = bytearray(data[i : i + PACKET_SIZE])
+            pusi = packet[1] & 0x40
+            pid = ((packet[1] & 0x1F) << 8) | packet[2]
+            afc = (packet[3] >> 4) & 0x03
+            cc = packet[3] & 0x0F
+            start = 4
+            if afc & 0x02:
+                start += 1 + packet[4]
+            if pid == 0 and pusi:
+                sec = section(packet, start, PACKET_SIZE)
+                if sec and packet[sec[0]] == 0x00:
+                    for j in range(sec[0] + 8, sec[1] - 3, 4):
+                        if (packet[j] << 8) | packet[j + 1]:
+                            pmt_pids.add(((packet[j + 2] & 0x1F) << 8) | packet[j + 3])
+            elif pid in pmt_pids and pusi:
+                self.rewrite_pmt(packet, start, stream_types)
+            elif pid in stream_types:
+                af = bytes(packet[4:start]) if afc & 0x02 else b""
+                if pusi and afc & 0x01:
+                    current[pid] = [pid, cc, af, bytearray(packet[start:])]
+                    items.append(current[pid])
+                    continue
+                if pid in current:
+                    if af and len(af) > 1 and af[1] & 0x10:
+                        # a PCR in mid-PES keeps its place as an adaptation-only packet
+                        items.append([pid, cc, af, None])
+                    if afc & 0x01:
+                        current[pid][3] += packet[start:]
+                    continue
+            items.append(packet)
+
+        out = bytearray()
+        counters = {}
+        for item in items:
+            if isinstance(item, bytearray):
+                pid = ((item[1] & 0x1F) << 8) | item[2]
+                if pid in stream_types and item[3] & 0x10:
+                    counters[pid] = item[3] & 0x0F
+                out += item
+                continue
+            pid, cc, af, pes = item
+            # rebuilt packets are renumbered from the first one's counter
+            counters.setdefault(pid, (cc - 1) & 0x0F)
+            if pes is None:
+                af = pad_adaptation_field(af, 184 - len(af))
+                cc = counters[pid]
+                out += bytes([SYNC_BYTE, pid >> 8, pid & 0xFF, 0x20 | cc]) + af
+                continue
+            pes = self.decrypt_pes(bytes(pes), stream_types[pid])
+            pos, first = 0, True
+            while first or pos < len(pes):
+                head = af if first else b""
+                room = PACKET_SIZE - 4 - len(head)
+                chunk = pes[pos : pos + room]
+                pos += len(chunk)
+                if len(chunk) < room:
+                    head = pad_adaptation_field(head, room - len(chunk))
+                cc = (counters[pid] + 1) & 0x0F
+                counters[pid] = cc
+                flags = 0x10 | (0x20 if head else 0) | cc
+                out += bytes([SYNC_BYTE, (0x40 if first else 0) | (pid >> 8), pid & 0xFF, flags])
+                out += head + chunk
+                first = False
+        return bytes(out)
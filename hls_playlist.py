@@ -0,0 +1,324 @@
+import re
+from dataclasses import dataclass, field, replace
+from datetime import datetime, timedelta, timezone
+from typing import Dict, List, Optional, Tuple
+from urllib.parse import urljoin
+
+ATTRIBUTE_RE = re.compile(r'([A-Z0-9-]+)=("[^"]*"|[^,]*)')
+DIGITS_RE = re.compile(r"\d+")
+DATE_TIME_RE = re.compile(
+    r"(\d{4}-\d\d-\d\dT\d\d:\d\d:\d\d)(?:\.(\d+))?(Z|[+-]\d\d:?\d\d)?$", re.I
+)
+
+
+def parse_attributes(text: str) -> Dict[str, str]:
+    """Parse an HLS attribute list (KEY=value,KEY="quoted, value",...)."""
+    return {
+        name: value[1:-1] if value.startswith('"') else value
+        for name, value in ATTRIBUTE_RE.findall(text)
+    }
+
+
+def parse_date_time(text: str) -> float:
+    """ISO 8601 date from #EXT-X-PROGRAM-DATE-TIME as a Unix timestamp."""
+    m = DATE_TIME_RE.match(text.strip())
+    if not m:
+        raise ValueError(f"bad PROGRAM-DATE-TIME: {text}")
+    base, fraction, zone = m.groups()
+    tz = timezone.utc
+    if zone and zone.upper() != "Z":
+        sign = -1 if zone[0] == "-" else 1
+        digits = zone[1:].replace(":", "")
+        tz = timezone(sign * timedelta(hours=int(digits[:2]), minutes=int(digits[2:])))
+    stamp = datetime.strptime(base, "%Y-%m-%dT%H:%M:%S").replace(tzinfo=tz).timestamp()
+    return stamp + (float("0." + fraction) if fraction else 0.0)
+
+
+@dataclass
+class Key:
+    """Encryption in effect for a segment, from #EXT-X-KEY."""
+
+    method: str
+    uri: Optional[str] = None
+    iv: Optional[bytes] = None
+    keyformat: str = "identity"
+
+
+@dataclass
+class Segment:
+    """A media segment as listed in the playlist."""
+
+    sequence: Optional[int]
+    url: str
+    duration: float = 0.0  # from #EXTINF
+    key: Optional[Key] = None  # None when the segment is not encrypted
+    discontinuity: bool = False  # never merge across this segment's start
+    byterange: Optional[Tuple[int, int]] = None  # (length, offset) from #EXT-X-BYTERANGE
+    program_date_time: Optional[float] = None  # wall clock of its first frame, Unix time
+    # filled in once the segment has been downloaded
+    path: Optional[str] = None
+    size: int = 0
+    keyframe: Optional[bool] = None  # opens on a random access point (None: unknown)
+    pts_range: Optional[Tuple[float, float]] = None  # first and last PTS, seconds
+
+
+@dataclass
+class Variant:
+    """One rendition of a master playlist, from #EXT-X-STREAM-INF."""
+
+    url: str
+    bandwidth: int = 0
+    width: Optional[int] = None
+    height: Optional[int] = None
+    codecs: Optional[str] = None
+
+
+@dataclass
+class MediaPlaylist:
+    """Header values and segments of one media playlist fetch."""
+
+    media_sequence: int = 0
+    target_duration: Optional[float] = None
+    segments: List[Segment] = field(default_factory=list)
+    ended: bool = False  # #EXT-X-ENDLIST: no more segments will be added
+
+
+@dataclass
+class ParseState:
+    """Tags in effect for the next segment while walking a media playlist."""
+
+    sequence: int = 0
+    duration: float = 0.0
+    key: Optional[Key] = None
+    byterange: Optional[Tuple[int, Optional[int]]] = None
+    date_time: Optional[float] = None  # carried forward by #EXTINF
+    discontinuity: bool = False
+    key_tags: int = 0  # #EXT-X-KEY tags since the last segment
+    range_ends: Dict[str, int] = field(default_factory=dict)  # url -> end of last sub-range
+
+
+class MediaPlaylistParser:
+    """
+    Incremental parser for one media playlist URL.
+
+    Every segment is numbered from #EXT-X-MEDIA-SEQUENCE (0 when the tag is
+    missing, as the HLS spec says), so the same segment keeps the same number
+    across polls no matter how the live window slides. A live playlist only
+    drops segments at the top and appends at the bottom, so on a refresh the
+    URI lines of segments seen before are counted but not parsed; parsing
+    resumes after the last known segment with the tag state it had there.
+    Segments of earlier polls still in the window are returned as the same
+    Segment objects. When the window no longer overlaps the previous one, or
+    the media sequence went backwards, the playlist is parsed from scratch.
+    """
+
+    def __init__(self, playlist_url: str):
+        self.playlist_url = playlist_url
+        self.media_sequence = None
+        self.segments = {}  # sequence -> Segment still in the window
+        self.state = None  # ParseState right after the last known segment
+
+    def parse(self, text: str) -> MediaPlaylist:
+        lines = text.splitlines()
+        playlist = MediaPlaylist()
+
+        # header tags sit above the first segment URI
+        for line in lines:
+            if line.startswith("#EXT-X-MEDIA-SEQUENCE:"):
+                playlist.media_sequence = int(line.split(":", 1)[1])
+            elif line.startswith("#EXT-X-TARGETDURATION:"):
+                playlist.target_duration = float(line.split(":", 1)[1])
+            elif line.strip() and not line.startswith("#"):
+                break
+
+        first = playlist.media_sequence
+        start = None
+        if self.state is not None and self.media_sequence <= first < self.state.sequence:
+            start = self.resume_index(lines, self.state.sequence - first)
+        if start is not None:
+            state = replace(self.state, range_ends=dict(self.state.range_ends))
+            playlist.segments = [self.segments[n] for n in range(first, state.sequence)]
+            self.segments = {n: s for n, s in self.segments.items() if n >= first}
+        else:
+            state = ParseState(sequence=first)
+            start = 0
+            self.segments = {}
+            self.state = None
+
+        for line in lines[start:]:
+            line = line.strip()
+            if not line:
+                continue
+            if not line.startswith("#"):
+                segment = self.add_segment(state, line)
+                playlist.segments.append(segment)
+                self.segments[segment.sequence] = segment
+                self.state = replace(state, range_ends=dict(state.range_ends))
+            else:
+                self.parse_tag(state, playlist, line)
+
+        self.media_sequence = first
+        return playlist
+
+    @staticmethod
+    def resume_index(lines, known: int):
+        """Index of the line after the `known`-th segment URI, or None if there are fewer."""
+        for i, line in enumerate(lines):
+            if line.strip() and not line.startswith("#"):
+                known -= 1
+                if not known:
+                    return i + 1
+        return None
+
+    def parse_tag(self, state: ParseState, playlist: MediaPlaylist, line: str):
+        if line.startswith("#EXTINF:"):
+            state.duration = float(line[len("#EXTINF:") :].split(",", 1)[0])
+        elif line.startswith("#EXT-X-BYTERANGE:"):
+            length, _, offset = line[len("#EXT-X-BYTERANGE:") :].partition("@")
+            state.byterange = (int(length), int(offset) if offset else None)
+        elif line == "#EXT-X-DISCONTINUITY":
+            state.discontinuity = True
+        elif line.startswith("#EXT-X-PROGRAM-DATE-TIME:"):
+            try:
+                state.date_time = parse_date_time(line.split(":", 1)[1])
+            except ValueError:
+                state.date_time = None
+        elif line.startswith("#EXT-X-KEY:"):
+            attrs = parse_attributes(line[len("#EXT-X-KEY:") :])
+            method = attrs.get("METHOD", "NONE")
+            if method == "NONE":
+                state.key = None
+            else:
+                uri = attrs.get("URI")
+                if uri:
+                    uri = urljoin(self.playlist_url, uri)
+                iv = attrs.get("IV")
+                if iv:
+                    iv = bytes.fromhex(iv[2:] if iv.lower().startswith("0x") else iv)
+                key = Key(
+                    method=method,
+                    uri=uri,
+                    iv=iv or None,
+                    keyformat=attrs.get("KEYFORMAT", "identity"),
+                )
+                # a tag per KEYFORMAT may list a DRM key next to the identity
+                # one: keep the key we can use
+                keep_current = (
+                    state.key_tags
+                    and state.key is not None
+                    and state.key.keyformat == "identity"
+                )
+                if key.keyformat == "identity" or not keep_current:
+                    state.key = key
+                state.key_tags += 1
+        elif line == "#EXT-X-ENDLIST":
+            playlist.ended = True
+
+    def add_segment(self, state: ParseState, uri: str) -> Segment:
+        """Build the segment for a URI line and reset the per-segment tags."""
+        url = urljoin(self.playlist_url, uri)
+        byterange = state.byterange
+        if byterange is not None:
+            length, offset = byterange
+            if offset is None:
+                # no @offset: the range starts where the previous one of this resource ended
+                offset = state.range_ends.get(url, 0)
+            byterange = (length, offset)
+            state.range_ends[url] = offset + length
+        segment = Segment(
+            sequence=state.sequence,
+            url=url,
+            duration=state.duration,
+            key=state.key,
+            discontinuity=state.discontinuity,
+            byterange=byterange,
+            program_date_time=state.date_time,
+        )
+        state.sequence += 1
+        if state.date_time is not None:
+            state.date_time += state.duration
+        state.duration = 0.0
+        state.byterange = None
+        state.discontinuity = False
+        state.key_tags = 0
+        return segment
+
+
+def parse_media_playlist(text: str, playlist_url: str) -> MediaPlaylist:
+    """Parse a whole media playlist (see MediaPlaylistParser)."""
+    return MediaPlaylistParser(playlist_url).parse(text)
+
+
+def guess_segment_url(known, sequence: int) -> Optional[str]:
+    """
+    Predict the URL of segment `sequence` from (sequence, url) pairs of other
+    segments, for URIs that carry the media sequence plus a constant
+    (seg1234.ts, 00123.ts, chunk_1699999000_1234.ts). Returns None unless the
+    URLs agree on everything but one number that moves with the sequence.
+    """
+    examples = []
+    for known_sequence, url in known:
+        if known_sequence is None or not url:
+            continue
+        examples.append((known_sequence, DIGITS_RE.split(url), DIGITS_RE.findall(url)))
+    if len({known_sequence for known_sequence, _, _ in examples}) < 2:
+        return None
+    _, text, numbers = examples[0]
+    if any(other != text for _, other, _ in examples):
+        return None
+    # the last number is the likeliest, e.g. a counter after a date in the path
+    for i in reversed(range(len(numbers))):
+        others_fixed = all(
+            nums[:i] + nums[i + 1 :] == numbers[:i] + numbers[i + 1 :]
+            for _, _, nums in examples
+        )
+        offsets = {int(nums[i]) - known_sequence for known_sequence, _, nums in examples}
+        if not others_fixed or len(offsets) != 1:
+            continue
+        value = sequence + offsets.pop()
+        if value < 0:
+            return None
+        widths = {len(nums[i]) for _, _, nums in examples}
+        padded = any(nums[i].startswith("0") and len(nums[i]) > 1 for _, _, nums in examples)
+        width = widths.pop() if padded and len(widths) == 1 else 0
+        parts = list(numbers)
+        parts[i] = str(value).zfill(width)
+        return "".join(t + n for t, n in zip(text, parts + [""]))
+    return None
+
+
+def is_master_playlist(text: str) -> bool:
+    return "#EXT-X-STREAM-INF:" in text
+
+
+def parse_master_playlist(text: str, playlist_url: str) -> List[Variant]:
+    """Parse the variants of a master playlist, sorted by ascending bandwidth."""
+    variants = []
+    attrs = None
+
+    for line in text.splitlines():
+        line = line.strip()
+        if not line:
+            continue
+        if line.startswith("#EXT-X-STREAM-INF:"):
+            attrs = parse_attributes(line[len("#EXT-X-STREAM-INF:") :])
+        elif line.startswith("#"):
+            continue
+        elif attrs is not None:
+            url = urljoin(playlist_url, line)
+            width = height = None
+            if "x" in attrs.get("RESOLUTION", ""):
+                width, height = (int(v) for v in attrs["RESOLUTION"].split("x", 1))
+            variants.append(
+                Variant(
+                    url=url,
+                    bandwidth=int(attrs.get("AVERAGE-BANDWIDTH") or attrs.get("BANDWIDTH") or 0),
+                    width=width,
+                    height=height,
+                    codecs=attrs.get("CODECS"),
+                )
+            )
+            attrs = None
+
+    variants.sort(key=lambda v: v.bandwidth)
+    return variants
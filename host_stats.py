@@ -0,0 +1,71 @@
+import collections
+import threading
+from typing import Optional
+from urllib.parse import urlparse, urlunparse
+
+
+def host_of(url: str) -> str:
+    return urlparse(url).netloc
+
+
+def mirror_url(url: str, mirror: str) -> str:
+    """
+    The same resource on a mirror: `mirror` is a base like
+    "https://edge2.example.com" whose scheme and host replace the URL's,
+    keeping its path and query.
+    """
+    parsed = urlparse(url)
+    base = urlparse(mirror if "//" in mirror else "//" + mirror)
+    return urlunparse(parsed._replace(scheme=base.scheme or parsed.scheme, netloc=base.netloc))
+
+
+class HostStats:
+    """
+    Recent segment fetch times and failures per host.
+
+    Keeps the last `window` successful fetch durations of every host and an
+    exponentially weighted failure rate. quantile() gives the hedging
+    deadline, rank() orders a segment's URLs (origin and mirrors) fastest and
+    most reliable host first. Hosts without timings keep their given order
+    behind the timed ones; hedges and failovers are what gets them timed.
+    """
+
+    def __init__(self, window=50, min_samples=10, error_weight=0.2):
+        self.window = window
+        self.min_samples = min_samples
+        self.error_weight = error_weight
+        self.lock = threading.Lock()
+        self.samples = {}  # host -> deque of fetch seconds
+        self.error_rate = {}  # host -> EWMA of failed fetches (0..1)
+
+    def observe(self, host: str, seconds: Optional[float] = None, ok: bool = True):
+        """Record one fetch; `seconds` only for a complete segment fetch."""
+        with self.lock:
+            rate = self.error_rate.get(host, 0.0)
+            self.error_rate[host] = rate + self.error_weight * ((0.0 if ok else 1.0) - rate)
+            if ok and seconds is not None:
+                samples = self.samples.get(host)
+                if samples is None:
+                    samples = self.samples[host] = collections.deque(maxlen=self.window)
+                samples.append(seconds)
+
+    def quantile(self, host: str, q: float) -> Optional[float]:
+        """The q-quantile of the host's recent fetch times; None until min_samples."""
+        with self.lock:
+            samples = sorted(self.samples.get(host, ()))
+        if len(samples) < self.min_samples:
+            return None
+        return samples[min(len(samples) - 1, int(q * len(samples)))]
+
+    def score(self, host: str) -> float:
+        """Median fetch time, inflated by the failure rate; lower is better."""
+        with self.lock:
+            samples = sorted(self.samples.get(host, ()))
+            rate = self.error_rate.get(host, 0.0)
+        if not samples:
+            return float("inf")
+        return samples[len(samples) // 2] * (1 + 4 * rate)
+
+    def rank(self, urls):
+        """urls sorted best host first (stable, so untimed hosts keep their order)."""
+        return sorted(urls, key=lambda url: self.score(host_of(url)))
@@ -0,0 +1,142 @@
+import csv
+import json
+import os
+import subprocess
+
+
+class IncrementalSegmenter:
+    """
+    Splits a growing media file into MP4 chunks without redoing old work.
+
+    Each pass runs `ffmpeg -f segment` from where the previous pass stopped
+    instead of from the start of the file. ffmpeg writes a CSV segment list;
+    every chunk except the last one of a pass is finished, so the segmenter
+    moves its start number and its input offset (the summed durations of the
+    finished chunks) past them. The next pass seeks there with -ss, which lands
+    on the keyframe that opened the next chunk, and rewrites only the chunk
+    that was still growing. State is kept in a small JSON file so a restarted
+    script carries on where it stopped.
+    """
+
+    def __init__(
+        self,
+        input_file,
+        output_pattern="output%08d.mp4",
+        segment_time=10,
+        input_args=(),
+        output_args=(),
+        state_file=None,
+    ):
+        self.input_file = input_file
+        self.output_pattern = output_pattern
+        self.segment_time = segment_time
+        self.input_args = list(input_args)
+        self.output_args = list(output_args)
+        self.state_file = state_file or f"{input_file}.segments.json"
+        self.list_file = self.state_file + ".csv"
+
+        self.next_index = 0  # number of the first chunk this pass writes
+        self.offset = 0.0  # seconds of input already in finished chunks
+        self.input_size = 0  # input size at the last pass, to notice restarts
+        self.load_state()
+
+    def load_state(self):
+        if not os.path.exists(self.state_file):
+            return
+        try:
+            with open(self.state_file, "r", encoding="utf-8") as f:
+                state = json.load(f)
+            self.next_index = state["next_index"]
+            self.offset = state["offset"]
+            self.input_size = state.get("input_size", 0)
+        except (OSError, ValueError, KeyError) as e:
+            print(f"⚠️ Ignoring unreadable {self.state_file}: {e}")
+
+    def save_state(self):
+        tmp = self.state_file + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(
+                {
+                    "next_index": self.next_index,
+                    "offset": self.offset,
+                    "input_size": self.input_size,
+                },
+                f,
+            )
+        os.replace(tmp, self.state_file)
+
+    def command(self):
+        cmd = ["ffmpeg", "-y", *self.input_args]
+        if self.offset > 0:
+            # a hair past the boundary so rounding never picks the keyframe before it
+            cmd += ["-ss", f"{self.offset + 0.01:.3f}"]
+        cmd += [
+            "-i",
+            self.input_file,
+            *self.output_args,
+            "-c",
+            "copy",
+            "-segment_time",
+            str(self.segment_time),
+            "-f",
+            "segment",
+            "-reset_timestamps",
+            "1",
+            "-segment_start_number",
+            str(self.next_index),
+            "-segment_list",
+            self.list_file,
+            "-segment_list_type",
+            "csv",
+            self.output_pattern,
+        ]
+        return cmd
+
+    def run(self) -> bool:
+        """Segment whatever was appended since the last pass. Returns False on error."""
+        try:
+            size = os.path.getsize(self.input_file)
+        except OSError:
+            size = 0
+        if size < self.input_size:
+            # the recorder started a new file: segment it from the top, but keep
+            # numbering after the chunks we already produced
+            print(f"🔁 {self.input_file} shrank, segmenting it from the start")
+            self.offset = 0.0
+            if os.path.exists(self.output_pattern % self.next_index):
+                # the old file's last chunk holds its tail: keep it
+                self.next_index += 1
+        self.input_size = size
+
+        try:
+            subprocess.run(
+                self.command(),
+                stdout=subprocess.DEVNULL,
+                stderr=subprocess.PIPE,
+                check=True,
+            )
+        except subprocess.CalledProcessError as e:
+            print("FFmpeg error output:")
+            print(e.stderr.decode(errors="ignore"))
+            return False
+
+        rows = self.read_segment_list()
+        # the last chunk runs up to the current end of the growing file
+        finished = rows[:-1]
+        if finished:
+            self.next_index += len(finished)
+            self.offset += sum(end - start for start, end in finished)
+        self.save_state()
+        return True
+
+    def read_segment_list(self):
+        """(start, end) times of the chunks written by the last pass."""
+        rows = []
+        try:
+            with open(self.list_file, "r", encoding="utf-8", newline="") as f:
+                for row in csv.reader(f):
+                    if len(row) >= 3:
+                        rows.append((float(row[1]), float(row[2])))
+        except (OSError, ValueError) as e:
+            print(f"⚠️ Could not read segment list {self.list_file}: {e}")
+        return rows
@@ -1,11 +1,282 @@
 import os
+import collections
+import io
 import json
 import time
 import requests
 import subprocess
 import hashlib
 import threading
+import queue
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from concurrent.futures import TimeoutError as FuturesTimeout
 from urllib.parse import urlparse, unquote
+from requests.adapters import HTTPAdapter
+from hls_playlist import (
+    Segment,
+    MediaPlaylistParser,
+    guess_segment_url,
+    is_master_playlist,
+    parse_master_playlist,
+)
+from stream_remuxer import StreamRemuxer
+from telegram_uploader import TelegramUploader
+from sent_ledger import SentLedger
+from hls_crypto import (
+    KeyCache,
+    SampleAESDecryptor,
+    SegmentDecryptor,
+    UnsupportedEncryption,
+    sequence_iv,
+)
+from ts_scanner import scan_file
+from metrics import Metrics
+from checkpoint import Checkpoint
+from host_stats import HostStats, host_of, mirror_url
+
+# segment bytes go to disk as served: no transfer compression to undo
+SEGMENT_HEADERS = {"Accept-Encoding": "identity"}
+
+
+def make_session(pool_connections=4, pool_maxsize=4) -> requests.Session:
+    """Create a pooled HTTP session that reuses connections per host."""
+    session = requests.Session()
+    # pool_block makes urllib3 wait for a free connection instead of opening
+    # more than pool_maxsize sockets to the same CDN edge
+    adapter = HTTPAdapter(
+        pool_connections=pool_connections,
+        pool_maxsize=pool_maxsize,
+        pool_block=True,
+    )
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+class BandwidthLimiter:
+    """
+    Token bucket shared by every download worker that is handed it.
+
+    consume() blocks until the bytes fit under `rate` bytes/s, with bursts of
+    up to one second's worth.
+    """
+
+    def __init__(self, rate):
+        self.rate = float(rate)
+        self.tokens = self.rate
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def consume(self, n: int):
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.rate, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= n
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0
+        if wait:
+            time.sleep(wait)
+
+
+class MemorySpool(io.BytesIO):
+    """A write-only file whose bytes land in spools[name] when it is closed."""
+
+    def __init__(self, spools: dict, name: str):
+        super().__init__()
+        self.spools = spools
+        self.name = name
+
+    def close(self):
+        if not self.closed:
+            self.spools[self.name] = self.getvalue()
+        super().close()
+
+
+class RenditionSelector:
+    """
+    Picks a rendition of a master playlist.
+
+    Variants above max_height / max_bandwidth are never chosen. "highest" and
+    "lowest" stick to one end of what is left. "adaptive" starts at the top
+    and, after every poll, compares the measured download throughput (an EWMA
+    of bytes/s over each poll's batch) with the rendition's bandwidth. It
+    steps down as soon as a batch took longer to fetch than it lasts, or
+    throughput drops below `down_margin` x the bandwidth. It steps back up
+    once throughput clears `up_margin` x the next rendition's bandwidth, and
+    no sooner than `up_cooldown` seconds after the last switch.
+    """
+
+    POLICIES = ("highest", "lowest", "adaptive")
+
+    def __init__(
+        self,
+        variants,
+        policy="highest",
+        max_height=None,
+        max_bandwidth=None,
+        down_margin=1.2,
+        up_margin=1.5,
+        up_cooldown=30,
+    ):
+        if policy not in self.POLICIES:
+            raise ValueError(f"unknown rendition_policy {policy!r}")
+        allowed = [
+            v
+            for v in variants
+            if (max_height is None or v.height is None or v.height <= max_height)
+            and (max_bandwidth is None or v.bandwidth <= max_bandwidth)
+        ]
+        self.variants = allowed or variants[:1]
+        self.policy = policy
+        self.down_margin = down_margin
+        self.up_margin = up_margin
+        self.up_cooldown = up_cooldown
+        self.index = 0 if policy == "lowest" else len(self.variants) - 1
+        self.throughput = None  # bits/s, EWMA
+        self.last_switch = time.monotonic()
+
+    @property
+    def current(self):
+        return self.variants[self.index]
+
+    def observe(self, nbytes: int, seconds: float, media_seconds: float) -> bool:
+        """Feed one poll's download batch; returns True if the rendition changed."""
+        if self.policy != "adaptive" or len(self.variants) < 2:
+            return False
+        if nbytes <= 0 or seconds <= 0:
+            return False
+        sample = nbytes * 8 / seconds
+        if self.throughput is None:
+            self.throughput = sample
+        else:
+            self.throughput = 0.7 * self.throughput + 0.3 * sample
+
+        behind = media_seconds > 0 and seconds > media_seconds
+        if self.index > 0 and (
+            behind or self.throughput < self.current.bandwidth * self.down_margin
+        ):
+            self.index -= 1
+        elif (
+            self.index < len(self.variants) - 1
+            and self.throughput > self.variants[self.index + 1].bandwidth * self.up_margin
+            and time.monotonic() - self.last_switch > self.up_cooldown
+        ):
+            self.index += 1
+        else:
+            return False
+        self.last_switch = time.monotonic()
+        return True
+
+
+class SegmentLedger:
+    """
+    Segments seen in the playlist, keyed by media sequence number.
+
+    Dedup and ordering lookups are O(1). Entries are dropped once their segment
+    has been merged and the MP4 it went into has been uploaded; every sequence
+    below `floor` is treated as done, so memory is bounded by the segments still
+    in flight instead of the length of the stream. A segment that finishes
+    while an older one still holds the floor down is kept in `done` until the
+    floor passes it, so the next poll does not fetch it again. Callers hold
+    their own lock.
+    """
+
+    def __init__(self):
+        self.files = {}  # sequence -> ts file path
+        self.sequences = {}  # ts file path -> sequence
+        self.claimed = set()  # sequences handed to a downloader
+        self.merged = {}  # mp4 basename -> sequences merged into it
+        self.done = set()  # finished sequences at or above floor
+        self.floor = None
+
+    def __len__(self):
+        return len(self.files)
+
+    def add(self, sequence: int, ts_file: str) -> bool:
+        """Record a playlist entry. Returns False if it is already known or done."""
+        if self.floor is not None and sequence < self.floor:
+            return False
+        if sequence in self.files or sequence in self.done:
+            return False
+        self.files[sequence] = ts_file
+        self.sequences[ts_file] = sequence
+        return True
+
+    def claim(self, sequence: int) -> bool:
+        """Reserve a segment for download. Returns False if already claimed."""
+        if sequence not in self.files or sequence in self.claimed:
+            return False
+        self.claimed.add(sequence)
+        return True
+
+    def release(self, sequence: int):
+        """Give up a claim after a failed download so the next poll retries it."""
+        self.claimed.discard(sequence)
+
+    def sequence_of(self, ts_file: str):
+        """Media sequence of a segment file, or None if it is not tracked."""
+        return self.sequences.get(ts_file)
+
+    def mark_merged(self, mp4_name: str, ts_files):
+        """Remember which segments went into an MP4."""
+        sequences = [self.sequences[f] for f in ts_files if f in self.sequences]
+        if sequences:
+            self.merged[os.path.basename(mp4_name)] = sequences
+
+    def mark_uploaded(self, mp4_name: str):
+        """Drop the segments of an uploaded MP4 and slide the window forward."""
+        sequences = self.merged.pop(os.path.basename(mp4_name), [])
+        for sequence in sequences:
+            self._drop(sequence)
+        if sequences:
+            self._advance_floor(max(sequences) + 1)
+
+    def retire(self, sequence: int):
+        """Drop a segment whose bytes were handed off without a file of its own."""
+        self._drop(sequence)
+        self._advance_floor(sequence + 1)
+
+    def expire_before(self, first_sequence: int):
+        """
+        Forget unclaimed entries that slid out of the live window; they can no
+        longer be fetched. Claimed ones stay until they are merged. Returns the
+        forgotten sequences: segments whose downloads failed for good.
+        """
+        stale = [
+            s for s in self.files if s < first_sequence and s not in self.claimed
+        ]
+        for sequence in stale:
+            self._drop(sequence)
+        if stale:
+            self._advance_floor(first_sequence)
+        return sorted(stale)
+
+    def reset(self):
+        """Forget everything, e.g. after the stream restarted its numbering."""
+        self.files.clear()
+        self.sequences.clear()
+        self.claimed.clear()
+        self.merged.clear()
+        self.done.clear()
+        self.floor = None
+
+    def _drop(self, sequence: int):
+        ts_file = self.files.pop(sequence, None)
+        if ts_file is not None:
+            self.sequences.pop(ts_file, None)
+        self.claimed.discard(sequence)
+        self.done.add(sequence)
+
+    def _advance_floor(self, candidate: int):
+        # never move past a segment that is still waiting to be merged/uploaded
+        if self.files:
+            candidate = min(candidate, min(self.files))
+        if self.floor is None or candidate > self.floor:
+            self.floor = candidate
+        # finished segments right above the floor no longer hold anything up
+        while self.floor in self.done and self.floor not in self.files:
+            self.floor += 1
+        self.done = {s for s in self.done if s >= self.floor}
 
 
 class M3U8TSToTG:
@@ -24,6 +295,31 @@ class M3U8TSToTG:
         caption_prefix="",
         work_dir=".",
         merge_group_size=15,
+        download_concurrency=4,
+        max_connections_per_host=None,
+        merge_mode="concat",
+        merge_target_duration=None,
+        merge_max_bytes="auto",
+        upload_concurrency=2,
+        chat_upload_concurrency=1,
+        uploader=None,
+        telegram_api_base="https://api.telegram.org",
+        telegram_local_mode=False,
+        session=None,
+        download_pool=None,
+        merge_pool=None,
+        bandwidth_limiter=None,
+        rendition_policy="highest",
+        max_height=None,
+        max_bandwidth=None,
+        metrics=None,
+        metrics_port=None,
+        disk_budget=None,
+        shed_policy="pause",
+        staging_dir=None,
+        mirrors=None,
+        hedge_quantile=0.9,
+        merge_workers=None,
     ):
         """
         Initialize M3U8TSToTG.
@@ -33,322 +329,1565 @@ class M3U8TSToTG:
             telegram_bot_token: Telegram bot token for sending files
             telegram_chat_id: Telegram channel/chat ID to send files to
             work_dir: Working directory for storing files (default: current directory)
+            download_concurrency: Number of .ts segments fetched in parallel
+            max_connections_per_host: Cap on open connections to a single host
+                (default: download_concurrency)
+            merge_mode: "concat" merges finished .ts groups with one ffmpeg per
+                group; "stream" pipes segments into a single long-lived ffmpeg
+                that cuts MP4 chunks of about merge_group_size segments
+            merge_target_duration: Group segments until their #EXTINF durations add
+                up to this many seconds instead of counting merge_group_size
+                segments (None keeps the count)
+            merge_max_bytes: Never let a group's segments add up to more than this
+                many bytes, so the MP4 stays under the Bot API upload limit
+                ("auto": 96% of the uploader's limit, i.e. 48 MiB on
+                api.telegram.org and about 1.9 GiB on a local server; None
+                disables the cap)
+            upload_concurrency: Upload worker threads when no uploader is given
+            chat_upload_concurrency: Uploads in flight to the one chat when no
+                uploader is given; above 1, neighbouring files may swap places
+                in the chat
+            uploader: A TelegramUploader to share with other instances (its
+                bot token, API server and mode are used instead of the
+                arguments here)
+            telegram_api_base: Bot API server when no uploader is given
+            telegram_local_mode: That server is a self-hosted one running with
+                --local on this disk; MP4s are sent as file:// paths
+            session, download_pool, merge_pool, bandwidth_limiter: Resources
+                shared between instances (see multi_channel.py); each one
+                not given is created for this instance alone
+            rendition_policy: For master playlists: "highest", "lowest" or
+                "adaptive" (follows measured download throughput)
+            max_height, max_bandwidth: Renditions above these are never picked
+            metrics: A Metrics registry to report into (shared between
+                instances; samples are labelled with the stream name)
+            metrics_port: Serve the metrics on 127.0.0.1:<port> while running
+            disk_budget: Cap in bytes on downloaded segments plus merged but
+                unsent MP4s (None: unlimited)
+            shed_policy: What happens at the cap: "pause" stops downloading
+                until uploads free space (whatever slides out of the live
+                window meanwhile is skipped); "drop_oldest" keeps up with the
+                live edge and deletes the oldest unsent MP4, then the oldest
+                unmerged segment, until back under the cap
+            staging_dir: Where segments are downloaded to before merging, e.g.
+                a directory in /dev/shm; MP4s stay in work_dir
+            mirrors: Other hosts serving the same segment paths, as base URLs
+                ("https://edge2.example.com"); retries fail over to them and
+                the host with the best recent fetch times is tried first
+            hedge_quantile: A segment fetch still running after this quantile of
+                its host's recent fetch times (its #EXTINF duration until
+                enough are known) gets a second request, to the next best
+                host; the first to finish wins (None: no hedging)
+            merge_workers: Most groups merged at the same time (default: the
+                core count); how many actually run adapts to the disk
         """
         self.m3u8_url = m3u8_url
+        self.stream_url = m3u8_url  # as configured; m3u8_url follows renditions
         self.telegram_bot_token = telegram_bot_token
         self.telegram_chat_id = telegram_chat_id
         self.caption_prefix = caption_prefix
         self.work_dir = work_dir
         self.merge_group_size = merge_group_size
+        self.merge_mode = merge_mode
+        self.merge_target_duration = merge_target_duration
+        if shed_policy not in ("pause", "drop_oldest"):
+            raise ValueError(f"unknown shed_policy {shed_policy!r}")
+        if rendition_policy not in RenditionSelector.POLICIES:
+            raise ValueError(f"unknown rendition_policy {rendition_policy!r}")
+        self.disk_budget = disk_budget
+        self.shed_policy = shed_policy
+        self.staged_bytes = 0  # segments and unsent MP4s on disk
+        self.downloads_held = False  # paused by the disk budget
+        self.staging_dir = staging_dir or work_dir
+        if staging_dir:
+            os.makedirs(staging_dir, exist_ok=True)
+        self.download_concurrency = max(1, download_concurrency)
+        self.max_connections_per_host = (
+            max_connections_per_host or self.download_concurrency
+        )
 
         # Constants
         self.sent_json_file = os.path.join(work_dir, "sent.json")
-        self.check_interval = 5  # seconds between M3U8 polls
-        self.merge_idle_limit = 30  # seconds since last modification before merging
+        self.check_interval = 5  # seconds between M3U8 polls without a target duration
+        self.merge_idle_limit = 30  # seconds since the last segment arrived before merging a short group
 
         # Shared data for background thread
-        self.downloaded_ts = set()
-        self.ts_playlist_order = []
+        self.ledger = SegmentLedger()
         self.lock = threading.Lock()
         self.stop_event = threading.Event()
 
-    def safe_ts_filename(self, ts_url: str) -> str:
-        """Generate safe filename from .ts URL."""
+        # Stage handoff: downloader -> merger -> uploader
+        self.segment_queue = queue.Queue()  # finished .ts paths in playlist order
+        self.owns_uploader = uploader is None
+        self.uploader = uploader or TelegramUploader(
+            telegram_bot_token,
+            workers=upload_concurrency,
+            api_base=telegram_api_base,
+            local_mode=telegram_local_mode,
+            per_chat_concurrency=chat_upload_concurrency,
+        )
+        if merge_max_bytes == "auto":
+            merge_max_bytes = int(self.uploader.upload_limit * 0.96)
+        self.merge_max_bytes = merge_max_bytes
+        self.pending_ts = []  # Segments received by the merger, not yet merged
+        self.last_segment_time = time.time()
+        self.last_activity = time.time()
+        self.merge_retry_at = 0  # back off after a failed ffmpeg run
+
+        # Parallel merges (see merge_ts_to_mp4); they cover the head of pending_ts
+        self.merge_workers = max(1, merge_workers or os.cpu_count() or 1)
+        self.merge_limit = 1  # merges allowed at once, adapted by tune_merge_limit
+        self.merge_rates = {}  # merges in flight -> EWMA bytes/s of one merge
+        self.merging = collections.deque()  # [group, future, in flight at start, failures]
+        self.merge_attempts = 2  # failures before a group is split in two, or a single segment dropped
+        self.sent = None  # SentLedger over sent.json, opened by run()
+
+        # Crash-resume state (see checkpoint.py), saved from the main loop
+        self.checkpoint = Checkpoint(os.path.join(work_dir, "checkpoint.json"))
+        self.checkpoint_interval = 5  # seconds between checkpoints
+        self.checkpoint_at = 0
+        self.next_sequence = None  # media sequence after the last one handed to the merger
+        self.unsent = []  # merged MP4 paths waiting for upload, in upload order
+
+        # Master playlist handling
+        self.rendition_policy = rendition_policy
+        self.max_height = max_height
+        self.max_bandwidth = max_bandwidth
+        self.master_url = None
+        self.rendition = None  # RenditionSelector once a master playlist was seen
+        self.rendition_switched = False
+        self.playlist_failures = 0
+
+        # Playlist reload state (HLS spec section 6.3.4)
+        self.target_duration = None
+        self.playlist_changed = True
+        self.playlist_etag = None
+        self.playlist_last_modified = None
+        self.playlist_body = None
+        self.playlist_parser = None  # MediaPlaylistParser of the current m3u8_url
+        self.playlist_ended = False  # #EXT-X-ENDLIST seen
+        self.downloads_finished = False  # ended and every segment is on disk
+
+        # Gap detection and backfill (see find_gap)
+        self.gaps_file = os.path.join(work_dir, "gaps.jsonl")
+        self.last_listed = None  # (sequence, url) of the newest segment of the last poll
+        self.poll_scale = 1.0  # halved after every gap, down to min_poll_scale
+        self.min_poll_scale = 0.5
+        self.restore_poll_after = 10  # gap-free polls before poll_scale doubles back
+        self.gap_free_polls = 0
+        self.polls_held = False  # the disk budget skipped polls since the last one
+        self.max_backfill = 30  # newest missing segments of a gap worth guessing URLs for
+        self.backfilling = set()  # sequences of guessed segments being fetched
+        self.lost = []  # (placeholder Segment, reason) not yet written to gaps.jsonl
+
+        # Segment transfer settings
+        self.chunk_size = 256 * 1024  # bytes read from the socket per write
+        self.max_range_request = 16 * 1024 * 1024  # cap on one coalesced Range request
+        self.segment_retries = 2  # immediate retries for failed or truncated transfers
+        self.mirrors = list(mirrors or [])
+        self.hedge_quantile = hedge_quantile
+        self.min_hedge_delay = 0.2  # seconds; never hedge sooner than this
+        self.host_stats = HostStats()
+        self.buffers = threading.local()  # one reusable read buffer per worker thread
+
+        # Long-lived ffmpeg for merge_mode="stream", started on the first segment
+        self.remuxer = None
+        self.spools = {}  # merge_mode="stream": .part name -> segment bytes held in memory
+        self.stream_waiting = {}  # sequence -> (segment, bytes) behind an unfinished older one
+
+        # Keep-alive connections shared by playlist polls and segment fetches
+        self.session = session or make_session(
+            self.download_concurrency, self.max_connections_per_host
+        )
+        self.key_cache = KeyCache(self.session)
+        self.bandwidth_limiter = bandwidth_limiter
+        self.owns_download_pool = download_pool is None
+        self.download_pool = download_pool or ThreadPoolExecutor(
+            max_workers=self.download_concurrency, thread_name_prefix="segment"
+        )
+        # hedged fetches race here, outside the download pool a fetch is waiting in
+        self.hedge_pool = ThreadPoolExecutor(
+            max_workers=2 * self.download_concurrency, thread_name_prefix="hedge"
+        )
+        # ffmpeg merges run here so a shared pool caps them across channels
+        self.owns_merge_pool = merge_pool is None
+        self.merge_pool = merge_pool or ThreadPoolExecutor(
+            max_workers=self.merge_workers, thread_name_prefix="merge"
+        )
+
+        # Pipeline metrics (see metrics.py)
+        self.metrics = metrics or Metrics()
+        self.stats = self.metrics.labels(
+            stream=caption_prefix or os.path.basename(os.path.abspath(work_dir))
+        )
+        self.metrics_port = metrics_port
+        self.metrics_server = None
+        self.media_ends = {}  # mp4 name -> PROGRAM-DATE-TIME its media ends at
+        self.stream_media_end = None  # merge_mode="stream": end of the last segment fed
+
+    def safe_ts_filename(self, ts_url: str, byterange=None) -> str:
+        """
+        Generate safe filename from .ts URL. Byte-range segments of one resource
+        get the range in their name, so each (URI, range) is its own file.
+        """
         parsed = urlparse(ts_url)
         filename = os.path.basename(parsed.path)
         filename = unquote(filename)
+        if byterange is not None:
+            length, offset = byterange
+            filename = f"{filename.rsplit('.', 1)[0]}_{offset}-{offset + length - 1}"
         if not filename.endswith(".ts"):
             filename += ".ts"
         if len(filename) > 80:
-            hashed = hashlib.md5(ts_url.encode()).hexdigest()[:8]
+            key = ts_url if byterange is None else f"{ts_url}#{byterange}"
+            hashed = hashlib.md5(key.encode()).hexdigest()[:8]
             filename = f"segment_{hashed}.ts"
         # sanitize slightly (remove problematic characters)
         filename = filename.replace("..", "_").replace("/", "_")
-        return os.path.join(self.work_dir, filename)
+        return os.path.join(self.staging_dir, filename)
 
-    def download_new_segments(self) -> bool:
-        """Check M3U8 and download new .ts segments."""
+    def read_buffer(self) -> memoryview:
+        """Per-thread scratch buffer so streaming a segment allocates nothing."""
+        view = getattr(self.buffers, "view", None)
+        if view is None or len(view) != self.chunk_size:
+            view = memoryview(bytearray(self.chunk_size))
+            self.buffers.view = view
+        return view
+
+    def body_chunks(self, res, limit=None):
+        """
+        A streamed response body in chunks (views into the per-thread buffer),
+        at most `limit` bytes. Segments are requested with Accept-Encoding:
+        identity; a server that compresses them anyway is decoded here.
+        """
+        encoding = res.headers.get("Content-Encoding", "identity").lower()
+        if encoding != "identity":
+            if limit is not None:
+                raise IOError(f"{encoding}-encoded range response")
+            yield from res.raw.stream(self.chunk_size, decode_content=True)
+            return
+        view = self.read_buffer()
+        received = 0
+        while limit is None or received < limit:
+            want = len(view) if limit is None else min(len(view), limit - received)
+            n = res.raw.readinto(view[:want])
+            if not n:
+                return
+            received += n
+            yield view[:n]
+
+    def stream_to_file(self, res, tmp_name: str, decryptor=None, limit=None, cancel=None):
+        """
+        Write a streamed response body to disk chunk by chunk, decrypting on the
+        way when a decryptor is given. With `limit`, stop after that many bytes
+        so the rest of the body can go to the next file. Setting the `cancel`
+        event aborts the transfer at the next chunk.
+        Returns (bytes received, bytes written).
+        """
+        received = written = 0
+        with self.open_output(tmp_name) as f:
+            for chunk in self.body_chunks(res, limit):
+                if cancel is not None and cancel.is_set():
+                    raise IOError("cancelled")
+                n = len(chunk)
+                received += n
+                if self.bandwidth_limiter is not None:
+                    self.bandwidth_limiter.consume(n)
+                written += self.write_body_chunk(f, decryptor, chunk)
+            if decryptor is not None:
+                written += self.write_body_chunk(f, decryptor, None)
+        return received, written
+
+    def write_body_chunk(self, f, decryptor, chunk) -> int:
+        """
+        Write one chunk of a segment body, decrypted when there is a
+        decryptor; chunk None writes the decryptor's tail. Returns the bytes
+        written.
+        """
+        if decryptor is None:
+            f.write(chunk)
+            return len(chunk)
+        plain = decryptor.update(chunk) if chunk is not None else decryptor.finalize()
+        f.write(plain)
+        return len(plain)
+
+    def open_output(self, tmp_name: str):
+        """
+        Where a segment body goes: its .part file, or in merge_mode="stream" a
+        buffer in memory that stream_segment() pipes to ffmpeg, so segments
+        never touch the disk.
+        """
+        if self.merge_mode == "stream":
+            return MemorySpool(self.spools, tmp_name)
+        return open(tmp_name, "wb")
+
+    def make_decryptor(self, segment):
+        """
+        AES-128 or SAMPLE-AES decryptor for a segment, or None if it is sent
+        in the clear. Raises UnsupportedEncryption for anything else, rather
+        than storing segments nobody can play.
+        """
+        key = segment.key
+        if key is None:
+            return None
+        if key.keyformat != "identity":
+            raise UnsupportedEncryption(
+                f"{key.method} with KEYFORMAT={key.keyformat} is DRM and cannot be decrypted"
+            )
+        if key.method == "AES-128":
+            decryptor = SegmentDecryptor
+        elif key.method == "SAMPLE-AES":
+            decryptor = SampleAESDecryptor
+        else:
+            raise UnsupportedEncryption(f"METHOD={key.method} is not supported")
+        return decryptor(self.key_cache.get(key.uri), key.iv or sequence_iv(segment.sequence))
+
+    def segment_urls(self, url: str):
+        """A segment's URL and its mirror copies, best host first."""
+        return self.host_stats.rank([url] + [mirror_url(url, m) for m in self.mirrors])
+
+    def fetch_failed(self, url: str, e: Exception, attempt: int, next_url: str, name: str):
+        if host_of(next_url) != host_of(url):
+            self.stats.inc("mirror_failovers_total")
+            print(f"🔀 {name} failed on {host_of(url)} ({e}), trying {host_of(next_url)}")
+        else:
+            print(f"🔁 Retrying {name} ({attempt}): {e}")
+
+    def fetch_from(self, segment, url: str, tmp_name: str, cancel=None):
+        """One GET of a segment into tmp_name; return (path, size)."""
+        decryptor = self.make_decryptor(segment)
+        host = host_of(url)
+        started = time.time()
         try:
-            r = requests.get(self.m3u8_url, timeout=10)
-            r.raise_for_status()
-        except Exception as e:
-            print(f"⚠️ Failed to fetch playlist: {e}")
-            return False
+            with self.session.get(url, headers=SEGMENT_HEADERS, timeout=20, stream=True) as res:
+                res.raise_for_status()
+                received, written = self.stream_to_file(res, tmp_name, decryptor, cancel=cancel)
+                self.check_body_length(received, res.headers)
+        except Exception:
+            self.fetch_aborted(tmp_name, host, started, cancel is not None and cancel.is_set())
+            raise
+        self.fetch_succeeded(segment, host, started)
+        return tmp_name, written
 
-        lines = r.text.splitlines()
-        ts_urls = [line.strip() for line in lines if line and not line.startswith("#")]
-        base_url = self.m3u8_url.rsplit("/", 1)[0]
+    def check_body_length(self, received: int, headers):
+        """Raise if fewer bytes arrived than Content-Length announced."""
+        # Content-Length counts encoded bytes, so only check identity bodies
+        expected = headers.get("Content-Length")
+        encoding = headers.get("Content-Encoding", "identity")
+        if expected is not None and encoding == "identity":
+            if received != int(expected):
+                raise IOError(f"truncated transfer: {received} of {expected} bytes")
 
-        with self.lock:
-            for ts_name in ts_urls:
-                ts_url = ts_name if ts_name.startswith("http") else f"{base_url}/{ts_name}"
-                ts_file = self.safe_ts_filename(ts_url)
-                if ts_file not in self.ts_playlist_order:
-                    self.ts_playlist_order.append(ts_file)
+    def fetch_succeeded(self, segment, host: str, started: float):
+        seconds = time.time() - started
+        self.host_stats.observe(host, seconds)
+        if segment.byterange is None:
+            self.stats.observe("segment_fetch_seconds", seconds, host=host)
 
-        new_files = 0
+    def fetch_aborted(self, tmp_name: str, host: str, started: float, cancelled: bool):
+        """Remove a failed or cancelled fetch's partial file and note it for the host."""
+        self.remove_quietly(tmp_name)
+        if cancelled:
+            # lost a hedge race: it took at least this long
+            self.host_stats.observe(host, time.time() - started)
+        else:
+            self.host_stats.observe(host, ok=False)
 
-        for ts_name in ts_urls:
-            ts_url = ts_name if ts_name.startswith("http") else f"{base_url}/{ts_name}"
-            ts_file = self.safe_ts_filename(ts_url)
+    def hedge_delay(self, url: str, segment):
+        """Seconds a fetch from url may take before it is hedged, or None."""
+        if self.hedge_quantile is None:
+            return None
+        delay = self.host_stats.quantile(host_of(url), self.hedge_quantile) or segment.duration
+        if not delay:
+            return None
+        return max(delay, self.min_hedge_delay)
 
-            with self.lock:
-                if ts_file in self.downloaded_ts:
+    def hedged_fetch(self, segment, ts_file: str, url: str, backup_url: str):
+        """
+        fetch_from() url; if it is still running at the hedge deadline, race a
+        second request to backup_url against it and keep whichever finishes
+        first. The loser is cancelled and its file removed.
+        """
+        delay = self.hedge_delay(url, segment)
+        if delay is None:
+            return self.fetch_from(segment, url, ts_file + ".part")
+        cancels = {}  # future -> its cancel event
+        event = threading.Event()
+        first = self.hedge_pool.submit(self.fetch_from, segment, url, ts_file + ".part", event)
+        cancels[first] = event
+        try:
+            return first.result(timeout=delay)
+        except FuturesTimeout:
+            pass
+
+        name = os.path.basename(ts_file)
+        print(f"🐇 {name} slower than {delay:.1f}s, hedging on {host_of(backup_url)}")
+        self.stats.inc("hedged_requests_total")
+        event = threading.Event()
+        second = self.hedge_pool.submit(
+            self.fetch_from, segment, backup_url, ts_file + ".hedge.part", event
+        )
+        cancels[second] = event
+
+        winner = error = None
+        running = set(cancels)
+        while running and winner is None:
+            done, running = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is not None:
+                    error = future.exception()
+                elif winner is None:
+                    winner = future
+                else:
+                    # both finished at once: keep one file
+                    self.remove_quietly(future.result()[0])
+        for future in running:
+            cancels[future].set()
+            future.add_done_callback(self.discard_loser)
+        if winner is None:
+            raise error
+        if winner is second:
+            self.stats.inc("hedge_wins_total")
+        return winner.result()
+
+    def discard_loser(self, future):
+        """Done callback of the slower request of a hedged fetch."""
+        if future.exception() is None:
+            self.remove_quietly(future.result()[0])
+
+    def fetch_segment(self, segment, ts_file: str):
+        """
+        Download one segment to a temporary .part file; return (path, size).
+        Failed attempts are retried on the next host when there are mirrors.
+        """
+        urls = self.segment_urls(segment.url)
+        retries = max(self.segment_retries, len(urls) - 1)
+        attempt = 0
+        while True:
+            url = urls[attempt % len(urls)]
+            backup_url = urls[(attempt + 1) % len(urls)]
+            try:
+                return self.hedged_fetch(segment, ts_file, url, backup_url)
+            except Exception as e:
+                attempt += 1
+                if attempt > retries or self.stop_event.is_set():
+                    raise
+                self.fetch_failed(url, e, attempt, backup_url, os.path.basename(ts_file))
+
+    def playlist_headers(self) -> dict:
+        """Conditional GET headers from the previous playlist response."""
+        headers = {}
+        if self.playlist_etag:
+            headers["If-None-Match"] = self.playlist_etag
+        if self.playlist_last_modified:
+            headers["If-Modified-Since"] = self.playlist_last_modified
+        return headers
+
+    def playlist_changed_text(self, headers, text: str):
+        """Remember the validators of a 200 response; return text, or None if unchanged."""
+        self.playlist_etag = headers.get("ETag")
+        self.playlist_last_modified = headers.get("Last-Modified")
+        if text == self.playlist_body:
+            return None
+        self.playlist_body = text
+        return text
+
+    def skip_body(self, res, nbytes: int):
+        """Read and drop the first bytes of a response (server ignored our Range)."""
+        view = self.read_buffer()
+        while nbytes > 0:
+            n = res.raw.readinto(view[: min(len(view), nbytes)])
+            if not n:
+                raise IOError("response ended before the requested range")
+            nbytes -= n
+
+    def coalesce_ranges(self, jobs):
+        """
+        Split (segment, ts_file) jobs into fetch runs. Byte-range segments that
+        continue the previous range of the same resource share one run (up to
+        max_range_request bytes); everything else is a run of its own.
+        """
+        runs = []
+        for segment, ts_file in jobs:
+            if runs and segment.byterange is not None:
+                last_segment = runs[-1][-1][0]
+                last = last_segment.byterange
+                if (
+                    last is not None
+                    and last_segment.url == segment.url
+                    and last[1] + last[0] == segment.byterange[1]
+                    and sum(s.byterange[0] for s, _ in runs[-1]) + segment.byterange[0]
+                    <= self.max_range_request
+                ):
+                    runs[-1].append((segment, ts_file))
+                    continue
+            runs.append([(segment, ts_file)])
+        return runs
+
+    def fetch_range_run(self, run):
+        """
+        Fetch adjacent byte ranges of one resource with a single Range request
+        and split the body back into per-segment .part files.
+        Returns [(path, size), ...] in run order.
+        """
+        first = run[0][0].byterange
+        last = run[-1][0].byterange
+        start, end = first[1], last[1] + last[0] - 1
+        urls = self.segment_urls(run[0][0].url)
+        retries = max(self.segment_retries, len(urls) - 1)
+        attempt = 0
+        while True:
+            url = urls[attempt % len(urls)]
+            results = []
+            try:
+                headers = dict(SEGMENT_HEADERS, Range=f"bytes={start}-{end}")
+                with self.session.get(url, headers=headers, timeout=20, stream=True) as res:
+                    res.raise_for_status()
+                    if res.status_code != 206:
+                        # whole resource came back: skip to our range
+                        self.skip_body(res, start)
+                    for segment, ts_file in run:
+                        tmp_name = ts_file + ".part"
+                        length = segment.byterange[0]
+                        received, written = self.stream_to_file(
+                            res, tmp_name, self.make_decryptor(segment), limit=length
+                        )
+                        if received != length:
+                            raise IOError(
+                                f"truncated range: {received} of {length} bytes"
+                            )
+                        results.append((tmp_name, written))
+                self.host_stats.observe(host_of(url))
+                return results
+            except Exception as e:
+                for segment, ts_file in run:
+                    self.remove_quietly(ts_file + ".part")
+                self.host_stats.observe(host_of(url), ok=False)
+                attempt += 1
+                if attempt > retries or self.stop_event.is_set():
+                    raise
+                name = f"range {start}-{end} of {os.path.basename(urlparse(url).path)}"
+                self.fetch_failed(url, e, attempt, urls[attempt % len(urls)], name)
+
+    def fetch_playlist(self):
+        """
+        Fetch the media playlist with a conditional GET.
+
+        Returns the playlist text, or None when it has not changed since the
+        last poll (HTTP 304 or an identical body).
+        """
+        r = self.session.get(self.m3u8_url, headers=self.playlist_headers(), timeout=10)
+        if r.status_code == 304:
+            return None
+        r.raise_for_status()
+        return self.playlist_changed_text(r.headers, r.text)
+
+    def poll_interval(self) -> float:
+        """
+        Seconds to wait between playlist reloads: the target duration after a
+        change, half of it when the playlist was unchanged. Once gaps were
+        seen the first shrinks by poll_scale, but never below the second.
+        """
+        if not self.target_duration:
+            return 1 if self.playlist_changed else self.check_interval
+        if self.playlist_changed:
+            return max(self.target_duration / 2, self.target_duration * self.poll_scale)
+        return self.target_duration / 2
+
+    def new_segments(self, playlist):
+        """Record a parsed playlist in the ledger; return (segment, ts_file) to fetch."""
+        with self.lock:
+            last_sequence = playlist.segments[-1].sequence
+            # floor can be one past the newest listed segment once that one is done
+            if self.ledger.floor is not None and last_sequence + 1 < self.ledger.floor:
+                print("🔁 Media sequence went backwards — stream restarted, resetting ledger")
+                self.ledger.reset()
+                self.last_listed = None
+            # claimed before the expiry below, so they survive it
+            missing = self.find_gap(playlist)
+            jobs = self.backfill(playlist, missing)
+            if not missing:
+                self.gap_free_poll()
+            self.polls_held = False
+            newest = playlist.segments[-1]
+            self.last_listed = (newest.sequence, newest.url)
+            for sequence in self.ledger.expire_before(playlist.media_sequence):
+                self.lost.append((self.placeholder(playlist, sequence), "download failed"))
+
+            for segment in playlist.segments:
+                ts_file = self.safe_ts_filename(segment.url, segment.byterange)
+                self.ledger.add(segment.sequence, ts_file)
+                if not self.ledger.claim(segment.sequence):
+                    continue
+                if os.path.exists(ts_file):
+                    # already present on disk
                     continue
-                self.downloaded_ts.add(ts_file)
+                jobs.append((segment, ts_file))
+        if jobs and self.rendition_switched:
+            jobs[0][0].discontinuity = True
+            self.rendition_switched = False
+        return jobs
+
+    def find_gap(self, playlist):
+        """
+        Sequences that slid out of the live window between the last poll and
+        this one without ever being listed. Caller holds the lock.
+        """
+        if self.last_listed is None:
+            return []
+        return list(range(self.last_listed[0] + 1, playlist.media_sequence))
+
+    def gap_free_poll(self):
+        """Double poll_scale back after restore_poll_after polls without gaps. Caller holds the lock."""
+        if self.poll_scale >= 1.0:
+            return
+        self.gap_free_polls += 1
+        if self.gap_free_polls >= self.restore_poll_after:
+            self.gap_free_polls = 0
+            self.poll_scale = min(1.0, self.poll_scale * 2)
+            print(f"⏪ No gaps lately, reloading the playlist at {self.poll_scale:g}x the usual interval")
+
+    def placeholder(self, playlist, sequence: int):
+        """A Segment for an unlisted sequence, its timing estimated from the window."""
+        durations = [s.duration for s in playlist.segments if s.duration]
+        duration = sum(durations) / len(durations) if durations else (self.target_duration or 0)
+        first = playlist.segments[0]
+        start = None
+        if first.program_date_time is not None:
+            start = first.program_date_time - (first.sequence - sequence) * duration
+        return Segment(sequence=sequence, url="", duration=duration, program_date_time=start)
+
+    def backfill(self, playlist, missing):
+        """
+        Queue segments of a gap for download under URLs guessed from the
+        playlist's naming scheme, while the CDN may still serve them. Those
+        without a usable URL are lost. Caller holds the lock.
+        """
+        if not missing:
+            return []
+        print(
+            f"🕳️ Media sequence jumped: {len(missing)} segments "
+            f"({missing[0]}-{missing[-1]}) left the window unseen"
+        )
+        self.stats.inc("gap_segments_total", len(missing))
+        if self.polls_held:
+            # we stopped polling ourselves: reloading sooner would not have helped
+            print("⏸️ The gap opened while downloads were paused, keeping the poll interval")
+        else:
+            self.gap_free_polls = 0
+            if self.poll_scale > self.min_poll_scale:
+                self.poll_scale = max(self.min_poll_scale, self.poll_scale / 2)
+                print(f"⏩ Reloading the playlist at {self.poll_scale:g}x the usual interval")
 
+        template = playlist.segments[0]
+        known = [(s.sequence, s.url) for s in playlist.segments]
+        if self.last_listed is not None:
+            known.append(self.last_listed)
+        # byte ranges and explicit IVs cannot be guessed
+        guessable = template.byterange is None and (template.key is None or template.key.iv is None)
+        jobs = []
+        for i, sequence in enumerate(missing):
+            segment = self.placeholder(playlist, sequence)
+            if len(missing) - i > self.max_backfill:
+                self.lost.append((segment, "too old to backfill"))
+                continue
+            url = guess_segment_url(known, sequence) if guessable else None
+            if url is None:
+                self.lost.append((segment, "no predictable URI"))
+                continue
+            segment.url = url
+            segment.key = template.key
+            ts_file = self.safe_ts_filename(url)
+            if not self.ledger.add(sequence, ts_file) or not self.ledger.claim(sequence):
+                continue
             if os.path.exists(ts_file):
-                # already present on disk
                 continue
+            self.backfilling.add(sequence)
+            jobs.append((segment, ts_file))
+        return jobs
+
+    def segment_fetched(self, segment):
+        """Bookkeeping after a segment was published."""
+        if segment.sequence in self.backfilling:
+            self.backfilling.discard(segment.sequence)
+            self.stats.inc("backfilled_segments_total")
+            print(f"🩹 Backfilled segment {segment.sequence}")
+
+    def download_failed(self, segment, ts_file: str, e: Exception):
+        """A fetch gave up: retried on the next poll, or lost if it was a backfill."""
+        if isinstance(e, UnsupportedEncryption) and not self.downloads_finished:
+            # every segment would fail the same way: stop instead of recording gaps
+            print(f"❌ {e}: stopping {self.stream_url}")
+            self.downloads_finished = True
+        with self.lock:
+            if segment.sequence not in self.backfilling:
+                self.ledger.release(segment.sequence)
+                print(f"❌ Failed to download {ts_file}: {e}")
+                return
+            self.backfilling.discard(segment.sequence)
+            self.ledger.retire(segment.sequence)
+            self.lost.append((segment, "backfill failed"))
+        print(f"❌ Could not backfill {os.path.basename(ts_file)}: {e}")
+
+    def record_gaps(self):
+        """Append the segments lost this poll to gaps.jsonl, a line per run of sequences."""
+        with self.lock:
+            lost, self.lost = self.lost, []
+        runs = []
+        # recovered leftovers have no sequence; each is a run of its own
+        lost.sort(key=lambda x: -1 if x[0].sequence is None else x[0].sequence)
+        for segment, reason in lost:
+            last = runs[-1][-1] if runs else None
+            if (
+                last is not None
+                and segment.sequence is not None
+                and last[0].sequence is not None
+                and last[0].sequence + 1 == segment.sequence
+                and last[1] == reason
+            ):
+                runs[-1].append((segment, reason))
+            else:
+                runs.append([(segment, reason)])
+        if not runs:
+            return
+        try:
+            with open(self.gaps_file, "a", encoding="utf-8") as f:
+                for run in runs:
+                    first, last = run[0][0], run[-1][0]
+                    entry = {
+                        "detected_at": time.time(),
+                        "first_sequence": first.sequence,
+                        "last_sequence": last.sequence,
+                        "segments": len(run),
+                        "seconds": sum(segment.duration for segment, _ in run),
+                        # estimated PROGRAM-DATE-TIME range; None without those tags
+                        "start": first.program_date_time,
+                        "end": None
+                        if last.program_date_time is None
+                        else last.program_date_time + last.duration,
+                        "reason": run[0][1],
+                    }
+                    f.write(json.dumps(entry) + "\n")
+                    print(
+                        f"🕳️ Lost segments {first.sequence}-{last.sequence} "
+                        f"(~{entry['seconds']:.1f}s): {entry['reason']}"
+                    )
+        except OSError as e:
+            print(f"⚠️ Could not write {self.gaps_file}: {e}")
+        self.stats.inc("lost_segments_total", len(lost))
+
+    def publish_segment(self, segment, ts_file: str, tmp_name: str):
+        """Hand a fully downloaded segment to the merge stage."""
+        if self.merge_mode == "stream":
+            self.stream_segment(segment, tmp_name)
+        else:
+            self.store_segment(segment, ts_file, tmp_name)
+            self.segment_queue.put(segment)
+        print(f"⬇️ Downloaded: {os.path.basename(ts_file)}")
+
+    def store_segment(self, segment, ts_file: str, tmp_name: str):
+        """Give a downloaded .part file its final name, then scan and journal it."""
+        # atomic rename so partially-written files are never visible
+        os.replace(tmp_name, ts_file)
+        segment.path = ts_file
+        self.stage(segment.size)
+        self.inspect_segment(segment)
+        self.checkpoint.published(segment)
+
+    def inspect_segment(self, segment):
+        """Note whether a downloaded segment opens on a keyframe, and its PTS range."""
+        try:
+            info = scan_file(segment.path)
+        except OSError as e:
+            print(f"⚠️ Could not scan {segment.path}: {e}")
+            return
+        segment.keyframe = info.keyframe
+        if info.first_pts is not None:
+            segment.pts_range = (info.first_pts, info.last_pts)
+        if info.cc_errors:
+            print(
+                f"⚠️ {os.path.basename(segment.path)}: "
+                f"{info.cc_errors} continuity counter errors"
+            )
+
+    def load_master(self, text: str):
+        """Parse a master playlist and switch to the rendition the policy picks."""
+        self.master_url = self.m3u8_url
+        variants = parse_master_playlist(text, self.master_url)
+        if not variants:
+            raise ValueError("master playlist lists no variants")
+        self.rendition = RenditionSelector(
+            variants,
+            policy=self.rendition_policy,
+            max_height=self.max_height,
+            max_bandwidth=self.max_bandwidth,
+        )
+        self.use_variant(self.rendition.current)
 
+    def use_variant(self, variant):
+        """Follow another media playlist from now on."""
+        resolution = f"{variant.width}x{variant.height}" if variant.height else "?"
+        print(f"📺 Rendition {resolution} @ {variant.bandwidth // 1000} kbps")
+        self.m3u8_url = variant.url
+        self.playlist_etag = self.playlist_last_modified = self.playlist_body = None
+        # a different rendition must never end up in the same MP4
+        self.rendition_switched = True
+        if self.last_listed is not None:
+            # its URIs say nothing about the new rendition's
+            self.last_listed = (self.last_listed[0], None)
+
+    def playlist_failed(self, e):
+        print(f"⚠️ Failed to fetch playlist: {e}")
+        self.stats.inc("playlist_fetch_errors_total")
+        self.playlist_changed = False
+        self.playlist_failures += 1
+        if self.master_url and self.playlist_failures >= 3:
+            # variant URLs often carry expiring tokens: resolve them again
+            print("🔁 Reloading master playlist")
+            self.m3u8_url = self.master_url
+            self.playlist_etag = self.playlist_last_modified = self.playlist_body = None
+            self.playlist_failures = 0
+
+    def parse_playlist(self, text: str):
+        """
+        Parse a fetched playlist. A master playlist picks a rendition and
+        returns None; the media playlist is loaded on the next poll.
+        """
+        self.playlist_failures = 0
+        if is_master_playlist(text):
+            self.load_master(text)
+            return None
+        if self.playlist_parser is None or self.playlist_parser.playlist_url != self.m3u8_url:
+            self.playlist_parser = MediaPlaylistParser(self.m3u8_url)
+        playlist = self.playlist_parser.parse(text)
+        self.target_duration = playlist.target_duration
+        self.playlist_ended = playlist.ended
+        return playlist if playlist.segments else None
+
+    def check_ended(self, jobs):
+        """After a poll of an ended playlist: finish once every segment is on disk."""
+        if not self.playlist_ended:
+            return
+        if all(job[0].size for job in jobs):
+            print("🏁 Playlist ended and every segment is downloaded")
+            self.downloads_finished = True
+        else:
+            # the playlist will not change any more: re-read it to retry the failures
+            self.playlist_etag = self.playlist_last_modified = self.playlist_body = None
+
+    def drained(self) -> bool:
+        """True once an ended playlist has been merged and uploaded completely."""
+        if not self.downloads_finished or self.pending_ts or not self.segment_queue.empty():
+            return False
+        self.flush_stream(everything=True)
+        if self.remuxer is not None:
+            # closing stdin makes ffmpeg finish the last chunk and hand it on
+            self.remuxer.close()
+            self.remuxer = None
+        return self.uploader.pending(owner=self) == 0
+
+    def observe_batch(self, jobs, started: float):
+        """
+        Record a poll's downloads in the metrics and let the adaptive rendition
+        policy see how long they took.
+        """
+        done = [job[0] for job in jobs if job[0].size]
+        nbytes = sum(segment.size for segment in done)
+        media_seconds = sum(segment.duration for segment in done)
+        elapsed = time.time() - started
+        self.stats.set("download_queue_depth", 0)
+        if done:
+            self.stats.inc("segments_downloaded_total", len(done))
+            self.stats.inc("segment_bytes_total", nbytes)
+            if elapsed > 0:
+                self.stats.observe("segment_bytes_per_second", nbytes / elapsed)
+        if len(done) < len(jobs):
+            self.stats.inc("segment_download_failures_total", len(jobs) - len(done))
+
+        if self.rendition is None:
+            return
+        if self.rendition.observe(nbytes, elapsed, media_seconds):
+            self.use_variant(self.rendition.current)
+
+    def download_new_segments(self) -> bool:
+        """Check M3U8 and download new .ts segments."""
+        if self.downloads_paused():
+            return False
+        fetch_started = time.time()
+        try:
+            text = self.fetch_playlist()
+        except Exception as e:
+            self.playlist_failed(e)
+            return False
+        self.stats.observe("playlist_fetch_seconds", time.time() - fetch_started)
+
+        self.playlist_changed = text is not None
+        if text is None:
+            return False
+
+        playlist = self.parse_playlist(text)
+        if playlist is None:
+            return False
+
+        # fan the fetches out to the worker pool; adjacent byte ranges share a request
+        started = time.time()
+        jobs = []
+        for run in self.coalesce_ranges(self.new_segments(playlist)):
+            if run[0][0].byterange is None:
+                segment, ts_file = run[0]
+                future = self.download_pool.submit(self.fetch_segment, segment, ts_file)
+                jobs.append((segment, ts_file, future, None))
+            else:
+                future = self.download_pool.submit(self.fetch_range_run, run)
+                for i, (segment, ts_file) in enumerate(run):
+                    jobs.append((segment, ts_file, future, i))
+        self.stats.set("download_queue_depth", len(jobs))
+
+        new_files = 0
+
+        # publish finished segments in playlist order: a later segment only becomes
+        # visible to the merger once everything before it has landed (or failed)
+        for segment, ts_file, future, index in jobs:
             try:
-                res = requests.get(ts_url, timeout=20)
-                res.raise_for_status()
-                # write to a temp file then atomically rename to avoid partially-written files being visible
-                tmp_name = ts_file + ".part"
-                with open(tmp_name, "wb") as f:
-                    f.write(res.content)
-                os.replace(tmp_name, ts_file)
+                result = future.result()
+                tmp_name, segment.size = result if index is None else result[index]
+                self.publish_segment(segment, ts_file, tmp_name)
+                self.segment_fetched(segment)
                 new_files += 1
-                print(f"⬇️ Downloaded: {os.path.basename(ts_file)}")
             except Exception as e:
-                print(f"❌ Failed to download {ts_file}: {e}")
-                with self.lock:
-                    self.downloaded_ts.discard(ts_file)
-                # if partial file exists, remove it
-                try:
-                    if os.path.exists(tmp_name):
-                        os.remove(tmp_name)
-                except Exception:
-                    pass
-                time.sleep(1)
+                self.download_failed(segment, ts_file, e)
 
+        self.observe_batch(jobs, started)
+        # segments that expired unfetched no longer hold the stream back
+        self.flush_stream()
+        self.record_gaps()
+        self.check_ended(jobs)
         return new_files > 0
 
+    def stream_segment(self, segment, tmp_name: str):
+        """
+        Queue a downloaded segment for the streaming remuxer. It is fed once
+        every older segment still in the ledger is fed too, so one failed
+        download holds the later ones back instead of landing after them.
+        """
+        self.stream_waiting[segment.sequence] = (segment, self.spools.pop(tmp_name))
+        self.flush_stream()
+
+    def flush_stream(self, everything: bool = False):
+        """Feed waiting segments in order; with `everything`, whatever is missing."""
+        while self.stream_waiting:
+            sequence = min(self.stream_waiting)
+            with self.lock:
+                oldest = min(self.ledger.files) if self.ledger.files else sequence
+            if sequence > oldest and not everything:
+                return
+            self.feed_stream(*self.stream_waiting.pop(sequence))
+
+    def feed_stream(self, segment, data: bytes):
+        """Pipe a segment from memory into the streaming remuxer."""
+        if segment.discontinuity and self.remuxer is not None:
+            # new timeline or rendition: finish the current chunk and start over
+            self.remuxer.close()
+            self.remuxer = None
+        if self.remuxer is None:
+            segment_seconds = self.merge_target_duration
+            if not segment_seconds and self.merge_group_size:
+                segment_seconds = self.merge_group_size * (self.target_duration or 6)
+            if self.merge_max_bytes and segment.size and segment.duration:
+                # ffmpeg can only cut by time: derive the longest chunk that stays
+                # under the byte cap from the first segment's bitrate, with headroom
+                bytes_per_second = segment.size / segment.duration
+                byte_seconds = 0.8 * self.merge_max_bytes / bytes_per_second
+                segment_seconds = min(segment_seconds or byte_seconds, byte_seconds)
+            if not segment_seconds:
+                # no size limit of any kind: chunks of 15 segments, the default
+                segment_seconds = 15 * (self.target_duration or 6)
+            self.remuxer = StreamRemuxer(
+                self.work_dir, segment_seconds, on_output=self.mp4_ready
+            )
+        self.remuxer.feed(data, os.path.basename(segment.url))
+        self.advance_next_sequence(segment)
+        if segment.program_date_time is not None:
+            self.stream_media_end = segment.program_date_time + segment.duration
+        with self.lock:
+            self.ledger.retire(segment.sequence)
+
     def download_worker(self):
         """Background thread: continuously fetch new segments."""
-        while not self.stop_event.is_set():
+        while not self.stop_event.is_set() and not self.downloads_finished:
             try:
-                new = self.download_new_segments()
-                if not new:
-                    # no new files found: wait full interval
-                    self.stop_event.wait(self.check_interval)
-                else:
-                    # got new files recently, poll again sooner
-                    self.stop_event.wait(1)
+                started = time.time()
+                self.download_new_segments()
+                # reload interval is measured from when the poll started
+                elapsed = time.time() - started
+                self.stop_event.wait(max(0, self.poll_interval() - elapsed))
             except Exception as e:
                 print("Download worker error:", e)
                 self.stop_event.wait(2)
 
-    def merge_ts_to_mp4(self):
+    def recover_leftovers(self):
         """
-        Merge .ts → .mp4 dynamically:
-        - Prefer merging groups of MERGE_GROUP_SIZE.
-        - If a group is smaller than MERGE_GROUP_SIZE, only merge it if the newest file in that group
-          has not been modified for at least MERGE_IDLE_LIMIT seconds.
+        Scan the work dir once at startup: queue .ts files left by an earlier
+        run for merging and unsent .mp4 files for upload. With a checkpoint of
+        this stream, its segments and uploads come back in their saved order
+        and downloads resume after its last media sequence.
         """
-        ts_files = [f for f in os.listdir(self.work_dir) if f.endswith(".ts")]
-        if not ts_files:
-            return
-
-        # Get full paths
-        ts_files = [os.path.join(self.work_dir, f) for f in ts_files]
+        state = self.checkpoint.load()
+        if state is not None and state["m3u8_url"] != self.stream_url:
+            print("⚠️ checkpoint.json belongs to another stream, ignoring it")
+            state = None
 
-        with self.lock:
-            order_map = {f: i for i, f in enumerate(self.ts_playlist_order)}
-
-        def sort_key(x):
-            if x in order_map:
-                return (1, order_map[x])
-            else:
+        ts_files, mp4_files = [], []
+        for f in os.listdir(self.work_dir):
+            path = os.path.join(self.work_dir, f)
+            if f.endswith(".ts"):
+                ts_files.append(path)
+            elif f.endswith(".mp4"):
+                mp4_files.append(f)
+            elif f.endswith(".concat.txt") or f.endswith(".mp4.part"):
                 try:
-                    mtime = os.path.getmtime(x)
+                    os.remove(path)
                 except OSError:
-                    mtime = 0
-                return (0, mtime)
+                    pass
+        if self.staging_dir != self.work_dir:
+            ts_files += [
+                os.path.join(self.staging_dir, f)
+                for f in os.listdir(self.staging_dir)
+                if f.endswith(".ts")
+            ]
 
-        ts_files.sort(key=sort_key)
+        def mtime(x):
+            try:
+                return os.path.getmtime(x)
+            except OSError:
+                return 0
 
-        # split into groups of MERGE_GROUP_SIZE
-        groups = [
-            ts_files[i : i + self.merge_group_size]
-            for i in range(0, len(ts_files), self.merge_group_size)
-        ]
+        if state is not None:
+            self.pending_ts = [s for s in state["pending"] if os.path.exists(s.path)]
+            self.next_sequence = state["next_sequence"]
+            known = {s.path for s in self.pending_ts}
+            ts_files = [ts for ts in ts_files if ts not in known]
 
-        now = time.time()
-        for group in groups:
-            if not group:
+        # the checkpoint and its journal cover every segment this version
+        # published; what is left has no media sequence, so mtime it is
+        for ts in sorted(ts_files, key=mtime):
+            try:
+                size = os.path.getsize(ts)
+            except OSError:
                 continue
+            if size <= 0:
+                continue
+            segment = Segment(sequence=None, url="", path=ts, size=size)
+            if self.next_sequence is not None:
+                # not journaled (a crash before the first save): after the rest
+                segment.sequence = self.next_sequence
+                self.next_sequence += 1
+            self.pending_ts.append(segment)
 
-            # skip tiny groups unless they've been idle for MERGE_IDLE_LIMIT
-            if len(group) < self.merge_group_size:
-                # compute newest modification time in this group
-                try:
-                    newest_mtime = max(os.path.getmtime(f) for f in group)
-                except FileNotFoundError:
-                    # some file disappeared, skip this group for now
-                    continue
-                group_idle = now - newest_mtime
-                if group_idle < self.merge_idle_limit:
-                    # still being updated recently -> skip
-                    print(
-                        f"⏳ Group of {len(group)} not idle yet (idle {group_idle:.1f}s) -> skip"
-                    )
-                    continue
+        self.stage(sum(segment.size for segment in self.pending_ts))
 
-            # additional safety: make sure files are non-zero and exist
-            ready = True
-            for ts in group:
-                try:
-                    if not os.path.exists(ts) or os.path.getsize(ts) == 0:
-                        ready = False
-                        break
-                except Exception:
-                    ready = False
-                    break
-            if not ready:
-                print(
-                    "⚠️ Some files in group are missing or zero-sized -> skip merging this group."
-                )
-                continue
+        if self.next_sequence is not None:
+            # everything below was downloaded already
+            with self.lock:
+                self.ledger.floor = self.next_sequence
+            print(f"♻️ Resuming at media sequence {self.next_sequence}")
+            # what slid out of the window while we were down is a gap
+            self.last_listed = (self.next_sequence - 1, None)
+
+        saved = state["uploads"] if state is not None else []
+        unsent = [
+            f
+            for f in saved + sorted(set(mp4_files) - set(saved))
+            if f in mp4_files and not self.sent.is_sent(f)
+        ]
+        for f in unsent:
+            self.mp4_ready(os.path.join(self.work_dir, f))
+
+        if self.pending_ts or unsent:
+            print(
+                f"♻️ Recovered {len(self.pending_ts)} segments and {len(unsent)} unsent MP4s"
+            )
+
+    def collect_segments(self, timeout: float):
+        """Move finished segments from the download queue to the merger's list."""
+        try:
+            received = [self.segment_queue.get(timeout=timeout)]
+        except queue.Empty:
+            return
+        while True:
+            try:
+                received.append(self.segment_queue.get_nowait())
+            except queue.Empty:
+                break
+
+        self.add_pending(received)
 
-            first_ts = group[0]
-            mp4_name = first_ts.rsplit(".", 1)[0] + ".mp4"
-            if os.path.exists(mp4_name):
-                # already merged
+    def advance_next_sequence(self, segment):
+        if segment.sequence is not None and (
+            self.next_sequence is None or segment.sequence >= self.next_sequence
+        ):
+            self.next_sequence = segment.sequence + 1
+
+    def add_pending(self, received):
+        """
+        Add finished segments to the merger's list, keeping playlist order.
+        Groups being merged stay at the head as they are; a late segment older
+        than them queues behind them.
+        """
+        for segment in received:
+            self.advance_next_sequence(segment)
+        merging = self.merging_size()
+        waiting = self.pending_ts[merging:] + list(received)
+        # recovered leftovers (no sequence) go first, then playlist order
+        waiting.sort(key=lambda x: (1, x.sequence) if x.sequence is not None else (0, 0))
+        self.pending_ts[merging:] = waiting
+        self.last_segment_time = self.last_activity = time.time()
+        self.stats.set("merge_queue_depth", len(self.pending_ts))
+
+    def next_group_size(self, start: int = 0) -> int:
+        """
+        How many pending segments from `start` on form the next group.
+
+        A group is full once it reaches merge_target_duration seconds of #EXTINF
+        (or merge_group_size segments when no target duration is set). It then
+        closes in front of the next segment that opens on a keyframe, so every
+        MP4 starts with a picture; after twice its size it closes regardless.
+        A discontinuity, or one more segment pushing it past merge_max_bytes,
+        closes it at once. Returns 0 when the pending segments do not fill a
+        group yet.
+        """
+        total_bytes = 0
+        total_duration = 0.0
+        full_at = 0
+        for i, segment in enumerate(self.pending_ts[start:]):
+            if i and segment.discontinuity:
+                return i
+            if i and self.merge_max_bytes and total_bytes + segment.size > self.merge_max_bytes:
+                return i
+            if full_at and (segment.keyframe is not False or i >= 2 * full_at):
+                return i
+            total_bytes += segment.size
+            total_duration += segment.duration
+            if full_at:
                 continue
+            if self.merge_target_duration:
+                if total_duration >= self.merge_target_duration:
+                    full_at = i + 1
+            elif self.merge_group_size and i + 1 >= self.merge_group_size:
+                full_at = i + 1
+        return 0
+
+    def ready_group(self):
+        """
+        The next group to merge after those already merging, or None:
+        - Prefer full groups (see next_group_size).
+        - A short group is only merged once no segment has arrived for at
+          least MERGE_IDLE_LIMIT seconds, or the playlist has ended.
+        """
+        start = self.merging_size()
+        if len(self.pending_ts) <= start or time.time() < self.merge_retry_at:
+            return None
+        size = self.next_group_size(start)
+        if not size:
+            # skip short groups unless the downloader has been idle for MERGE_IDLE_LIMIT
+            group_idle = time.time() - self.last_segment_time
+            if group_idle < self.merge_idle_limit and not self.downloads_finished:
+                return None
+            size = len(self.pending_ts) - start
+        return self.pending_ts[start : start + size]
 
-            # create a unique concat list file for this merge
-            list_file = f"{mp4_name}.concat.txt"
+    def merging_size(self) -> int:
+        """Pending segments that belong to groups being merged."""
+        return sum(len(entry[0]) for entry in self.merging)
+
+    def group_done(self, group, ok: bool, seconds=None):
+        if seconds is not None:
+            self.stats.observe("merge_seconds", seconds)
+        if ok:
+            merged = {id(segment) for segment in group}
+            self.pending_ts = [s for s in self.pending_ts if id(s) not in merged]
+            self.stats.inc("merges_total")
+            self.stats.set("merge_queue_depth", len(self.pending_ts))
+        else:
+            # keep ts files for retry in a little while
+            self.merge_retry_at = time.time() + 10
+            self.stats.inc("merge_failures_total")
+
+    def merge_ts_to_mp4(self):
+        """
+        Merge ready groups, .ts → .mp4, up to merge_limit at a time. Each
+        ffmpeg -c copy uses one core and mostly waits on the disk, so a
+        backlog drains in parallel; finished MP4s still go to the uploader in
+        group order. Returns without waiting for the merges.
+        """
+        self.hand_off_merges()
+        while len(self.merging) < self.merge_limit:
+            group = self.ready_group()
+            if group is None:
+                return
+            self.merging.append([group, self.start_merge(group), len(self.merging) + 1, 0])
+
+    def start_merge(self, group):
+        """Run merge_group() in the background; returns its future."""
+        return self.merge_pool.submit(self.timed_merge, group)
+
+    def timed_merge(self, group):
+        started = time.time()
+        ok, mp4_name = self.merge_group(group)
+        return ok, mp4_name, time.time() - started
+
+    def hand_off_merges(self, wait=False):
+        """
+        Pass finished merges on in group order. A failed merge is retried
+        before anything behind it is handed on; after merge_attempts failures
+        the group is split in two to corner the bad segment, which is then
+        dropped (see give_up_merge). With wait, block for the merges still
+        running.
+        """
+        while self.merging:
+            entry = self.merging[0]
+            group, future, in_flight, failures = entry
+            if future is None:
+                # failed earlier: retry once the back-off is over
+                if time.time() >= self.merge_retry_at:
+                    entry[1] = self.start_merge(group)
+                return
+            if not wait and not future.done():
+                return
             try:
-                with open(list_file, "w", encoding="utf-8") as f:
-                    for ts in group:
-                        # ffmpeg concat demuxer expects paths; wrap in single quotes and escape single quotes inside
-                        safe_path = ts.replace("'", "'\\''")
-                        f.write(f"file '{safe_path}'\n")
-
-                print(f"🎞️ Merging {len(group)} segments → {os.path.basename(mp4_name)}")
-                cmd = [
-                    "ffmpeg",
-                    "-y",
-                    "-f",
-                    "concat",
-                    "-safe",
-                    "0",
-                    "-i",
-                    list_file,
-                    "-c",
-                    "copy",
-                    mp4_name,
-                ]
-                proc = subprocess.run(
-                    cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE
-                )
-                if proc.returncode != 0:
-                    print(
-                        f"❌ ffmpeg failed for {mp4_name}. stderr:\n{proc.stderr.decode(errors='ignore')}"
-                    )
-                    # keep ts files for retry
+                ok, mp4_name, seconds = future.result()
+            except Exception as e:
+                print(f"❌ Merge error: {e}")
+                ok, mp4_name, seconds = False, None, None
+            if not ok:
+                self.group_done(group, False, seconds)
+                entry[1] = None
+                entry[3] += 1
+                if entry[3] < self.merge_attempts:
+                    return
+                self.merging.popleft()
+                self.merge_retry_at = 0
+                if len(group) > 1:
+                    half = len(group) // 2
+                    self.merging.extendleft([[group[half:], None, 1, 0], [group[:half], None, 1, 0]])
                 else:
-                    print(f"✅ Merged to {os.path.basename(mp4_name)}")
-                    # remove merged .ts files only on success
-                    for ts in group:
-                        try:
-                            if os.path.exists(ts):
-                                os.remove(ts)
-                        except Exception as e:
-                            print(f"⚠️ Could not remove {ts}: {e}")
-            finally:
-                try:
-                    if os.path.exists(list_file):
-                        os.remove(list_file)
-                except Exception:
-                    pass
+                    self.give_up_merge(group[0])
+                continue
+            self.merging.popleft()
+            self.group_done(group, True, seconds)
+            self.tune_merge_limit(sum(segment.size for segment in group), seconds, in_flight)
+            if mp4_name is not None:
+                self.mp4_ready(mp4_name)
 
-    def load_sent_status(self) -> dict:
-        """Load the status of files sent to Telegram."""
-        if os.path.exists(self.sent_json_file):
-            try:
-                with open(self.sent_json_file, "r", encoding="utf-8") as f:
-                    return json.load(f)
-            except Exception:
-                return {}
-        return {}
-
-    def save_sent_status(self, status_dict: dict):
-        """Save the status of files sent to Telegram."""
-        with open(self.sent_json_file, "w", encoding="utf-8") as f:
-            json.dump(status_dict, f, indent=4)
-
-    def send_to_telegram(self, file_path: str) -> bool:
-        """Send a file to Telegram chat."""
-        url = f"https://api.telegram.org/bot{self.telegram_bot_token}/sendDocument"
-        while True:
+    def give_up_merge(self, segment):
+        """Drop a segment ffmpeg keeps failing on, and record it in gaps.jsonl."""
+        print(f"🗑️ Giving up on {os.path.basename(segment.path)}: ffmpeg keeps failing on it")
+        self.pending_ts = [s for s in self.pending_ts if s is not segment]
+        self.remove_quietly(segment.path)
+        self.stage(-segment.size)
+        with self.lock:
+            if segment.sequence is not None:
+                self.ledger.retire(segment.sequence)
+            self.lost.append((segment, "merge failed"))
+        self.record_gaps()
+
+    def tune_merge_limit(self, nbytes: int, seconds: float, in_flight: int):
+        """
+        Adapt how many merges run at once to what the disk sustains: while n
+        parallel merges move clearly more bytes per second in total than n - 1
+        did, allow one more (up to merge_workers); once they do not, step back.
+        """
+        if not seconds or not nbytes:
+            return
+        rate = nbytes / seconds
+        old = self.merge_rates.get(in_flight)
+        rate = self.merge_rates[in_flight] = rate if old is None else old + 0.3 * (rate - old)
+        below = self.merge_rates.get(in_flight - 1)
+        if below is not None and in_flight * rate < 1.1 * (in_flight - 1) * below:
+            self.merge_limit = max(1, in_flight - 1)
+        elif in_flight >= self.merge_limit and self.merge_limit < self.merge_workers:
+            self.merge_limit += 1
+
+    def write_concat_list(self, paths, mp4_name: str) -> str:
+        """Write the ffmpeg concat list for a merge and return its path."""
+        # create a unique concat list file for this merge
+        list_file = f"{mp4_name}.concat.txt"
+        with open(list_file, "w", encoding="utf-8") as f:
+            for ts in paths:
+                # ffmpeg concat demuxer expects paths; wrap in single quotes and escape single quotes inside
+                safe_path = ts.replace("'", "'\\''")
+                f.write(f"file '{safe_path}'\n")
+        return list_file
+
+    def concat_command(self, list_file: str, mp4_name: str):
+        return [
+            "ffmpeg",
+            "-y",
+            "-f",
+            "concat",
+            "-safe",
+            "0",
+            "-i",
+            list_file,
+            "-c",
+            "copy",
+            "-f",
+            "mp4",
+            mp4_name + ".part",  # renamed by finish_merge once complete
+        ]
+
+    def finish_merge(self, paths, mp4_name: str, returncode: int, stderr: bytes) -> bool:
+        """Act on an ffmpeg result: keep the MP4, or keep the .ts files for a retry."""
+        if returncode != 0:
+            print(
+                f"❌ ffmpeg failed for {mp4_name}. stderr:\n{stderr.decode(errors='ignore')}"
+            )
+            self.remove_quietly(mp4_name + ".part")
+            return False
+
+        # only a complete MP4 ever carries the final name
+        os.replace(mp4_name + ".part", mp4_name)
+        print(f"✅ Merged to {os.path.basename(mp4_name)}")
+        self.segments_merged(paths, mp4_name)
+        return True
+
+    def segments_merged(self, paths, mp4_name: str):
+        """The group's .ts files are in mp4_name now: unstage and remove them."""
+        self.stage(-sum(self.file_size(ts) for ts in paths))
+        with self.lock:
+            self.ledger.mark_merged(mp4_name, paths)
+            if self.sent.is_sent(os.path.basename(mp4_name)):
+                # merged and sent by an earlier run: nothing will release them
+                self.ledger.mark_uploaded(mp4_name)
+        # remove merged .ts files only on success
+        for ts in paths:
             try:
-                with open(file_path, "rb") as f:
-                    to_send_caption = (
-                        file_path
-                        if not self.caption_prefix
-                        else f"{self.caption_prefix}_{file_path.replace(self.work_dir + '/', '')}"
-                    )
-                    response = requests.post(
-                        url,
-                        data={
-                            "chat_id": self.telegram_chat_id,
-                            "caption": to_send_caption,
-                        },
-                        files={"document": f},
-                        timeout=120,
-                    )
-                if response.status_code == 200:
-                    return True
-                else:
-                    print(f"Telegram responded {response.status_code}: {response.text}")
+                if os.path.exists(ts):
+                    os.remove(ts)
             except Exception as e:
-                print(f"⚠️ Telegram send error for {file_path}: {e}")
-            print(f"Retrying {file_path} in 5s...")
-            time.sleep(5)
+                print(f"⚠️ Could not remove {ts}: {e}")
+
+    def file_size(self, path: str) -> int:
+        try:
+            return os.path.getsize(path)
+        except OSError:
+            return 0
+
+    def stage(self, nbytes: int):
+        """Account for bytes added to (or, negative, removed from) the disk budget."""
+        with self.lock:
+            self.staged_bytes += nbytes
+            staged = self.staged_bytes
+        self.stats.set("staged_bytes", staged)
+
+    def downloads_paused(self) -> bool:
+        """With the "pause" policy, hold off new downloads while the disk budget is used up."""
+        if not self.disk_budget or self.shed_policy != "pause":
+            return False
+        full = self.staged_bytes >= self.disk_budget
+        if full:
+            self.polls_held = True
+        if full != self.downloads_held:
+            self.downloads_held = full
+            if full:
+                print(
+                    f"⏸️ Disk budget full ({self.staged_bytes // 1000000} MB staged), "
+                    "pausing downloads"
+                )
+            else:
+                print("▶️ Back under the disk budget, resuming downloads")
+        return full
 
-    def process_files(self):
-        """Process and send MP4 files to Telegram."""
-        status = self.load_sent_status()
-        now = time.time()
+    def shed_load(self):
+        """
+        With the "drop_oldest" policy, delete the oldest unsent MP4, then the
+        oldest segment waiting to be merged, until back under the disk budget.
+        """
+        if not self.disk_budget or self.shed_policy != "drop_oldest":
+            return
+        while self.staged_bytes > self.disk_budget:
+            with self.lock:
+                victim = self.unsent.pop(0) if self.unsent else None
+            if victim is not None:
+                size = self.file_size(victim)
+                self.remove_quietly(victim)
+                self.sent.record(os.path.basename(victim), dropped=True)
+                with self.lock:
+                    self.ledger.mark_uploaded(victim)
+            elif len(self.pending_ts) > self.merging_size():
+                segment = self.pending_ts.pop(self.merging_size())
+                victim, size = segment.path, segment.size
+                self.remove_quietly(victim)
+                with self.lock:
+                    if segment.sequence is not None:
+                        self.ledger.retire(segment.sequence)
+            else:
+                return
+            self.stage(-size)
+            self.stats.inc("shed_files_total")
+            print(f"🗑️ Over the disk budget, dropped {os.path.basename(victim)}")
 
-        all_files = sorted([f for f in os.listdir(self.work_dir) if f.endswith(".mp4")])
+    def remove_quietly(self, path: str):
+        self.spools.pop(path, None)
+        try:
+            if os.path.exists(path):
+                os.remove(path)
+        except Exception:
+            pass
 
-        for f in all_files:
-            if f not in status:
-                status[f] = {"first_seen": now, "sent": False}
+    def merge_group(self, group):
+        """
+        Merge one group of segments into an MP4. Returns (ok, the new MP4 or
+        None when the group had been merged already).
+        """
+        prepared = self.prepare_merge(group)
+        if prepared is None:
+            return True, None
+        paths, mp4_name, list_file = prepared
+        try:
+            proc = subprocess.run(
+                self.concat_command(list_file, mp4_name),
+                stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE,
+            )
+            ok = self.finish_merge(paths, mp4_name, proc.returncode, proc.stderr)
+            return ok, mp4_name if ok else None
+        finally:
+            self.remove_quietly(list_file)
+
+    def prepare_merge(self, group):
+        """
+        Set up a group's merge: (paths, mp4 name, concat list file), or None
+        when its MP4 exists already (queued for upload by recover_leftovers),
+        in which case the segments are released here.
+        """
+        paths = [segment.path for segment in group]
+        mp4_name = self.mp4_name_for(paths[0])
+        if os.path.exists(mp4_name):
+            self.segments_merged(paths, mp4_name)
+            return None
+        self.remember_media_end(group, mp4_name)
+        list_file = self.write_concat_list(paths, mp4_name)
+        print(f"🎞️ Merging {len(paths)} segments → {os.path.basename(mp4_name)}")
+        return paths, mp4_name, list_file
 
-        unsent = [f for f in all_files if not status.get(f, {}).get("sent", False)]
+    def mp4_name_for(self, first_ts: str) -> str:
+        """MP4 path for a group: named after its first segment, in work_dir."""
+        return os.path.join(
+            self.work_dir, os.path.basename(first_ts).rsplit(".", 1)[0] + ".mp4"
+        )
 
-        if len(unsent) > 5:
-            base_files = unsent[:-5]
-            tail_files = unsent[-5:]
-        else:
-            base_files, tail_files = [], unsent
+    def remember_media_end(self, group, mp4_name: str):
+        """Note when the last frame of a group aired, for the live-edge latency."""
+        ends = [
+            s.program_date_time + s.duration
+            for s in group
+            if s.program_date_time is not None
+        ]
+        if ends:
+            self.media_ends[os.path.basename(mp4_name)] = max(ends)
+
+    def mp4_ready(self, mp4_name: str):
+        """Hand a finished MP4 to the uploader."""
+        self.last_activity = time.time()
+        f = os.path.basename(mp4_name)
+        if f not in self.sent:
+            self.sent.record(f, first_seen=time.time(), sent=False)
+        with self.lock:
+            self.unsent.append(mp4_name)
+        self.stage(self.file_size(mp4_name))
+        if self.merge_mode == "stream" and self.stream_media_end is not None:
+            # ffmpeg may still hold part of the last segment fed, so this is a lower bound
+            self.media_ends[f] = self.stream_media_end
+        self.uploader.submit(
+            self.telegram_chat_id,
+            mp4_name,
+            self.caption_for(mp4_name),
+            on_sent=self.upload_done,
+            on_failed=self.upload_failed,
+            owner=self,
+        )
+        self.stats.set("upload_queue_depth", self.uploader.pending(owner=self))
+
+    def caption_for(self, file_path: str) -> str:
+        """Caption shown under the document in Telegram."""
+        if not self.caption_prefix:
+            return file_path
+        return f"{self.caption_prefix}_{file_path.replace(self.work_dir + '/', '')}"
+
+    def upload_done(self, job):
+        """Uploader callback: record the sent MP4 in the sent ledger."""
+        self.stats.observe("upload_seconds", job.send_seconds)
+        if job.attempts > 1:
+            self.stats.inc("upload_retries_total", job.attempts - 1)
+        self.record_sent(job.file_path)
+        self.stats.set("upload_queue_depth", self.uploader.pending(owner=self))
 
-        files_to_send = list(base_files)
-        for f in tail_files:
-            if now - status[f]["first_seen"] > 180:
-                files_to_send.append(f)
+    def upload_failed(self, job):
+        """Uploader callback: the MP4 was rejected for good, or is gone."""
+        self.drop_upload(job.file_path)
+        self.stats.set("upload_queue_depth", self.uploader.pending(owner=self))
 
-        for f in files_to_send:
-            file_path = os.path.join(self.work_dir, f)
-            if self.send_to_telegram(file_path):
-                print(f"✅ Sent: {f}")
-                status[f]["sent"] = True
+    def drop_upload(self, file_path: str):
+        """
+        Stop tracking an MP4 that will never be sent. The file (if any) stays
+        on disk for a later run or by hand, but no longer holds the disk
+        budget or the segment ledger.
+        """
+        f = os.path.basename(file_path)
+        self.sent.record(f, failed=True)
+        self.release_upload(file_path)
 
-        self.save_sent_status(status)
+    def release_upload(self, file_path: str):
+        """Free the ledger entries and disk budget an MP4 held until upload."""
+        f = os.path.basename(file_path)
+        with self.lock:
+            self.ledger.mark_uploaded(f)
+            unsent = [p for p in self.unsent if os.path.basename(p) != f]
+            # an MP4 shed while it was uploading is already off the budget
+            was_staged = len(unsent) < len(self.unsent)
+            self.unsent = unsent
+        if was_staged:
+            self.stage(-self.file_size(file_path))
+
+    def record_sent(self, file_path: str):
+        f = os.path.basename(file_path)
+        print(f"✅ Sent: {f}")
+        self.last_activity = time.time()
+        self.sent.record(f, sent=True)
+        self.release_upload(file_path)
+        self.stats.inc("uploads_total")
+        media_end = self.media_ends.pop(f, None)
+        if media_end is not None:
+            self.stats.observe("live_edge_latency_seconds", time.time() - media_end)
+
+    def save_checkpoint(self, force=False):
+        """Write checkpoint.json every checkpoint_interval seconds, or now with force."""
+        if not force and time.time() < self.checkpoint_at:
+            return
+        self.checkpoint_at = time.time() + self.checkpoint_interval
+        with self.lock:
+            uploads = [os.path.basename(p) for p in self.unsent]
+        try:
+            self.checkpoint.save(self.stream_url, self.next_sequence, self.pending_ts, uploads)
+        except OSError as e:
+            print(f"⚠️ Could not write checkpoint: {e}")
 
     def cleanup(self):
-        """Clean up temporary and .ts files."""
-        for f in os.listdir(self.work_dir):
-            if f.endswith(".ts") or f.endswith(".part"):
-                try:
-                    os.remove(os.path.join(self.work_dir, f))
-                except Exception:
-                    pass
+        """
+        Clean up temporary files and .ts files that are not in the checkpoint
+        (those wait there for the next run).
+        """
+        keep = {s.path for s in self.pending_ts}
+        for d in {self.work_dir, self.staging_dir}:
+            for f in os.listdir(d):
+                path = os.path.join(d, f)
+                if f.endswith(".part") or (f.endswith(".ts") and path not in keep):
+                    try:
+                        os.remove(path)
+                    except Exception:
+                        pass
+        self.checkpoint.close()
 
     def run(self, timeout_hours=2.5):
         """
@@ -359,25 +1898,28 @@ class M3U8TSToTG:
         """
         timeout_seconds = timeout_hours * 3600
         start_time = time.time()
-        last_new_file_time = start_time
+        self.last_activity = start_time
 
-        print("🚀 Starting background download thread...")
+        self.sent = SentLedger(self.sent_json_file)
+        self.recover_leftovers()
+        if self.metrics_port:
+            self.metrics_server = self.metrics.serve(self.metrics_port)
+
+        print("🚀 Starting background download and upload threads...")
         t = threading.Thread(target=self.download_worker, daemon=True)
         t.start()
+        self.uploader.start()
 
         try:
             while True:
-                before = set(os.listdir(self.work_dir))
-
+                # block until the downloader hands over segments (or 1s passes)
+                self.collect_segments(timeout=1)
                 self.merge_ts_to_mp4()
-                self.process_files()
-
-                after = set(os.listdir(self.work_dir))
-                if after != before:
-                    last_new_file_time = time.time()
+                self.shed_load()
+                self.save_checkpoint()
 
                 elapsed = time.time() - start_time
-                idle_time = time.time() - last_new_file_time
+                idle_time = time.time() - self.last_activity
 
                 if elapsed > timeout_seconds:
                     print(f"⏱️ {timeout_hours} hours elapsed — stopping.")
@@ -385,12 +1927,34 @@ class M3U8TSToTG:
                 if idle_time > timeout_seconds:
                     print(f"🕒 Idle {timeout_hours} hours — stopping.")
                     break
-
-                # sleep a bit so loop is not tight
-                time.sleep(10)
+                if self.drained():
+                    print("🏁 Everything merged and sent — stopping.")
+                    break
 
         finally:
             self.stop_event.set()
             t.join(timeout=5)
+            # let running merges finish so their MP4s are queued in order
+            self.hand_off_merges(wait=True)
+            if self.owns_download_pool:
+                self.download_pool.shutdown(wait=False)
+            self.hedge_pool.shutdown(wait=False)
+            if self.owns_merge_pool:
+                self.merge_pool.shutdown(wait=False)
+            self.flush_stream(everything=True)
+            if self.remuxer is not None:
+                self.remuxer.close()
+            # the sent ledger closes below: no upload of ours may finish after
+            # that (cancelled ones stay in the checkpoint for the next run)
+            if not self.uploader.drain(self):
+                print("⚠️ An upload is still in flight; it will not be recorded as sent")
+            if self.owns_uploader:
+                self.uploader.stop()
+            if self.metrics_server is not None:
+                self.metrics_server.shutdown()
+            # keep what the downloader finished for the next run
+            self.collect_segments(timeout=0)
+            self.save_checkpoint(force=True)
+            self.sent.close()
             self.cleanup()
             print("🧹 Cleaned .ts files. ✅ Done.")
@@ -0,0 +1,209 @@
+import bisect
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+
+PREFIX = "m3u8tg_"
+
+# bucket upper bounds; +Inf is implied
+SECONDS_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+RATE_BUCKETS = tuple(x * 1000 * 1000 / 8 for x in (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000))
+
+# help text, type and buckets of every metric the pipeline reports
+METRICS = {
+    "playlist_fetch_seconds": ("Playlist GET latency", "histogram", SECONDS_BUCKETS),
+    "playlist_fetch_errors_total": ("Failed playlist fetches", "counter", None),
+    "segments_downloaded_total": ("Segments downloaded", "counter", None),
+    "segment_bytes_total": ("Segment bytes written to disk", "counter", None),
+    "segment_download_failures_total": ("Segments given up on", "counter", None),
+    "segment_fetch_seconds": ("Duration of one whole-segment GET, per host", "histogram", SECONDS_BUCKETS),
+    "hedged_requests_total": ("Segment fetches that got a second, hedging request", "counter", None),
+    "hedge_wins_total": ("Hedged fetches the hedging request finished first", "counter", None),
+    "mirror_failovers_total": ("Segment retries sent to another host", "counter", None),
+    "segment_bytes_per_second": ("Download throughput per poll", "histogram", RATE_BUCKETS),
+    "gap_segments_total": ("Segments that left the live window between two polls", "counter", None),
+    "backfilled_segments_total": ("Gap segments recovered under guessed URIs", "counter", None),
+    "lost_segments_total": ("Segments missing from the recording (see gaps.jsonl)", "counter", None),
+    "download_queue_depth": ("Segment fetches in flight", "gauge", None),
+    "merge_queue_depth": ("Downloaded segments waiting to be merged", "gauge", None),
+    "merge_seconds": ("ffmpeg merge duration", "histogram", SECONDS_BUCKETS),
+    "merges_total": ("Successful merges", "counter", None),
+    "merge_failures_total": ("Failed merges", "counter", None),
+    "upload_seconds": ("Duration of the successful sendDocument call", "histogram", SECONDS_BUCKETS),
+    "uploads_total": ("Files sent to Telegram", "counter", None),
+    "upload_retries_total": ("Upload attempts that had to be retried", "counter", None),
+    "upload_queue_depth": ("Files waiting for upload", "gauge", None),
+    "staged_bytes": ("Segments and unsent MP4s on disk, against the disk budget", "gauge", None),
+    "shed_files_total": ("Files deleted to stay within the disk budget", "counter", None),
+    "live_edge_latency_seconds": (
+        "From the end of the media (PROGRAM-DATE-TIME) to its upload finishing",
+        "histogram",
+        SECONDS_BUCKETS,
+    ),
+}
+
+
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def cumulative(self):
+        """(upper bound, observations <= bound) pairs, ending with +Inf."""
+        total = 0
+        for bound, n in zip(list(self.buckets) + [float("inf")], self.counts):
+            total += n
+            yield bound, total
+
+
+class Metrics:
+    """
+    Counters, gauges and histograms of the pipeline stages.
+
+    One instance can be shared by many streams; every sample carries its
+    labels (usually just `stream`). labels() returns a view that fills them
+    in. snapshot() gives everything as plain JSON-able data and render() the
+    Prometheus text format, both also served over HTTP by serve().
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.values = {}  # (name, labels) -> number or Histogram
+
+    def labels(self, **labels) -> "BoundMetrics":
+        return BoundMetrics(self, labels)
+
+    def key(self, name, labels):
+        if name not in METRICS:
+            raise KeyError(f"unknown metric {name}")
+        return name, tuple(sorted(labels.items()))
+
+    def inc(self, name, value=1, **labels):
+        key = self.key(name, labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        key = self.key(name, labels)
+        with self.lock:
+            self.values[key] = value
+
+    def observe(self, name, value, **labels):
+        key = self.key(name, labels)
+        with self.lock:
+            histogram = self.values.get(key)
+            if histogram is None:
+                histogram = self.values[key] = Histogram(METRICS[name][2])
+            histogram.observe(value)
+
+    def snapshot(self) -> dict:
+        """
+        {name: [{"labels": {...}, "value": n}, ...]}; histogram values are
+        {"count": ..., "sum": ..., "buckets": {"0.5": cumulative count, ...}}.
+        """
+        result = {}
+        with self.lock:
+            for (name, labels), value in sorted(self.values.items(), key=lambda x: x[0]):
+                if isinstance(value, Histogram):
+                    value = {
+                        "count": value.count,
+                        "sum": value.sum,
+                        "buckets": {format_bound(b): n for b, n in value.cumulative()},
+                    }
+                result.setdefault(name, []).append({"labels": dict(labels), "value": value})
+        return result
+
+    def render(self) -> str:
+        """Prometheus text exposition format."""
+        lines = []
+        for name, samples in self.snapshot().items():
+            help_text, kind, _ = METRICS[name]
+            lines.append(f"# HELP {PREFIX}{name} {help_text}")
+            lines.append(f"# TYPE {PREFIX}{name} {kind}")
+            for sample in samples:
+                labels = sample["labels"]
+                value = sample["value"]
+                if kind != "histogram":
+                    lines.append(f"{PREFIX}{name}{format_labels(labels)} {value}")
+                    continue
+                for bound, n in value["buckets"].items():
+                    le = format_labels(dict(labels, le=bound))
+                    lines.append(f"{PREFIX}{name}_bucket{le} {n}")
+                lines.append(f"{PREFIX}{name}_sum{format_labels(labels)} {value['sum']}")
+                lines.append(f"{PREFIX}{name}_count{format_labels(labels)} {value['count']}")
+        return "\n".join(lines) + "\n"
+
+    def serve(self, port: int, host: str = "127.0.0.1"):
+        """
+        Serve /metrics (Prometheus) and /metrics.json (snapshot) from a daemon
+        thread. Returns the server; call shutdown() on it to stop.
+        """
+        metrics = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path == "/metrics":
+                    body = metrics.render().encode()
+                    content_type = "text/plain; version=0.0.4"
+                elif self.path == "/metrics.json":
+                    body = json.dumps(metrics.snapshot()).encode()
+                    content_type = "application/json"
+                else:
+                    self.send_error(404)
+                    return
+                self.send_response(200)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        server = MetricsServer((host, port), Handler)
+        threading.Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+        print(f"📈 Metrics on http://{host}:{server.server_address[1]}/metrics")
+        return server
+
+
+class MetricsServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class BoundMetrics:
+    """Metrics with some labels already filled in; more can be passed per sample."""
+
+    def __init__(self, metrics: Metrics, labels: dict):
+        self.metrics = metrics
+        self.labels = labels
+
+    def inc(self, name, value=1, **labels):
+        self.metrics.inc(name, value, **self.labels, **labels)
+
+    def set(self, name, value, **labels):
+        self.metrics.set(name, value, **self.labels, **labels)
+
+    def observe(self, name, value, **labels):
+        self.metrics.observe(name, value, **self.labels, **labels)
+
+
+def format_bound(bound: float) -> str:
+    return "+Inf" if bound == float("inf") else repr(float(bound))
+
+
+def format_labels(labels: dict) -> str:
+    if not labels:
+        return ""
+    escaped = (
+        (k, str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+        for k, v in labels.items()
+    )
+    return "{" + ",".join(f'{k}="{v}"' for k, v in escaped) + "}"
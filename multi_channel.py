@@ -0,0 +1,145 @@
+import json
+import os
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from m3u8_ts_to_tg import BandwidthLimiter, M3U8TSToTG, make_session
+from metrics import Metrics
+from telegram_uploader import TelegramUploader
+
+# Keys of a stream entry that are passed straight to M3U8TSToTG
+STREAM_OPTIONS = (
+    "caption_prefix",
+    "merge_group_size",
+    "merge_mode",
+    "merge_target_duration",
+    "merge_max_bytes",
+    "merge_workers",
+    "disk_budget",
+    "shed_policy",
+    "staging_dir",
+    "mirrors",
+    "hedge_quantile",
+    "rendition_policy",
+    "max_height",
+    "max_bandwidth",
+)
+
+
+class MultiChannelRunner:
+    """
+    Records many live streams in one process.
+
+    Every stream gets its own M3U8TSToTG (own work dir, playlist poller and
+    sent ledger), but they all share one HTTP connection pool, one segment
+    download pool, one ffmpeg merge pool, one Telegram uploader and an
+    optional bandwidth cap. The global limits therefore hold no matter how
+    many streams are configured.
+
+    Config (JSON):
+        {
+            "telegram_bot_token": "...",        # default: $TELEGRAM_BOT_TOKEN
+            "download_concurrency": 16,         # segment fetches in flight, all streams
+            "max_connections_per_host": 6,
+            "merge_concurrency": 2,             # ffmpeg merges at once, all streams
+            "upload_concurrency": 4,            # Telegram uploads at once, all chats
+            "chat_upload_concurrency": 1,       # uploads at once per chat; >1 may reorder files
+            "telegram_api_base": "http://127.0.0.1:8081",  # optional self-hosted Bot API
+            "telegram_local_mode": true,        # it runs with --local: send paths, 2000 MB cap
+            "bandwidth_limit_mbps": 200,        # optional download cap
+            "metrics_port": 9464,               # optional Prometheus endpoint, all streams
+            "timeout_hours": 2.5,
+            "streams": [
+                {"m3u8_url": "...", "telegram_chat_id": "-100...",
+                 "caption_prefix": "kick", "merge_group_size": 5,
+                 "work_dir": "channel1", "rendition_policy": "adaptive",
+                 "max_height": 720}
+            ]
+        }
+    """
+
+    def __init__(self, config: dict):
+        self.config = config
+        token = config.get("telegram_bot_token") or os.getenv("TELEGRAM_BOT_TOKEN")
+        download_concurrency = config.get("download_concurrency", 16)
+        max_per_host = config.get("max_connections_per_host", 6)
+
+        self.session = make_session(download_concurrency, max_per_host)
+        self.download_pool = ThreadPoolExecutor(
+            max_workers=download_concurrency, thread_name_prefix="segment"
+        )
+        self.merge_pool = ThreadPoolExecutor(
+            max_workers=config.get("merge_concurrency", os.cpu_count() or 2),
+            thread_name_prefix="merge",
+        )
+        self.uploader = TelegramUploader(
+            token,
+            workers=config.get("upload_concurrency", 4),
+            api_base=config.get("telegram_api_base", "https://api.telegram.org"),
+            local_mode=config.get("telegram_local_mode", False),
+            per_chat_concurrency=config.get("chat_upload_concurrency", 1),
+        )
+        self.bandwidth_limiter = None
+        if config.get("bandwidth_limit_mbps"):
+            self.bandwidth_limiter = BandwidthLimiter(
+                config["bandwidth_limit_mbps"] * 1000 * 1000 / 8
+            )
+
+        self.metrics = Metrics()
+        self.metrics_server = None
+
+        self.processors = []
+        for i, stream in enumerate(config["streams"], 1):
+            work_dir = stream.get("work_dir", f"channel{i}")
+            os.makedirs(work_dir, exist_ok=True)
+            options = {k: stream[k] for k in STREAM_OPTIONS if k in stream}
+            self.processors.append(
+                M3U8TSToTG(
+                    m3u8_url=stream["m3u8_url"],
+                    telegram_bot_token=token,
+                    telegram_chat_id=stream["telegram_chat_id"],
+                    work_dir=work_dir,
+                    download_concurrency=download_concurrency,
+                    max_connections_per_host=max_per_host,
+                    uploader=self.uploader,
+                    session=self.session,
+                    download_pool=self.download_pool,
+                    merge_pool=self.merge_pool,
+                    bandwidth_limiter=self.bandwidth_limiter,
+                    metrics=self.metrics,
+                    **options,
+                )
+            )
+
+    def run(self):
+        timeout_hours = self.config.get("timeout_hours", 2.5)
+        print(f"🚀 Recording {len(self.processors)} streams")
+        if self.config.get("metrics_port"):
+            self.metrics_server = self.metrics.serve(self.config["metrics_port"])
+        self.uploader.start()
+        threads = [
+            threading.Thread(
+                target=p.run, kwargs={"timeout_hours": timeout_hours}, daemon=True
+            )
+            for p in self.processors
+        ]
+        try:
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+        finally:
+            for p in self.processors:
+                p.stop_event.set()
+            self.uploader.stop()
+            self.download_pool.shutdown(wait=False)
+            self.merge_pool.shutdown(wait=False)
+            if self.metrics_server is not None:
+                self.metrics_server.shutdown()
+
+
+if __name__ == "__main__":
+    config_file = sys.argv[1] if len(sys.argv) > 1 else "channels.json"
+    with open(config_file, "r", encoding="utf-8") as f:
+        MultiChannelRunner(json.load(f)).run()
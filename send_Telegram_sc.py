@@ -1,9 +1,8 @@
 import os
-import json
 import time
-import subprocess
 import requests
-import subprocess
+from sent_ledger import SentLedger
+from incremental_segmenter import IncrementalSegmenter
 
 # time.sleep(20)
 # https://www.showroom-live.com/api/live/streaming_url?room_id=190685&abr_available=1
@@ -14,56 +13,27 @@ TELEGRAM_CHAT_ID = os.environ["TELEGRAM_CHAT_ID"]
 
 # JSON 文件存储每个文件的状态（首次出现时间 + 是否已发送）
 SENT_JSON_FILE = "sent.json"
+sent = SentLedger(SENT_JSON_FILE)
 
 
-# FFmpeg 命令
-FFMPEG_COMMAND = [
-    "ffmpeg",
-    #"-decryption_key",
-    #"54506ff0bc8e6c75ed657efed5e70d3a",
-    "-i",
+# FFmpeg 增量切片：每轮只处理文件新增的部分，已完成的 mp4 不再重写
+segmenter = IncrementalSegmenter(
     "chunklist.mp4",
-    "-c",
-    "copy",
-    "-segment_time",
-    "10",
-    "-f",
-    "segment",
-    "-reset_timestamps",
-    "1",
-    "output%08d.mp4",
-]
+    output_pattern="output%08d.mp4",
+    segment_time=10,
+    input_args=[
+        #"-decryption_key",
+        #"54506ff0bc8e6c75ed657efed5e70d3a",
+    ],
+)
 
 
 def run_ffmpeg():
-    """运行 FFmpeg 命令并覆盖已有的 mp4 文件"""
-    try:
-        subprocess.run(
-            FFMPEG_COMMAND,
-            stdout=subprocess.DEVNULL,
-            stderr=subprocess.PIPE,
-            check=True,
-        )
-    except subprocess.CalledProcessError as e:
-        print("FFmpeg error output:")
-        print(e.stderr.decode())
+    """增量运行 FFmpeg，只切分上次之后新增的内容"""
+    if not segmenter.run():
         time.sleep(10)
 
 
-def load_sent_status():
-    """加载 sent.json 数据结构"""
-    if os.path.exists(SENT_JSON_FILE):
-        with open(SENT_JSON_FILE, "r") as f:
-            return json.load(f)
-    return {}
-
-
-def save_sent_status(status_dict):
-    """保存文件状态到 sent.json"""
-    with open(SENT_JSON_FILE, "w") as f:
-        json.dump(status_dict, f, indent=4)
-
-
 def send_to_telegram(file_path):
     """发送文件到 Telegram，直到成功为止"""
     url = f"https://api.telegram.org/bot{TELEGRAM_BOT_TOKEN}/sendDocument"
@@ -82,7 +52,6 @@ def send_to_telegram(file_path):
 
 def process_files():
     """处理并发送符合条件的 MP4 文件"""
-    status = load_sent_status()
     now = time.time()
 
     # 查找所有还存在于文件夹的 output mp4
@@ -92,11 +61,11 @@ def process_files():
 
     # 更新状态字典中未记录的文件，记录首次发现时间和是否已发送
     for f in all_files:
-        if f not in status:
-            status[f] = {"first_seen": now, "sent": False}
+        if f not in sent:
+            sent.record(f, first_seen=now, sent=False)
 
     # 找出未发送的文件
-    unsent_files = [f for f in all_files if not status.get(f, {}).get("sent", False)]
+    unsent_files = [f for f in all_files if not sent.is_sent(f)]
 
     # 分离最后五个
     if len(unsent_files) > 5:
@@ -110,18 +79,17 @@ def process_files():
 
     # 添加尾部文件：如果 first_seen 时间超过 180 秒
     for f in tail_files:
-        first_seen = status[f]["first_seen"]
+        first_seen = sent.get(f)["first_seen"]
         if now - first_seen > 180:
             files_to_send.append(f)
 
     # 发送文件
     for file_name in files_to_send:
-        if not status[file_name]["sent"]:
+        if not sent.is_sent(file_name):
             if send_to_telegram(file_name):
                 print(f"Sent: {file_name}")
-                status[file_name]["sent"] = True
-
-    save_sent_status(status)
+                # 只追加一行记录，不再整体重写 sent.json
+                sent.record(file_name, sent=True)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,101 @@
+import json
+import os
+import threading
+
+
+class SentLedger:
+    """
+    Durable record of which files have been sent to Telegram.
+
+    The state lives in two files: a snapshot (`sent.json`, same layout as
+    before: name -> {"first_seen": ..., "sent": ...}) and an append-only
+    journal next to it (`sent.json.journal`, one JSON object per line). Every
+    change appends and fsyncs a single line instead of rewriting the whole
+    file. Once the journal grows past `compact_every` lines it is folded into a
+    new snapshot, written to a temp file and swapped in with os.replace. A crash
+    can therefore only lose the line being written, and a torn last line is
+    skipped on load instead of throwing the whole history away.
+    """
+
+    def __init__(self, path, compact_every=1000):
+        self.path = path
+        self.journal_path = path + ".journal"
+        self.compact_every = compact_every
+        self.lock = threading.Lock()
+        self.entries = {}
+        self.journal_lines = 0
+        self.journal = None
+        self.load()
+
+    def load(self):
+        """Read the snapshot, replay the journal, then compact."""
+        if os.path.exists(self.path):
+            try:
+                with open(self.path, "r", encoding="utf-8") as f:
+                    self.entries = json.load(f)
+            except (OSError, ValueError) as e:
+                # with atomic compaction this only happens to hand-edited files
+                print(f"⚠️ Could not read {self.path} ({e}); relying on the journal")
+                self.entries = {}
+
+        if os.path.exists(self.journal_path):
+            with open(self.journal_path, "r", encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        # torn write from a crash: everything before it is intact
+                        continue
+                    name = record.pop("name", None)
+                    if name is not None:
+                        self.entries.setdefault(name, {}).update(record)
+
+        self.compact()
+
+    def compact(self):
+        """Fold the journal into a fresh snapshot and start an empty journal."""
+        tmp = self.path + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(self.entries, f, indent=4)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.path)
+
+        if self.journal is not None:
+            self.journal.close()
+        self.journal = open(self.journal_path, "w", encoding="utf-8")
+        self.journal_lines = 0
+
+    def __contains__(self, name) -> bool:
+        with self.lock:
+            return name in self.entries
+
+    def get(self, name, default=None):
+        with self.lock:
+            entry = self.entries.get(name)
+            return dict(entry) if entry is not None else default
+
+    def is_sent(self, name) -> bool:
+        with self.lock:
+            return self.entries.get(name, {}).get("sent", False)
+
+    def record(self, name, **fields):
+        """Update one entry and append the change to the journal."""
+        with self.lock:
+            if self.journal is None:
+                print(f"❌ {self.path} is closed, not recording {name}: {fields}")
+                return
+            self.entries.setdefault(name, {}).update(fields)
+            line = json.dumps(dict(fields, name=name), ensure_ascii=False)
+            self.journal.write(line + "\n")
+            self.journal.flush()
+            os.fsync(self.journal.fileno())
+            self.journal_lines += 1
+            if self.journal_lines >= self.compact_every:
+                self.compact()
+
+    def close(self):
+        with self.lock:
+            if self.journal is not None:
+                self.journal.close()
+                self.journal = None
@@ -0,0 +1,158 @@
+import os
+import re
+import subprocess
+import threading
+
+
+class StreamRemuxer:
+    """
+    One long-lived ffmpeg that turns a stream of .ts bytes into MP4 chunks.
+
+    Segment bytes are piped into ffmpeg's stdin in playlist order and the segment
+    muxer cuts the output into MP4 files of roughly `segment_seconds` each (on
+    keyframes). ffmpeg reports every finished chunk on stdout through
+    -segment_list; only then is the chunk renamed from `.mp4.part` to `.mp4`,
+    so nothing downstream ever sees a half-written file.
+    """
+
+    def __init__(self, work_dir, segment_seconds, prefix="stream", on_output=None):
+        self.work_dir = work_dir
+        self.segment_seconds = segment_seconds
+        self.prefix = prefix
+        self.on_output = on_output
+
+        self.proc = None
+        self.reader = None
+        self.lock = threading.Lock()  # serializes writes to ffmpeg's stdin
+        self.index_lock = threading.Lock()
+        self.next_index = self.find_next_index()
+        self.log_file = os.path.join(work_dir, f"{prefix}_remux.log")
+
+    def find_next_index(self) -> int:
+        """Continue numbering after chunks left by a previous run."""
+        pattern = re.compile(rf"^{re.escape(self.prefix)}_(\d+)\.mp4")
+        indexes = [
+            int(m.group(1))
+            for m in (pattern.match(f) for f in os.listdir(self.work_dir))
+            if m
+        ]
+        return max(indexes) + 1 if indexes else 0
+
+    def start(self):
+        """Spawn ffmpeg reading MPEG-TS from stdin."""
+        output = os.path.join(self.work_dir, f"{self.prefix}_%08d.mp4.part")
+        with self.index_lock:
+            start_number = self.next_index
+        cmd = [
+            "ffmpeg",
+            "-hide_banner",
+            "-loglevel",
+            "error",
+            "-f",
+            "mpegts",
+            "-i",
+            "pipe:0",
+            "-map",
+            "0",
+            "-c",
+            "copy",
+            "-f",
+            "segment",
+            "-segment_format",
+            "mp4",
+            "-segment_time",
+            str(self.segment_seconds),
+            "-segment_start_number",
+            str(start_number),
+            "-reset_timestamps",
+            "1",
+            "-segment_list",
+            "pipe:1",
+            "-segment_list_type",
+            "flat",
+            output,
+        ]
+        print(f"🎞️ Starting streaming remux at {self.prefix}_{start_number:08d}.mp4")
+        with open(self.log_file, "ab") as log:
+            self.proc = subprocess.Popen(
+                cmd,
+                stdin=subprocess.PIPE,
+                stdout=subprocess.PIPE,
+                stderr=log,
+            )
+        self.reader = threading.Thread(
+            target=self.read_finished, args=(self.proc,), daemon=True
+        )
+        self.reader.start()
+
+    def read_finished(self, proc):
+        """Rename every chunk ffmpeg reports as finished and hand it on."""
+        for line in proc.stdout:
+            name = os.path.basename(line.decode(errors="ignore").strip())
+            if not name:
+                continue
+            part = os.path.join(self.work_dir, name)
+            mp4_name = part[: -len(".part")] if part.endswith(".part") else part
+            try:
+                os.replace(part, mp4_name)
+            except OSError as e:
+                print(f"⚠️ Could not finalize {name}: {e}")
+                continue
+            with self.index_lock:
+                match = re.search(r"_(\d+)\.mp4$", mp4_name)
+                if match:
+                    self.next_index = max(self.next_index, int(match.group(1)) + 1)
+            print(f"✅ Remuxed to {os.path.basename(mp4_name)}")
+            if self.on_output:
+                self.on_output(mp4_name)
+
+    def feed(self, data: bytes, name: str = "segment"):
+        """Pipe one segment's bytes into ffmpeg."""
+        with self.lock:
+            if self.proc is None or self.proc.poll() is not None:
+                self.restart()
+            try:
+                self.proc.stdin.write(data)
+                self.proc.stdin.flush()
+            except (BrokenPipeError, OSError) as e:
+                print(f"❌ Streaming remux lost {name}: {e}")
+                self.restart()
+
+    def restart(self):
+        """(Re)start ffmpeg after it exited, keeping the chunk numbering going."""
+        if self.proc is not None:
+            self.stop()
+            # the unfinished chunk of the dead process is incomplete
+            for f in os.listdir(self.work_dir):
+                if f.startswith(self.prefix + "_") and f.endswith(".mp4.part"):
+                    try:
+                        os.remove(os.path.join(self.work_dir, f))
+                    except OSError:
+                        pass
+        self.start()
+
+    def stop(self):
+        """Close stdin so ffmpeg finalizes the last chunk, then wait for it."""
+        proc = self.proc
+        if proc is None:
+            return
+        try:
+            proc.stdin.close()
+        except OSError:
+            pass
+        try:
+            proc.wait(timeout=60)
+        except subprocess.TimeoutExpired:
+            proc.kill()
+            proc.wait()
+        if self.reader is not None:
+            self.reader.join(timeout=10)
+        if proc.returncode not in (0, None):
+            print(
+                f"❌ Streaming remux exited {proc.returncode}, see {self.log_file}"
+            )
+        self.proc = None
+
+    def close(self):
+        with self.lock:
+            self.stop()
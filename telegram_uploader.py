@@ -0,0 +1,319 @@
+import collections
+import os
+import threading
+import time
+from dataclasses import dataclass
+from typing import Callable, Optional
+
+import requests
+
+# sendDocument size limits: api.telegram.org, and a self-hosted Bot API
+# server started with --local
+CLOUD_UPLOAD_LIMIT = 50 * 1024 * 1024
+LOCAL_UPLOAD_LIMIT = 2000 * 1024 * 1024
+
+
+def retry_after_of(body, headers) -> float:
+    """Seconds a 429 answer asks to wait: the JSON body's retry_after, else Retry-After."""
+    try:
+        return float(body["parameters"]["retry_after"])
+    except Exception:
+        pass
+    try:
+        return float(headers.get("Retry-After", 5))
+    except ValueError:
+        return 5.0
+
+
+@dataclass
+class UploadJob:
+    """One file waiting to be sent to a chat."""
+
+    chat_id: str
+    file_path: str
+    caption: str
+    on_sent: Optional[Callable[["UploadJob"], None]] = None
+    on_failed: Optional[Callable[["UploadJob"], None]] = None
+    owner: object = None  # whoever submitted it, for pending() and drain()
+    attempts: int = 0
+    send_seconds: float = 0.0  # duration of the last sendDocument attempt
+    sending: bool = False  # a worker has it
+    done: bool = False  # finished, waiting for earlier jobs of the chat
+    ok: bool = False
+
+
+class TelegramUploader:
+    """
+    Sends documents to Telegram from a pool of worker threads.
+
+    Each chat has its own FIFO queue; different chats upload in parallel.
+    Within a chat at most `per_chat_concurrency` uploads are in flight. With
+    the default of 1 files arrive in the order they were submitted. Telegram
+    posts a document when its upload completes, so with more than one a
+    small file can overtake a bigger one in the chat. The on_sent/on_failed
+    callbacks still run in submission order either way.
+
+    Pacing follows Telegram's flood limits: a minimum gap between sends to
+    the same chat, a bot-wide rate, and the `retry_after` returned with HTTP
+    429. That pauses the chat, and the bot-wide send slot with it, for
+    exactly as long as asked, since the flood limit counts per bot. 5xx
+    responses and network errors back off exponentially. Other 4xx responses
+    (file too big, bot removed from chat) will never succeed and are dropped.
+
+    With local_mode=True, api_base points at a self-hosted Bot API server
+    running with --local on the same disk: documents are passed as file://
+    paths the server reads itself instead of multipart uploads, and files up
+    to 2000 MB are accepted.
+    """
+
+    def __init__(
+        self,
+        bot_token,
+        workers=2,
+        api_base="https://api.telegram.org",
+        per_chat_interval=1.0,
+        global_interval=1 / 30,
+        max_backoff=300,
+        timeout=120,
+        session=None,
+        local_mode=False,
+        per_chat_concurrency=1,
+    ):
+        self.bot_token = bot_token
+        self.workers = max(1, workers)
+        self.per_chat_concurrency = max(1, per_chat_concurrency)
+        self.api_base = api_base.rstrip("/")
+        self.per_chat_interval = per_chat_interval
+        self.global_interval = global_interval
+        self.max_backoff = max_backoff
+        self.timeout = timeout
+        self.session = session or requests.Session()
+        self.local_mode = local_mode
+        self.upload_limit = LOCAL_UPLOAD_LIMIT if local_mode else CLOUD_UPLOAD_LIMIT
+
+        self.queues = collections.OrderedDict()  # chat_id -> deque of UploadJob
+        self.ready_at = {}  # chat_id -> monotonic time the chat may be sent to again
+        self.backoff = {}  # chat_id -> current 5xx backoff in seconds
+        self.next_send = 0.0  # monotonic time of the next bot-wide send slot
+        self.cond = threading.Condition()
+        self.callback_lock = threading.Lock()  # keeps callbacks in submission order
+        self.stopped = False
+        self.threads = []
+
+    @property
+    def url(self) -> str:
+        return f"{self.api_base}/bot{self.bot_token}/sendDocument"
+
+    def start(self):
+        """Start the worker threads (idempotent)."""
+        if self.threads:
+            return
+        for i in range(self.workers):
+            t = threading.Thread(
+                target=self.worker, name=f"upload-{i}", daemon=True
+            )
+            t.start()
+            self.threads.append(t)
+
+    def stop(self, timeout=5):
+        with self.cond:
+            self.stopped = True
+            self.cond.notify_all()
+        for t in self.threads:
+            t.join(timeout=timeout)
+        self.threads = []
+
+    def submit(self, chat_id, file_path, caption, on_sent=None, on_failed=None, owner=None):
+        """Queue a file for upload behind everything already queued for the chat."""
+        job = UploadJob(str(chat_id), file_path, caption, on_sent, on_failed, owner)
+        with self.cond:
+            self.queues.setdefault(job.chat_id, collections.deque()).append(job)
+            self.cond.notify()
+        return job
+
+    def pending(self, chat_id=None, owner=None) -> int:
+        """Number of queued or in-flight uploads, optionally for one chat or owner."""
+        with self.cond:
+            if chat_id is not None:
+                jobs = self.queues.get(str(chat_id), ())
+            else:
+                jobs = [job for q in self.queues.values() for job in q]
+            if owner is not None:
+                return sum(1 for job in jobs if job.owner is owner)
+            return len(jobs)
+
+    def drain(self, owner, timeout=None) -> bool:
+        """
+        Cancel an owner's queued uploads and wait for the ones in flight, so
+        none of its callbacks runs after this returns True. Cancelled jobs get
+        no callback: they were never sent. False if `timeout` (default: one
+        send timeout) ran out first.
+        """
+        deadline = time.monotonic() + (self.timeout if timeout is None else timeout)
+        while True:
+            with self.callback_lock:
+                with self.cond:
+                    for jobs in self.queues.values():
+                        for job in list(jobs):
+                            if job.owner is owner and not job.sending and not job.done:
+                                jobs.remove(job)
+                    # finished jobs that only waited for a cancelled one
+                    finished = self.pop_finished(list(self.queues))
+                self.run_callbacks(finished)
+            with self.cond:
+                if not any(job.owner is owner for jobs in self.queues.values() for job in jobs):
+                    return True
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                self.cond.wait(remaining)
+
+    def next_job(self):
+        """Block until some chat is idle, not paused and has work; claim it."""
+        with self.cond:
+            while not self.stopped:
+                now = time.monotonic()
+                wake_at = None
+                for chat_id, jobs in self.queues.items():
+                    if sum(1 for job in jobs if job.sending) >= self.per_chat_concurrency:
+                        continue
+                    job = next((j for j in jobs if not j.sending and not j.done), None)
+                    if job is None:
+                        continue
+                    ready_at = self.ready_at.get(chat_id, 0)
+                    if ready_at <= now:
+                        job.sending = True
+                        self.ready_at[chat_id] = now + self.per_chat_interval
+                        # rotate so busy chats do not starve the others
+                        self.queues.move_to_end(chat_id)
+                        return job
+                    wake_at = ready_at if wake_at is None else min(wake_at, ready_at)
+                self.cond.wait(None if wake_at is None else wake_at - now)
+            return None
+
+    def hold_all(self, delay: float):
+        """Push the bot-wide send slot back: a flood limit applies to the whole bot."""
+        with self.cond:
+            self.next_send = max(self.next_send, time.monotonic() + delay)
+
+    def take_send_slot(self):
+        """Respect the bot-wide send rate."""
+        with self.cond:
+            now = time.monotonic()
+            slot = max(now, self.next_send)
+            self.next_send = slot + self.global_interval
+        if slot > now:
+            time.sleep(slot - now)
+
+    def local_uri(self, file_path) -> str:
+        """file:// URI of a file for a local-mode server; raises if it is gone."""
+        path = os.path.abspath(file_path)
+        if not os.path.isfile(path):
+            raise FileNotFoundError(path)
+        return "file://" + path
+
+    def send(self, job: UploadJob):
+        """One sendDocument attempt. Returns the HTTP response."""
+        if self.local_mode:
+            data = {
+                "chat_id": job.chat_id,
+                "caption": job.caption,
+                "document": self.local_uri(job.file_path),
+            }
+            return self.session.post(self.url, data=data, timeout=self.timeout)
+        with open(job.file_path, "rb") as f:
+            return self.session.post(
+                self.url,
+                data={"chat_id": job.chat_id, "caption": job.caption},
+                files={"document": f},
+                timeout=self.timeout,
+            )
+
+    def worker(self):
+        while True:
+            job = self.next_job()
+            if job is None:
+                return
+            self.take_send_slot()
+            job.attempts += 1
+            started = time.monotonic()
+            try:
+                response = self.send(job)
+                status = response.status_code
+                job.send_seconds = time.monotonic() - started
+            except FileNotFoundError as e:
+                print(f"❌ {job.file_path} is gone, dropping upload: {e}")
+                self.finish(job, ok=False)
+                continue
+            except Exception as e:
+                print(f"⚠️ Telegram send error for {job.file_path}: {e}")
+                self.retry(job, self.next_backoff(job.chat_id))
+                continue
+
+            if status == 200:
+                self.finish(job, ok=True)
+            elif status == 429:
+                retry_after = self.retry_after(response)
+                print(f"🐢 Flood limit for chat {job.chat_id}: retry after {retry_after}s")
+                self.hold_all(retry_after)
+                self.retry(job, retry_after)
+            elif status >= 500:
+                delay = self.next_backoff(job.chat_id)
+                print(f"Telegram responded {status}, retrying {job.file_path} in {delay}s...")
+                self.retry(job, delay)
+            else:
+                print(f"❌ Telegram rejected {job.file_path} ({status}): {response.text}")
+                self.finish(job, ok=False)
+
+    def retry_after(self, response) -> float:
+        """Seconds Telegram asked us to wait, from the body or the header."""
+        try:
+            body = response.json()
+        except Exception:
+            body = None
+        return retry_after_of(body, response.headers)
+
+    def next_backoff(self, chat_id) -> float:
+        with self.cond:
+            delay = min(self.backoff.get(chat_id, 1) * 2, self.max_backoff)
+            self.backoff[chat_id] = delay
+        return delay
+
+    def retry(self, job: UploadJob, delay: float):
+        """Leave the job in its place in the queue and pause the chat."""
+        with self.cond:
+            self.ready_at[job.chat_id] = time.monotonic() + delay
+            job.sending = False
+            self.cond.notify_all()
+
+    def finish(self, job: UploadJob, ok: bool):
+        """Mark a job done; the chat's jobs leave the queue, and call back, in order."""
+        with self.callback_lock:
+            with self.cond:
+                job.sending = False
+                job.done = True
+                job.ok = ok
+                if ok:
+                    self.backoff.pop(job.chat_id, None)
+                self.ready_at[job.chat_id] = time.monotonic() + self.per_chat_interval
+                finished = self.pop_finished([job.chat_id])
+                self.cond.notify_all()
+            self.run_callbacks(finished)
+
+    def pop_finished(self, chat_ids):
+        """Remove done jobs from the head of the chats' queues. Caller holds cond."""
+        finished = []
+        for chat_id in chat_ids:
+            jobs = self.queues.get(chat_id)
+            while jobs and jobs[0].done:
+                finished.append(jobs.popleft())
+        return finished
+
+    def run_callbacks(self, jobs):
+        for job in jobs:
+            callback = job.on_sent if job.ok else job.on_failed
+            if callback:
+                try:
+                    callback(job)
+                except Exception as e:
+                    print("Upload callback error:", e)
@@ -0,0 +1,31 @@
+import asyncio
+import os
+
+from async_m3u8_ts_to_tg import AsyncM3U8TSToTG
+from hls_playlist import Segment
+from sent_ledger import SentLedger
+
+
+def test_already_merged_group_is_released(tmp_path):
+    engine = AsyncM3U8TSToTG("http://origin/live.m3u8", "token", "1", work_dir=str(tmp_path))
+    engine.sent = SentLedger(str(tmp_path / "sent.json"))
+    group = []
+    for sequence in range(3):
+        path = str(tmp_path / f"s{sequence}.ts")
+        with open(path, "wb") as f:
+            f.write(b"\x47" * 188)
+        engine.ledger.add(sequence, path)
+        engine.ledger.claim(sequence)
+        engine.stage(188)
+        group.append(Segment(sequence=sequence, url="", path=path, size=188))
+    mp4_name = engine.mp4_name_for(group[0].path)
+    with open(mp4_name, "wb") as f:
+        f.write(b"mp4")
+    # merged and sent by an earlier run
+    engine.sent.record(os.path.basename(mp4_name), sent=True)
+
+    assert asyncio.run(engine.merge_group_async(group)) == (True, None)
+    assert not any(os.path.exists(segment.path) for segment in group)
+    assert engine.staged_bytes == 0
+    assert len(engine.ledger) == 0 and engine.ledger.floor == 3
+    engine.sent.close()
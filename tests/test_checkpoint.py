@@ -0,0 +1,86 @@
+import os
+
+from checkpoint import Checkpoint
+from hls_playlist import Segment
+from m3u8_ts_to_tg import M3U8TSToTG
+from sent_ledger import SentLedger
+
+URL = "http://origin/live.m3u8"
+
+
+def ts_segment(tmp_path, sequence):
+    path = str(tmp_path / f"seg{sequence}.ts")
+    with open(path, "wb") as f:
+        f.write(b"\x47" * 188)
+    return Segment(sequence=sequence, url="", path=path, size=188, duration=6.0)
+
+
+def test_save_and_load_round_trip(tmp_path):
+    checkpoint = Checkpoint(str(tmp_path / "checkpoint.json"))
+    pending = [ts_segment(tmp_path, 5), ts_segment(tmp_path, 6)]
+    checkpoint.save(URL, 7, pending, ["a.mp4"])
+    checkpoint.close()
+
+    state = Checkpoint(str(tmp_path / "checkpoint.json")).load()
+    assert state["m3u8_url"] == URL
+    assert state["next_sequence"] == 7
+    assert [(s.sequence, s.path, s.duration) for s in state["pending"]] == [
+        (s.sequence, s.path, s.duration) for s in pending
+    ]
+    assert state["uploads"] == ["a.mp4"]
+
+
+def test_journal_covers_segments_published_after_the_last_save(tmp_path):
+    path = str(tmp_path / "checkpoint.json")
+    checkpoint = Checkpoint(path)
+    checkpoint.published(ts_segment(tmp_path, 5))
+    checkpoint.save(URL, 6, [ts_segment(tmp_path, 5)], [])
+    checkpoint.published(ts_segment(tmp_path, 7))
+    checkpoint.published(ts_segment(tmp_path, 6))
+    # crash: no close(), half a line at the end of the journal
+    with open(path + ".journal", "a", encoding="utf-8") as f:
+        f.write('{"sequence": 8, "pa')
+
+    state = Checkpoint(path).load()
+    assert [s.sequence for s in state["pending"]] == [5, 6, 7]
+    assert state["next_sequence"] == 8
+
+
+def test_save_drops_the_journal_lines_it_covers(tmp_path):
+    path = str(tmp_path / "checkpoint.json")
+    checkpoint = Checkpoint(path)
+    for sequence in range(3):
+        checkpoint.published(ts_segment(tmp_path, sequence))
+    checkpoint.save(URL, 2, [], [])
+    checkpoint.close()
+    assert [entry["sequence"] for entry in checkpoint.read_journal()] == [2]
+
+
+def test_unreadable_checkpoint_is_ignored(tmp_path):
+    path = tmp_path / "checkpoint.json"
+    path.write_text("{not json")
+    assert Checkpoint(str(path)).load() is None
+
+
+def test_engine_resumes_at_the_saved_media_sequence(tmp_path):
+    engine = M3U8TSToTG(URL, "token", "1", work_dir=str(tmp_path))
+    engine.sent = SentLedger(str(tmp_path / "sent.json"))
+    checkpoint = Checkpoint(str(tmp_path / "checkpoint.json"))
+    checkpoint.save(URL, 11, [ts_segment(tmp_path, 10)], [])
+    checkpoint.published(ts_segment(tmp_path, 11))
+    checkpoint.close()
+    # downloaded after the last journal line made it to disk
+    stray = ts_segment(tmp_path, 99)
+    try:
+        engine.recover_leftovers()
+        assert [(s.sequence, os.path.basename(s.path)) for s in engine.pending_ts] == [
+            (10, "seg10.ts"),
+            (11, "seg11.ts"),
+            (12, os.path.basename(stray.path)),
+        ]
+        assert engine.next_sequence == 13
+        assert engine.ledger.floor == 13
+        assert engine.staged_bytes == 3 * 188
+    finally:
+        engine.sent.close()
+        engine.checkpoint.close()
@@ -0,0 +1,94 @@
+from hls_playlist import (
+    MediaPlaylistParser,
+    guess_segment_url,
+    parse_master_playlist,
+    parse_media_playlist,
+)
+
+URL = "http://origin/live/index.m3u8"
+
+
+def live(first, count, extra=None):
+    lines = ["#EXTM3U", "#EXT-X-TARGETDURATION:6", f"#EXT-X-MEDIA-SEQUENCE:{first}"]
+    for sequence in range(first, first + count):
+        lines += (extra or {}).get(sequence, [])
+        lines += ["#EXTINF:6.0,", f"seg{sequence}.ts"]
+    return "\n".join(lines) + "\n"
+
+
+def test_segments_are_numbered_from_the_media_sequence():
+    playlist = parse_media_playlist(live(100, 3), URL)
+    assert playlist.media_sequence == 100
+    assert playlist.target_duration == 6
+    assert [s.sequence for s in playlist.segments] == [100, 101, 102]
+    assert playlist.segments[0].url == "http://origin/live/seg100.ts"
+    assert not playlist.ended
+
+
+def test_refresh_keeps_known_segments_and_parses_only_new_ones():
+    parser = MediaPlaylistParser(URL)
+    first = parser.parse(live(100, 3, {102: ["#EXT-X-DISCONTINUITY"]}))
+    second = parser.parse(live(101, 4))
+    assert [s.sequence for s in second.segments] == [101, 102, 103, 104]
+    # the same objects, with the tags they were parsed with
+    assert second.segments[0] is first.segments[1]
+    assert second.segments[1].discontinuity
+    assert not second.segments[3].discontinuity
+
+
+def test_restart_is_parsed_from_scratch():
+    parser = MediaPlaylistParser(URL)
+    parser.parse(live(100, 3))
+    playlist = parser.parse(live(0, 2))
+    assert [s.sequence for s in playlist.segments] == [0, 1]
+    assert playlist.segments[0].url.endswith("seg0.ts")
+
+
+def test_tags_apply_to_the_next_segment():
+    text = (
+        "#EXTM3U\n#EXT-X-TARGETDURATION:4\n"
+        "#EXT-X-PROGRAM-DATE-TIME:2024-01-01T00:00:00Z\n"
+        '#EXT-X-KEY:METHOD=AES-128,URI="key.bin",IV=0x000102030405060708090a0b0c0d0e0f\n'
+        "#EXTINF:4.0,\n#EXT-X-BYTERANGE:1000@0\nmedia.ts\n"
+        "#EXTINF:4.0,\n#EXT-X-BYTERANGE:500\nmedia.ts\n"
+        "#EXT-X-KEY:METHOD=NONE\n#EXTINF:2.5,\nlast.ts\n"
+        "#EXT-X-ENDLIST\n"
+    )
+    playlist = parse_media_playlist(text, URL)
+    first, second, last = playlist.segments
+    assert playlist.ended
+    assert first.byterange == (1000, 0)
+    # no @offset: continues where the previous range of the same URI ended
+    assert second.byterange == (500, 1000)
+    assert first.key.uri == "http://origin/live/key.bin"
+    assert first.key.iv == bytes(range(16))
+    assert last.key is None and last.duration == 2.5
+    assert second.program_date_time - first.program_date_time == 4.0
+
+
+def test_identity_key_wins_over_a_drm_key():
+    text = (
+        "#EXTM3U\n#EXT-X-TARGETDURATION:4\n"
+        '#EXT-X-KEY:METHOD=SAMPLE-AES,URI="skd://drm",KEYFORMAT="com.apple.streamingkeydelivery"\n'
+        '#EXT-X-KEY:METHOD=SAMPLE-AES,URI="key.bin"\n'
+        "#EXTINF:4.0,\nseg0.ts\n"
+    )
+    key = parse_media_playlist(text, URL).segments[0].key
+    assert key.keyformat == "identity" and key.uri.endswith("key.bin")
+
+
+def test_master_playlist_variants_are_sorted_by_bandwidth():
+    text = (
+        "#EXTM3U\n"
+        "#EXT-X-STREAM-INF:BANDWIDTH=3000000,RESOLUTION=1280x720\nhi/index.m3u8\n"
+        '#EXT-X-STREAM-INF:BANDWIDTH=800000,RESOLUTION=640x360,CODECS="avc1.4d401e,mp4a.40.2"\nlo/index.m3u8\n'
+    )
+    variants = parse_master_playlist(text, URL)
+    assert [v.height for v in variants] == [360, 720]
+    assert variants[0].url == "http://origin/live/lo/index.m3u8"
+
+
+def test_segment_urls_are_guessed_from_the_naming_scheme():
+    known = [(10, "http://cdn/a/chunk_1699_0010.ts"), (11, "http://cdn/a/chunk_1699_0011.ts")]
+    assert guess_segment_url(known, 7) == "http://cdn/a/chunk_1699_0007.ts"
+    assert guess_segment_url([(10, "x/abc.ts"), (11, "x/def.ts")], 7) is None
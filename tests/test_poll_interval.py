@@ -0,0 +1,42 @@
+from m3u8_ts_to_tg import M3U8TSToTG
+
+
+def window(first, count=3):
+    lines = ["#EXTM3U", "#EXT-X-TARGETDURATION:4", f"#EXT-X-MEDIA-SEQUENCE:{first}"]
+    for sequence in range(first, first + count):
+        lines += ["#EXTINF:4.0,", f"seg{sequence}.ts"]
+    return "\n".join(lines) + "\n"
+
+
+def make_engine(tmp_path, **kwargs):
+    engine = M3U8TSToTG("http://origin/live.m3u8", "token", "1", work_dir=str(tmp_path), **kwargs)
+    engine.max_backfill = 0  # nothing to fetch in these tests
+    return engine
+
+
+def poll(engine, first):
+    engine.new_segments(engine.parse_playlist(window(first)))
+
+
+def test_gap_tightens_the_poll_interval(tmp_path):
+    engine = make_engine(tmp_path)
+    poll(engine, 0)
+    poll(engine, 10)
+    assert engine.poll_scale == 0.5
+    for i in range(engine.restore_poll_after):
+        poll(engine, 10 + i)
+    assert engine.poll_scale == 1.0
+
+
+def test_gap_from_a_disk_budget_pause_keeps_the_poll_interval(tmp_path):
+    engine = make_engine(tmp_path, disk_budget=1000)
+    poll(engine, 0)
+    engine.stage(1000)
+    assert engine.downloads_paused()
+    engine.stage(-1000)
+    assert not engine.downloads_paused()
+    poll(engine, 10)
+    assert engine.poll_scale == 1.0
+    # a later gap is the origin's doing again
+    poll(engine, 20)
+    assert engine.poll_scale == 0.5
@@ -0,0 +1,23 @@
+import pytest
+
+from hls_playlist import Variant
+from m3u8_ts_to_tg import M3U8TSToTG, RenditionSelector
+
+VARIANTS = [
+    Variant(url="360.m3u8", bandwidth=800000, height=360),
+    Variant(url="720.m3u8", bandwidth=3000000, height=720),
+    Variant(url="1080.m3u8", bandwidth=6000000, height=1080),
+]
+
+
+def test_caps_limit_the_choice():
+    assert RenditionSelector(VARIANTS, max_height=720).current.height == 720
+    assert RenditionSelector(VARIANTS, max_bandwidth=1000000).current.height == 360
+    assert RenditionSelector(VARIANTS, policy="lowest").current.height == 360
+
+
+def test_unknown_policy_is_rejected(tmp_path):
+    with pytest.raises(ValueError):
+        RenditionSelector(VARIANTS, policy="best")
+    with pytest.raises(ValueError):
+        M3U8TSToTG("http://origin/master.m3u8", "token", "1", work_dir=str(tmp_path), rendition_policy="best")
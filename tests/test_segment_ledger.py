@@ -0,0 +1,109 @@
+from hls_playlist import Segment
+from m3u8_ts_to_tg import M3U8TSToTG, SegmentLedger
+
+
+def ledger_with(sequences):
+    ledger = SegmentLedger()
+    for sequence in sequences:
+        assert ledger.add(sequence, f"s{sequence}.ts")
+        assert ledger.claim(sequence)
+    return ledger
+
+
+def test_add_and_claim_are_deduplicated():
+    ledger = ledger_with([0])
+    assert not ledger.add(0, "s0.ts")
+    assert not ledger.claim(0)
+    ledger.release(0)
+    assert ledger.claim(0)
+    assert ledger.sequence_of("s0.ts") == 0
+
+
+def test_retired_segments_behind_a_failed_one_are_not_fetched_again():
+    ledger = ledger_with(range(6))
+    ledger.release(3)  # download failed, the next poll retries it
+    for sequence in (0, 1, 2, 4, 5):
+        ledger.retire(sequence)
+    assert ledger.floor == 3
+    # the next poll lists 3-7 again
+    assert not ledger.add(4, "s4.ts")
+    assert not ledger.add(5, "s5.ts")
+    assert not ledger.add(3, "s3.ts")
+    assert ledger.claim(3)
+    assert ledger.add(6, "s6.ts")
+
+    ledger.retire(3)
+    assert ledger.floor == 6
+    assert ledger.done == set()
+    assert len(ledger) == 1
+
+
+def test_uploaded_mp4_behind_a_failed_segment_is_not_merged_again():
+    ledger = ledger_with(range(8))
+    ledger.mark_merged("a.mp4", ["s0.ts", "s1.ts", "s2.ts"])
+    ledger.mark_merged("b.mp4", ["s4.ts", "s5.ts", "s6.ts", "s7.ts"])
+    ledger.mark_uploaded("b.mp4")
+    ledger.mark_uploaded("a.mp4")
+    assert ledger.floor == 3
+    for sequence in range(4, 8):
+        assert not ledger.add(sequence, f"s{sequence}.ts")
+
+    ledger.mark_merged("c.mp4", ["s3.ts"])
+    ledger.mark_uploaded("c.mp4")
+    assert ledger.floor == 8
+    assert len(ledger) == 0 and ledger.done == set()
+
+
+def test_expire_before_forgets_only_unclaimed_entries():
+    ledger = ledger_with([0, 1])
+    ledger.add(2, "s2.ts")
+    ledger.add(3, "s3.ts")
+    ledger.release(1)
+    assert ledger.expire_before(3) == [1, 2]
+    assert 0 in ledger.files and 3 in ledger.files
+    assert ledger.floor == 0
+    assert not ledger.add(2, "s2.ts")
+    ledger.retire(0)
+    assert ledger.floor == 3
+
+
+def test_reset_forgets_everything():
+    ledger = ledger_with(range(3))
+    ledger.retire(2)
+    ledger.reset()
+    assert ledger.floor is None and not ledger.done and len(ledger) == 0
+    assert ledger.add(2, "s2.ts")
+
+
+class FakeRemuxer:
+    def __init__(self):
+        self.fed = []
+
+    def feed(self, data, name="segment"):
+        self.fed.append(data)
+
+    def close(self):
+        pass
+
+
+def test_stream_mode_holds_later_segments_behind_a_failed_one(tmp_path):
+    engine = M3U8TSToTG("http://origin/live.m3u8", "token", "1", work_dir=str(tmp_path), merge_mode="stream")
+    engine.remuxer = remuxer = FakeRemuxer()
+    for sequence in range(6):
+        engine.ledger.add(sequence, f"s{sequence}.ts")
+        engine.ledger.claim(sequence)
+
+    def downloaded(sequence):
+        engine.spools[f"s{sequence}.part"] = bytes([sequence])
+        segment = Segment(sequence=sequence, url=f"http://origin/s{sequence}.ts")
+        engine.stream_segment(segment, f"s{sequence}.part")
+
+    for sequence in (0, 1, 2, 4, 5):
+        downloaded(sequence)
+    assert remuxer.fed == [b"\x00", b"\x01", b"\x02"]
+    engine.ledger.release(3)
+    assert not engine.ledger.add(4, "s4.ts")
+
+    downloaded(3)
+    assert remuxer.fed == [bytes([i]) for i in range(6)]
+    assert engine.ledger.floor == 6
@@ -0,0 +1,86 @@
+import json
+import threading
+import time
+
+from sent_ledger import SentLedger
+from telegram_uploader import TelegramUploader
+
+
+def test_journal_survives_a_crash_and_a_torn_line(tmp_path):
+    path = str(tmp_path / "sent.json")
+    ledger = SentLedger(path)
+    ledger.record("a.mp4", first_seen=1, sent=False)
+    ledger.record("a.mp4", sent=True)
+    ledger.record("b.mp4", first_seen=2, sent=False)
+    # crash: no close(), half a line at the end of the journal
+    with open(path + ".journal", "a", encoding="utf-8") as f:
+        f.write('{"name": "c.mp4", "se')
+
+    resumed = SentLedger(path)
+    assert resumed.is_sent("a.mp4")
+    assert not resumed.is_sent("b.mp4")
+    assert "c.mp4" not in resumed
+    # loading compacted the journal into the snapshot
+    with open(path, encoding="utf-8") as f:
+        assert json.load(f)["a.mp4"] == {"first_seen": 1, "sent": True}
+
+
+def test_compaction_keeps_every_entry(tmp_path):
+    path = str(tmp_path / "sent.json")
+    ledger = SentLedger(path, compact_every=3)
+    for i in range(10):
+        ledger.record(f"{i}.mp4", sent=True)
+    ledger.close()
+    assert all(SentLedger(path).is_sent(f"{i}.mp4") for i in range(10))
+
+
+def test_record_after_close_is_a_no_op(tmp_path):
+    path = str(tmp_path / "sent.json")
+    ledger = SentLedger(path)
+    ledger.close()
+    ledger.record("late.mp4", sent=True)
+    assert not SentLedger(path).is_sent("late.mp4")
+
+
+class SlowResponse:
+    status_code = 200
+
+
+class SlowSession:
+    """Answers every sendDocument after `delay` seconds."""
+
+    def __init__(self, delay):
+        self.delay = delay
+        self.started = threading.Event()
+
+    def post(self, url, **kwargs):
+        self.started.set()
+        time.sleep(self.delay)
+        return SlowResponse()
+
+
+def test_drain_cancels_queued_uploads_and_waits_for_the_one_in_flight(tmp_path):
+    session = SlowSession(0.3)
+    uploader = TelegramUploader("token", workers=1, per_chat_interval=0, session=session, local_mode=True)
+    files = []
+    for i in range(3):
+        path = tmp_path / f"{i}.mp4"
+        path.write_bytes(b"mp4")
+        files.append(str(path))
+    sent = []
+    owner, other = object(), object()
+    for path in files[:2]:
+        uploader.submit("1", path, "", on_sent=lambda job: sent.append(job.file_path), owner=owner)
+    uploader.submit("2", files[2], "", owner=other)
+    uploader.start()
+    try:
+        assert session.started.wait(2)
+        assert uploader.drain(owner, timeout=5)
+        assert uploader.pending(owner=owner) == 0
+        assert uploader.pending(owner=other) == 1
+        # nothing of the owner's finishes after drain() returned
+        assert sent == files[:1]
+        time.sleep(0.4)
+        assert sent == files[:1]
+    finally:
+        uploader.stop()
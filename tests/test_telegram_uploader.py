@@ -0,0 +1,112 @@
+import threading
+import time
+
+from telegram_uploader import TelegramUploader
+
+
+class Response:
+    def __init__(self, status_code, body=None):
+        self.status_code = status_code
+        self.body = body or {}
+        self.headers = {}
+        self.text = str(self.body)
+
+    def json(self):
+        return self.body
+
+
+class FakeBot:
+    """sendDocument that takes longer for files named in `delays`."""
+
+    def __init__(self, delays=None, flood=0):
+        self.delays = delays or {}
+        self.flood = flood  # answer the first N sends with 429
+        self.lock = threading.Lock()
+        self.active = 0
+        self.most_active = 0
+        self.sends = []
+
+    def post(self, url, data=None, **kwargs):
+        name = data["document"].rsplit("/", 1)[-1]
+        with self.lock:
+            self.sends.append((name, time.monotonic()))
+            if self.flood:
+                self.flood -= 1
+                return Response(429, {"ok": False, "parameters": {"retry_after": 1}})
+            self.active += 1
+            self.most_active = max(self.most_active, self.active)
+        time.sleep(self.delays.get(name, 0.05))
+        with self.lock:
+            self.active -= 1
+        return Response(200)
+
+
+def make_files(tmp_path, count):
+    files = []
+    for i in range(count):
+        path = tmp_path / f"{i}.mp4"
+        path.write_bytes(b"mp4")
+        files.append(str(path))
+    return files
+
+
+def wait_for(predicate, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not predicate() and time.monotonic() < deadline:
+        time.sleep(0.01)
+    return predicate()
+
+
+def test_one_chat_uploads_concurrently_and_calls_back_in_order(tmp_path):
+    # the first file is the slowest, so the others finish before it
+    bot = FakeBot(delays={"0.mp4": 0.4})
+    uploader = TelegramUploader(
+        "token", workers=3, per_chat_interval=0, session=bot, local_mode=True,
+        global_interval=0, per_chat_concurrency=3,
+    )
+    files = make_files(tmp_path, 3)
+    sent = []
+    for path in files:
+        uploader.submit("1", path, "", on_sent=lambda job: sent.append(job.file_path))
+    uploader.start()
+    try:
+        assert wait_for(lambda: len(sent) == 3)
+        assert bot.most_active == 3
+        assert sent == files
+        assert uploader.pending() == 0
+    finally:
+        uploader.stop()
+
+
+def test_default_keeps_one_upload_per_chat(tmp_path):
+    bot = FakeBot()
+    uploader = TelegramUploader("token", workers=3, per_chat_interval=0, global_interval=0,
+                                session=bot, local_mode=True)
+    sent = []
+    for path in make_files(tmp_path, 3):
+        uploader.submit("1", path, "", on_sent=lambda job: sent.append(job.file_path))
+    uploader.start()
+    try:
+        assert wait_for(lambda: len(sent) == 3)
+        assert bot.most_active == 1
+    finally:
+        uploader.stop()
+
+
+def test_flood_limit_pauses_every_chat(tmp_path):
+    bot = FakeBot(flood=1)
+    uploader = TelegramUploader("token", workers=2, per_chat_interval=0, global_interval=0,
+                                session=bot, local_mode=True)
+    first, second = make_files(tmp_path, 2)
+    sent = []
+    uploader.submit("1", first, "", on_sent=lambda job: sent.append(job.file_path))
+    uploader.start()
+    try:
+        assert wait_for(lambda: len(bot.sends) == 1)
+        flooded_at = bot.sends[0][1]
+        # another chat must wait out the retry_after too
+        uploader.submit("2", second, "", on_sent=lambda job: sent.append(job.file_path))
+        assert wait_for(lambda: len(sent) == 2)
+        assert all(at - flooded_at >= 0.9 for name, at in bot.sends[1:])
+    finally:
+        uploader.stop()
@@ -0,0 +1,71 @@
+from ts_scanner import scan_ts
+
+VIDEO_PID, PMT_PID = 0x100, 0x1000
+
+
+def packet(pid: int, payload: bytes, cc: int, pusi=False, rai=False) -> bytes:
+    """One TS packet, padded with an adaptation field (which carries RAI when asked)."""
+    header = bytes([0x47, (0x40 if pusi else 0) | pid >> 8, pid & 0xFF])
+    stuffing = 184 - len(payload)
+    if not stuffing and not rai:
+        return header + bytes([0x10 | cc]) + payload
+    af = bytes([stuffing - 1, 0x40 if rai else 0x00]) + b"\xff" * (stuffing - 2)
+    return header + bytes([0x30 | cc]) + af + payload
+
+
+def psi(table: bytes) -> bytes:
+    return b"\x00" + table + b"\x00" * 4  # the scanner does not check the CRC
+
+
+def pat() -> bytes:
+    return psi(bytes([0x00, 0xB0, 13, 0x00, 0x01, 0xC1, 0x00, 0x00, 0x00, 0x01, 0xE0 | PMT_PID >> 8, PMT_PID & 0xFF]))
+
+
+def pmt(stream_type=0x1B) -> bytes:
+    stream = bytes([stream_type, 0xE0 | VIDEO_PID >> 8, VIDEO_PID & 0xFF, 0xF0, 0x00])
+    return psi(bytes([0x02, 0xB0, 9 + len(stream) + 4, 0x00, 0x01, 0xC1, 0x00, 0x00,
+                      0xE0 | VIDEO_PID >> 8, VIDEO_PID & 0xFF, 0xF0, 0x00]) + stream)
+
+
+def pes(pts: int, nal_type: int) -> bytes:
+    pts_bytes = bytes([
+        0x21 | ((pts >> 29) & 0x0E), (pts >> 22) & 0xFF, 0x01 | ((pts >> 14) & 0xFE),
+        (pts >> 7) & 0xFF, 0x01 | ((pts << 1) & 0xFE),
+    ])
+    return bytes([0, 0, 1, 0xE0, 0, 0, 0x80, 0x80, 5]) + pts_bytes + b"\x00\x00\x00\x01" + bytes([nal_type]) + bytes(20)
+
+
+def segment(frames, rai=False, counters=None):
+    """PAT, PMT, then one single-packet video PES per (pts, nal_type)."""
+    out = packet(0, pat(), 0, pusi=True) + packet(PMT_PID, pmt(), 0, pusi=True)
+    counters = counters or list(range(len(frames)))
+    for (pts, nal_type), cc in zip(frames, counters):
+        out += packet(VIDEO_PID, pes(pts, nal_type), cc, pusi=True, rai=rai)
+    return out
+
+
+def test_rai_flag_marks_a_keyframe_and_pts_range_is_taken():
+    info = scan_ts(segment([(90000, 0x65), (93000, 0x41), (96000, 0x41)], rai=True))
+    assert info.keyframe is True
+    assert info.video_pid == VIDEO_PID
+    assert info.first_pts == 1.0
+    assert abs(info.last_pts - 96000 / 90000) < 1e-9
+    assert info.cc_errors == 0
+    assert info.packets == 5
+
+
+def test_first_slice_decides_without_rai():
+    assert scan_ts(segment([(0, 0x65), (3000, 0x41)])).keyframe is True
+    assert scan_ts(segment([(0, 0x41), (3000, 0x65)])).keyframe is False
+
+
+def test_continuity_counter_jumps_are_counted():
+    frames = [(i * 3000, 0x41) for i in range(4)]
+    assert scan_ts(segment(frames, counters=[0, 1, 1, 2])).cc_errors == 0  # one repeat is allowed
+    assert scan_ts(segment(frames, counters=[0, 1, 3, 4])).cc_errors == 1
+
+
+def test_sync_loss_is_skipped():
+    data = segment([(0, 0x65)], rai=True)
+    info = scan_ts(b"\x00" * 10 + data)
+    assert info.keyframe is True and info.packets == 3
@@ -0,0 +1,195 @@
+from dataclasses import dataclass
+from typing import Optional
+
+PACKET_SIZE = 188
+SYNC_BYTE = 0x47
+NULL_PID = 0x1FFF
+
+# PMT stream types that carry video
+HEVC_TYPES = (0x24,)
+VIDEO_TYPES = (0x01, 0x02, 0x10, 0x1B, 0x24, 0x42)
+
+# how much of the first video PES to search for a slice NAL when RAI is not set
+NAL_SEARCH_LIMIT = 64 * 1024
+
+
+@dataclass
+class TSInfo:
+    """What scan_ts() found in one MPEG-TS segment."""
+
+    keyframe: Optional[bool] = None  # first video frame is a random access point (None: unknown)
+    first_pts: Optional[float] = None  # seconds, lowest PTS on the timing stream
+    last_pts: Optional[float] = None  # seconds, highest PTS on the timing stream
+    cc_errors: int = 0  # continuity-counter jumps (lost or reordered packets)
+    packets: int = 0
+    video_pid: Optional[int] = None
+
+
+def read_pts(b, i: int) -> int:
+    """Decode the 33-bit PTS/DTS field starting at b[i]."""
+    return (
+        ((b[i] >> 1) & 0x07) << 30
+        | b[i + 1] << 22
+        | (b[i + 2] >> 1) << 15
+        | b[i + 3] << 7
+        | b[i + 4] >> 1
+    )
+
+
+def section(b, start: int, end: int):
+    """(offset, end) of the PSI section in a PUSI payload, past its pointer field."""
+    if start >= end:
+        return None
+    start += 1 + b[start]
+    if start + 3 > end:
+        return None
+    length = ((b[start + 1] & 0x0F) << 8) | b[start + 2]
+    # the CRC32 is not part of the entries
+    return start, min(end, start + 3 + length - 4)
+
+
+def nal_keyframe(data, hevc: bool) -> Optional[bool]:
+    """
+    Look for the first slice NAL unit in an Annex B byte stream. True for an
+    IDR/IRAP slice, False for any other slice, None if no slice was found.
+    """
+    i = data.find(b"\x00\x00\x01")
+    while i != -1 and i + 3 < len(data):
+        header = data[i + 3]
+        if hevc:
+            nal_type = (header >> 1) & 0x3F
+            if 16 <= nal_type <= 21:
+                return True
+            if nal_type <= 9:
+                return False
+        else:
+            nal_type = header & 0x1F
+            if nal_type == 5:
+                return True
+            if nal_type == 1:
+                return False
+        i = data.find(b"\x00\x00\x01", i + 3)
+    return None
+
+
+def scan_ts(data) -> TSInfo:
+    """
+    Scan an MPEG-TS buffer without demuxing it.
+
+    Only the PAT, the PMT, PES headers and the adaptation field are read:
+    enough to find the video PID, tell whether the segment opens on a random
+    access point (the RAI flag, or the first slice NAL when a muxer leaves
+    RAI unset), take the PTS range and count continuity-counter errors.
+    """
+    if not isinstance(data, (bytes, bytearray)):
+        data = bytes(data)
+    b = memoryview(data)
+    n = len(b)
+    info = TSInfo()
+
+    pmt_pids = set()
+    stream_types = {}  # pid -> PMT stream type
+    timing_pid = None
+    counters = {}  # pid -> last continuity counter
+    duplicates = set()  # pids whose last packet was a repeat
+    first_video = True  # next video PES start is the segment's first
+    nal_buffer = None  # first video PES payload, while keyframe is undecided
+    pts_min = pts_max = None
+
+    i = 0
+    while i + PACKET_SIZE <= n:
+        if b[i] != SYNC_BYTE:
+            # lost sync: skip to the next sync byte
+            j = data.find(b"\x47", i + 1)
+            if j == -1:
+                break
+            i = j
+            continue
+        info.packets += 1
+        pusi = b[i + 1] & 0x40
+        pid = ((b[i + 1] & 0x1F) << 8) | b[i + 2]
+        afc = (b[i + 3] >> 4) & 0x03
+        cc = b[i + 3] & 0x0F
+        end = i + PACKET_SIZE
+
+        start = i + 4
+        flags = 0
+        if afc & 0x02:
+            af_len = b[start]
+            if af_len:
+                flags = b[start + 1]
+            start += 1 + af_len
+
+        if pid != NULL_PID and afc & 0x01:
+            last = counters.get(pid)
+            if flags & 0x80 or last is None:
+                pass  # discontinuity indicator: counter may restart
+            elif cc == last and pid not in duplicates:
+                # one repeated packet is allowed
+                duplicates.add(pid)
+            elif cc != (last + 1) & 0x0F:
+                info.cc_errors += 1
+            if cc != last:
+                duplicates.discard(pid)
+            counters[pid] = cc
+
+        if not afc & 0x01 or start >= end:
+            i += PACKET_SIZE
+            continue
+
+        if pid == 0 and pusi:
+            sec = section(b, start, end)
+            if sec and b[sec[0]] == 0x00:
+                for j in range(sec[0] + 8, sec[1] - 3, 4):
+                    if (b[j] << 8) | b[j + 1]:  # program 0 is the NIT
+                        pmt_pids.add(((b[j + 2] & 0x1F) << 8) | b[j + 3])
+        elif pid in pmt_pids and pusi:
+            sec = section(b, start, end)
+            if sec and b[sec[0]] == 0x02:
+                s = sec[0]
+                j = s + 12 + (((b[s + 10] & 0x0F) << 8) | b[s + 11])
+                while j + 5 <= sec[1]:
+                    es_pid = ((b[j + 1] & 0x1F) << 8) | b[j + 2]
+                    stream_types[es_pid] = b[j]
+                    if info.video_pid is None and b[j] in VIDEO_TYPES:
+                        info.video_pid = es_pid
+                    j += 5 + (((b[j + 3] & 0x0F) << 8) | b[j + 4])
+        elif pid in stream_types:
+            if timing_pid is None or (pid == info.video_pid and timing_pid != pid):
+                timing_pid = pid
+                pts_min = pts_max = None
+            video = pid == info.video_pid
+
+            if pusi and b[start : start + 3] == b"\x00\x00\x01" and start + 9 <= end:
+                if pid == timing_pid and b[start + 7] & 0x80 and start + 14 <= end:
+                    pts = read_pts(b, start + 9)
+                    pts_min = pts if pts_min is None else min(pts_min, pts)
+                    pts_max = pts if pts_max is None else max(pts_max, pts)
+                if video:
+                    # a second PES start ends the search in the first one
+                    nal_buffer = None
+                    if first_video:
+                        first_video = False
+                        if flags & 0x40:
+                            info.keyframe = True
+                        else:
+                            nal_buffer = bytearray()
+                            start += 9 + b[start + 8]
+            if video and nal_buffer is not None and start < end:
+                nal_buffer += b[start:end]
+                found = nal_keyframe(nal_buffer, stream_types[pid] in HEVC_TYPES)
+                if found is not None or len(nal_buffer) > NAL_SEARCH_LIMIT:
+                    info.keyframe = found
+                    nal_buffer = None
+        i += PACKET_SIZE
+
+    if pts_min is not None:
+        info.first_pts = pts_min / 90000
+        info.last_pts = pts_max / 90000
+    return info
+
+
+def scan_file(path: str) -> TSInfo:
+    """scan_ts() on a file on disk."""
+    with open(path, "rb") as f:
+        return scan_ts(f.read())